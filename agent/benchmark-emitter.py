@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+'''
+Compare records/sec of the shared emitter against the
+MessageToJson -> json.loads -> json.dumps path the agents used to take.
+
+Builds synthetic Variant records shaped like the MC3 MAF output and
+GeneExpression records shaped like the GTEx output, checks that both paths
+produce the same documents, then times each.
+
+example usage:
+
+    python agent/benchmark-emitter.py --variants 20000 --expressions 50 --genes 20000
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+from ga4gh import variants_pb2
+from bmeg import matrix_pb2
+from google.protobuf import json_format
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import emitter
+
+def round_trip(message):
+    msg = json.loads(json_format.MessageToJson(message))
+    msg['#label'] = message.DESCRIPTOR.full_name
+    return json.dumps(msg)
+
+def single_pass(message):
+    return emitter.message_to_json(message, '#label', True)
+
+def build_variants(count):
+    out = []
+    for i in range(count):
+        variant = variants_pb2.Variant()
+        start = random.randint(1, 200000000)
+        variant.id = 'variant:%d:%d:%d:A:T' % (i % 22 + 1, start, start)
+        variant.start = start
+        variant.end = start
+        variant.reference_name = str(i % 22 + 1)
+        variant.reference_bases = 'A'
+        variant.alternate_bases.append('T')
+        for c in ['broad', 'ucsc', 'bcgsc']:
+            variant.info['center'].values.add().string_value = c
+        call = variant.calls.add()
+        call.call_set_id = 'callSet:TCGA-%04d' % (i % 5000)
+        out.append(variant)
+    return out
+
+def build_expressions(count, genes):
+    names = ['GENE%05d' % g for g in range(genes)]
+    out = []
+    for i in range(count):
+        ge = matrix_pb2.GeneExpression()
+        ge.biosample_id = 'biosample:gtex:%d' % i
+        for name in names:
+            ge.expressions[name] = random.random() * 100
+        out.append(ge)
+    return out
+
+def check(messages):
+    for message in messages[:100]:
+        if json.loads(round_trip(message)) != json.loads(single_pass(message)):
+            raise Exception('emitter output differs for %s' % message.DESCRIPTOR.full_name)
+
+def timed(name, convert, messages):
+    start = time.time()
+    size = 0
+    for message in messages:
+        size += len(convert(message))
+    elapsed = time.time() - start
+    rate = len(messages) / elapsed if elapsed > 0 else float('inf')
+    print('%-14s %8d records %8.2fs %12.1f records/sec %10.1f MB' % (name, len(messages), elapsed, rate, size / 1e6))
+    return rate
+
+def run(label, messages):
+    check(messages)
+    print(label)
+    old = timed('round trip', round_trip, messages)
+    new = timed('emitter', single_pass, messages)
+    print('%-14s %.2fx\n' % ('speedup', new / old))
+
+def parse_args(args):
+    args = args[1:]
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--variants', type=int, default=20000, help='number of Variant records')
+    parser.add_argument('--expressions', type=int, default=50, help='number of GeneExpression records')
+    parser.add_argument('--genes', type=int, default=20000, help='genes per GeneExpression record')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(args)
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv)
+    random.seed(options.seed)
+    run('Variant', build_variants(options.variants))
+    run('GeneExpression', build_expressions(options.expressions, options.genes))
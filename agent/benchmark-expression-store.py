@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+'''
+Check and time the expression store in its default configuration, raw
+memory mapped tiles, against zlib compressed tiles.
+
+Writes a synthetic float32 samples x genes matrix, with some genes not
+measured (NaN), to a store of each kind. Checks that the default store maps
+its tiles rather than reading them, and that column, row and submatrix
+slices of both stores equal the matrix. Then times writing each store,
+reading --reads gene columns and sample rows from a freshly opened store,
+and a submatrix of --reads genes over every sample, and prints the size of
+each store on disk.
+
+example usage:
+
+    python agent/benchmark-expression-store.py --samples 2000 --genes 20000
+'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+import numpy
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import expression_store
+
+def synthetic_matrix(samples, genes, missing):
+    matrix = numpy.random.lognormal(1.0, 2.0, size=(samples, genes)).astype(expression_store.DTYPE)
+    matrix[numpy.random.random_sample((samples, genes)) < missing] = numpy.nan
+    return matrix
+
+def same(a, b):
+    return a.shape == b.shape and bool(((a == b) | (numpy.isnan(a) & numpy.isnan(b))).all())
+
+def check(condition, message):
+    if not condition:
+        raise Exception('check failed: ' + message)
+    print('ok   ' + message)
+
+def store_size(path):
+    size = 0
+    for directory, dirs, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(directory, name))
+    return size
+
+def write_store(path, samples, genes, matrix, compression):
+    with expression_store.StoreWriter(path, genes, compression=compression) as store:
+        store.add_matrix(samples, matrix)
+
+def read_columns(path, columns):
+    store = expression_store.ExpressionStore(path)
+    for g in columns:
+        store.column(g)
+
+def read_rows(path, rows):
+    store = expression_store.ExpressionStore(path)
+    for s in rows:
+        store.row(s)
+
+def read_submatrix(path, columns):
+    return expression_store.ExpressionStore(path).submatrix(genes=columns)
+
+def check_store(path, name, samples, genes, matrix, columns, rows):
+    store = expression_store.ExpressionStore(path)
+    if store.compression is None:
+        check(isinstance(store.tile(0, 0), numpy.memmap), '%s store maps its tiles' % name)
+    check(all(same(store.column(genes[g]), matrix[:, g]) for g in columns), '%s store columns equal the matrix' % name)
+    check(all(same(store.row(samples[s]), matrix[s]) for s in rows), '%s store rows equal the matrix' % name)
+    check(same(store.submatrix(genes=[genes[g] for g in columns]), matrix[:, columns]), '%s store submatrix equals the matrix' % name)
+
+def timed(name, function, *args):
+    start = time.time()
+    result = function(*args)
+    elapsed = time.time() - start
+    print('%-24s %8.2fs' % (name, elapsed))
+    return elapsed, result
+
+def parse_args(args):
+    args = args[1:]
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=2000, help='number of samples')
+    parser.add_argument('--genes', type=int, default=20000, help='number of genes')
+    parser.add_argument('--missing', type=float, default=0.1, help='fraction of values not measured')
+    parser.add_argument('--reads', type=int, default=200, help='number of columns, rows and submatrix genes read')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(args)
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv)
+    random.seed(options.seed)
+    numpy.random.seed(options.seed)
+
+    samples = ['sample-%06d' % i for i in range(options.samples)]
+    genes = ['GENE%d' % i for i in range(options.genes)]
+    matrix = synthetic_matrix(options.samples, options.genes, options.missing)
+    columns = sorted(random.sample(range(options.genes), min(options.reads, options.genes)))
+    rows = random.sample(range(options.samples), min(options.reads, options.samples))
+
+    directory = tempfile.mkdtemp()
+    try:
+        for name, compression in [('default', None), ('zlib', 'zlib')]:
+            path = os.path.join(directory, name)
+            timed('%s write' % name, write_store, path, samples, genes, matrix, compression)
+            check_store(path, name, samples, genes, matrix, columns, rows)
+            timed('%s %d columns' % (name, len(columns)), read_columns, path, columns)
+            timed('%s %d rows' % (name, len(rows)), read_rows, path, rows)
+            timed('%s submatrix' % name, read_submatrix, path, columns)
+            print('%-24s %8.1f MB' % ('%s size' % name, store_size(path) / float(1 << 20)))
+    finally:
+        shutil.rmtree(directory)
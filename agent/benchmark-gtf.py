@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+'''
+Compare the GTFMap reader convert-ccle-seg.py used against the gtf module.
+
+Writes a synthetic GTF in the layout convert-ccle-seg.py reads, with the
+biotype in the source column (a gene line, transcripts, exons, CDS and UTRs
+per gene, over a mix of biotypes), checks that both readers find
+the same protein coding gene spans, then times GTFMap.read, gtf.read_records
+and gtf.read_table on the gene lines of that biotype.
+
+example usage:
+
+    python agent/benchmark-gtf.py --genes 20000
+'''
+
+import os
+import sys
+import re
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import gtf
+
+BIOTYPES = ['protein_coding', 'lincRNA', 'antisense', 'processed_pseudogene', 'miRNA']
+
+# the GTF reader convert-ccle-seg.py used, kept as the reference
+
+reAttr = re.compile(r'([^ ]+) \"(.*)\"')
+
+class GTFLine:
+    def __init__(self, seqname, source, feature, start, end, score, strand, frame, attr):
+        self.seqname = seqname
+        self.source = source
+        self.feature = feature
+        self.start = long(start)
+        self.end = long(end)
+        try:
+            self.score = float(score)
+        except ValueError:
+            self.score = None
+        self.strand = strand
+        try:
+            self.frame = int(frame)
+        except ValueError:
+            self.frame = None
+        self.attr = attr
+
+    def get_type(self):
+        return self.feature
+
+def gtfParse(handle, source_filter=None, feature_filter=None):
+    for line in handle:
+        if not line.startswith("#"):
+            row = line.split("\t")
+            attr_str = row[8]
+            attr = {}
+            for s in attr_str.split("; "):
+                res = reAttr.search(s)
+                if res:
+                    attr[res.group(1)] = res.group(2)
+            if source_filter is None or source_filter==row[1]:
+                if feature_filter is None or feature_filter==row[2]:
+                    yield GTFLine(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], attr)
+
+class GTFGene:
+    def __init__(self, gene_id):
+        self.elements = {}
+        self.gene_id = gene_id
+        self.start = None
+        self.end = None
+        self.seqname = None
+
+    def append(self, elem):
+        if self.start is None or elem.start < self.start:
+            self.start = elem.start
+        if self.end is None or elem.end > self.end:
+            self.end = elem.end
+        self.seqname = elem.seqname
+        t = elem.get_type()
+        if t not in self.elements:
+            self.elements[t] = []
+        self.elements[t].append(elem)
+
+class GTFMap:
+    def __init__(self):
+        self.gene_map = {}
+        self.chrom_map = {}
+
+    def read(self, handle, source_filter=None, feature_filter=None):
+        for line in gtfParse(handle, source_filter=source_filter, feature_filter=feature_filter):
+            g = line.attr['gene_name'] #.gene_id()
+
+            if line.seqname not in self.chrom_map:
+                self.chrom_map[line.seqname] = []
+
+            if g not in self.gene_map:
+                gene = GTFGene(g)
+                self.gene_map[g] = gene
+                self.chrom_map[line.seqname].append(gene)
+
+            self.gene_map[g].append(line)
+
+    def __iter__(self):
+        for k in self.gene_map:
+            yield k
+
+    def __getitem__(self, n):
+        return self.gene_map[n]
+
+def attributes(gene, biotype, transcript=None, exon=None):
+    out = 'gene_id "ENSG%011d.1"; gene_type "%s"; gene_status "KNOWN"; gene_name "GENE%d"; level 2; havana_gene "OTTHUMG%011d.1";' % (gene, biotype, gene, gene)
+    if transcript is not None:
+        out += ' transcript_id "ENST%011d.1"; transcript_type "%s"; transcript_name "GENE%d-%03d";' % (transcript, biotype, gene, transcript % 1000)
+    if exon is not None:
+        out += ' exon_number %d; exon_id "ENSE%011d.1";' % (exon, transcript * 100 + exon)
+    return out + ' tag "basic";'
+
+def write_gtf(path, genes, transcripts, exons):
+    with open(path, 'w') as handle:
+        handle.write('##description: synthetic annotation\n')
+        transcript_id = 0
+        for g in range(genes):
+            chromosome = 'chr%d' % (g % 22 + 1)
+            biotype = BIOTYPES[g % len(BIOTYPES)]
+            start = random.randint(1, 200000000)
+            end = start + random.randint(1000, 100000)
+            strand = random.choice('+-')
+            handle.write('\t'.join([chromosome, biotype, 'gene', str(start), str(end), '.', strand, '.', attributes(g, biotype)]) + '\n')
+            for t in range(transcripts):
+                transcript_id += 1
+                handle.write('\t'.join([chromosome, biotype, 'transcript', str(start), str(end), '.', strand, '.', attributes(g, biotype, transcript_id)]) + '\n')
+                step = (end - start) // exons
+                for e in range(exons):
+                    exon_start = start + e * step
+                    exon_end = exon_start + step // 2
+                    for feature in ['exon', 'CDS', 'UTR']:
+                        handle.write('\t'.join([chromosome, biotype, feature, str(exon_start), str(exon_end), '.', strand, '0' if feature == 'CDS' else '.', attributes(g, biotype, transcript_id, e + 1)]) + '\n')
+
+def gtf_map_spans(path, source_filter, feature_filter):
+    g = GTFMap()
+    with open(path) as handle:
+        g.read(handle, source_filter=source_filter, feature_filter=feature_filter)
+    spans = {}
+    for name in g:
+        gene = g[name]
+        spans[name] = (gene.seqname, gene.start, gene.end)
+    return spans
+
+def table_spans(path, source_filter, feature_filter):
+    with open(path) as handle:
+        table = gtf.read_table(handle, source_filter, feature_filter, keys=['gene_name'])
+    names, seqnames, starts, ends = table.spans('gene_name')
+    return dict(zip(names, zip(seqnames, starts, ends)))
+
+def record_count(path, source_filter, feature_filter):
+    count = 0
+    with open(path) as handle:
+        for record in gtf.read_records(handle, source_filter, feature_filter):
+            count += 1
+    return count
+
+def timed(name, function, *args):
+    start = time.time()
+    result = function(*args)
+    elapsed = time.time() - start
+    print('%-16s %8.2fs' % (name, elapsed))
+    return elapsed, result
+
+def parse_args(args):
+    args = args[1:]
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--genes', type=int, default=20000, help='number of genes')
+    parser.add_argument('--transcripts', type=int, default=3, help='transcripts per gene')
+    parser.add_argument('--exons', type=int, default=8, help='exons per transcript')
+    parser.add_argument('--gtf', help='time an existing GTF instead of a synthetic one')
+    parser.add_argument('--source', default='protein_coding')
+    parser.add_argument('--feature', default='gene')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(args)
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv)
+    random.seed(options.seed)
+
+    path = options.gtf
+    if path is None:
+        handle, path = tempfile.mkstemp(suffix='.gtf')
+        os.close(handle)
+        write_gtf(path, options.genes, options.transcripts, options.exons)
+
+    try:
+        old_time, old = timed('GTFMap.read', gtf_map_spans, path, options.source, options.feature)
+        records_time, count = timed('read_records', record_count, path, options.source, options.feature)
+        table_time, new = timed('read_table', table_spans, path, options.source, options.feature)
+    finally:
+        if options.gtf is None:
+            os.remove(path)
+
+    if old != new:
+        raise Exception('gene spans differ: %d GTFMap genes, %d table genes' % (len(old), len(new)))
+    print('%d genes, %d records' % (len(new), count))
+    print('%-16s %.2fx' % ('records speedup', old_time / records_time))
+    print('%-16s %.2fx' % ('table speedup', old_time / table_time))
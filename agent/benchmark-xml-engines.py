@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+'''
+Compare the SAX and lxml iterparse engines of the pubmed and drugbank
+agents.
+
+Parses a Medline file and a DrugBank file with each engine, checks that
+both print byte-identical output, and reports the time of each. Without
+--medline/--drugbank, synthetic files shaped like the real ones are
+generated.
+
+example usage:
+
+    python agent/benchmark-xml-engines.py --medline medline17n0001.xml.gz --drugbank drugbank.xml
+    python agent/benchmark-xml-engines.py --articles 5000 --drugs 1000
+'''
+
+import os
+import sys
+import imp
+import gzip
+import time
+import random
+import logging
+import argparse
+from cStringIO import StringIO
+
+AGENT = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(AGENT)
+sys.path.append(os.path.join(AGENT, 'pubmed'))
+sys.path.append(os.path.join(AGENT, 'drugbank'))
+import pubmed
+import drugbank
+
+WORDS = ['alpha', 'beta', 'kinase', 'inhibitor', 'receptor', 'binding', 'tablet', 'oral', 'liver', 'renal']
+
+def sentence(count):
+    return ' '.join(random.choice(WORDS) for i in range(count))
+
+def polypeptide(i, enzyme=False):
+    out = ('<polypeptide id="P%05d" source="Swiss-Prot"><name>%s</name><general-function>%s</general-function>'
+        '<specific-function>%s</specific-function><gene-name>G%d</gene-name><locus>1p%d</locus>'
+        '<cellular-location>membrane</cellular-location><organism ncbi-taxonomy-id="9606">Human</organism>'
+        '<molecular-weight>%d</molecular-weight>' % (i, sentence(3), sentence(5), sentence(40), i, i % 30, random.randint(1000, 90000)))
+    if enzyme:
+        out += '<amino-acid-sequence format="FASTA">%s</amino-acid-sequence><gene-sequence format="FASTA">%s</gene-sequence>' % ('M' * 300, 'ACGT' * 200)
+    out += '<external-identifiers><external-identifier><resource>UniProtKB</resource><identifier>Q%d</identifier></external-identifier></external-identifiers>' % i
+    out += '<synonyms>%s</synonyms>' % ''.join('<synonym>%s</synonym>' % sentence(2) for k in range(3))
+    out += '<go-classifiers>%s</go-classifiers></polypeptide>' % ''.join(
+        '<go-classifier><category>component</category><description>%s</description></go-classifier>' % sentence(3) for k in range(4))
+    return out
+
+def drug(d):
+    out = ['<drug type="small molecule" created="2005-06-13" updated="2016-08-17">']
+    out.append('<drugbank-id primary="true">DB%05d</drugbank-id><drugbank-id>APRD%05d</drugbank-id>' % (d, d))
+    out.append('<name>drug%d</name><description>%s</description><cas-number>%d-00-0</cas-number><unii>U%d</unii><state>solid</state>' % (d, sentence(200), d, d))
+    out.append('<groups><group>approved</group><group>investigational</group></groups>')
+    out.append('<general-references><articles><article><pubmed-id>1</pubmed-id><citation>%s</citation></article></articles></general-references>' % sentence(10))
+    out.append('<indication>%s</indication><pharmacodynamics>%s</pharmacodynamics><mechanism-of-action>%s</mechanism-of-action>'
+        '<toxicity>%s</toxicity><metabolism>%s</metabolism><absorption>%s</absorption><half-life>%s</half-life>'
+        '<protein-binding>90%%</protein-binding><route-of-elimination>%s</route-of-elimination><clearance>%s</clearance>' % tuple(sentence(60) for k in range(9)))
+    out.append('<classification><description>%s</description><direct-parent>a</direct-parent><kingdom>Organic</kingdom>'
+        '<superclass>b</superclass><class>c</class><subclass>d</subclass></classification>' % sentence(10))
+    out.append('<synonyms>%s</synonyms>' % ''.join('<synonym language="" coder="">%s</synonym>' % sentence(2) for k in range(5)))
+    out.append('<products>%s</products>' % ''.join(
+        '<product><name>P%d</name><labeller>L</labeller><dosage-form>Tablet</dosage-form><strength>10 mg</strength>'
+        '<route>Oral</route><approved>true</approved></product>' % k for k in range(6)))
+    out.append('<mixtures><mixture><name>m</name><ingredients>a + b</ingredients></mixture></mixtures>')
+    out.append('<categories>%s</categories>' % ''.join('<category><category>%s</category><mesh-id>D%d</mesh-id></category>' % (sentence(2), k) for k in range(4)))
+    out.append('<dosages><dosage><form>Tablet</form><route>Oral</route><strength>5 mg</strength></dosage></dosages>')
+    out.append('<drug-interactions>%s</drug-interactions>' % ''.join(
+        '<drug-interaction><drugbank-id>DB%05d</drugbank-id><name>x</name><description>%s</description></drug-interaction>' % (k, sentence(15)) for k in range(20)))
+    out.append('<targets>%s</targets>' % ''.join(
+        '<target position="1"><id>BE%d</id><name>%s</name><organism>Human</organism><actions><action>inhibitor</action></actions>'
+        '<references><articles><article><pubmed-id>%d</pubmed-id><citation>%s</citation></article></articles></references>'
+        '<known-action>yes</known-action>%s</target>' % (k, sentence(2), k, sentence(8), polypeptide(k)) for k in range(3)))
+    out.append('<enzymes>%s</enzymes>' % ''.join(
+        '<enzyme position="1"><id>BE%d</id><name>e</name><organism>Human</organism>%s</enzyme>' % (k, polypeptide(k, True)) for k in range(2)))
+    out.append('</drug>\n')
+    return ''.join(out)
+
+def synthetic_drugbank(drugs):
+    out = StringIO()
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n<drugbank xmlns="http://www.drugbank.ca" version="5.0">\n')
+    for d in range(drugs):
+        out.write(drug(d))
+    out.write('</drugbank>\n')
+    return out.getvalue()
+
+def timed(parse, data):
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    start = time.time()
+    try:
+        parse(StringIO(data))
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    return time.time() - start, output
+
+def compare(label, parse, data):
+    print(label)
+    times = {}
+    outputs = {}
+    for engine in ['sax', 'lxml']:
+        times[engine], outputs[engine] = timed(lambda handle: parse(handle, engine), data)
+        print('%-10s %8.2fs %8d lines' % (engine, times[engine], outputs[engine].count('\n')))
+    if outputs['sax'] != outputs['lxml']:
+        raise Exception('%s engines printed different output' % label)
+    print('%-10s %.2fx\n' % ('speedup', times['sax'] / times['lxml']))
+
+def parse_args(args):
+    args = args[1:]
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--medline', help='Medline file (.xml.gz) to time on')
+    parser.add_argument('--drugbank', help='DrugBank full database xml to time on')
+    parser.add_argument('--articles', type=int, default=5000, help='number of synthetic Medline articles')
+    parser.add_argument('--drugs', type=int, default=1000, help='number of synthetic drugs')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(args)
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv)
+    logging.basicConfig(level=logging.ERROR)
+    random.seed(options.seed)
+
+    if options.medline:
+        with gzip.open(options.medline) as handle:
+            medline = handle.read()
+    else:
+        benchmark_pubmed = imp.load_source('benchmark_pubmed', os.path.join(AGENT, 'pubmed', 'benchmark-pubmed.py'))
+        medline = benchmark_pubmed.synthetic_medline(options.articles)
+    compare('pubmed', lambda handle, engine: pubmed.parse_pubmed(handle, engine=engine), medline)
+
+    if options.drugbank:
+        with open(options.drugbank) as handle:
+            data = handle.read()
+    else:
+        data = synthetic_drugbank(options.drugs)
+    compare('drugbank', drugbank.parse_drugbank, data)
@@ -2,171 +2,19 @@
 
 # curl -o CCLE_copynumber_2013-12-03.seg.txt "https://portals.broadinstitute.org/ccle/downloadFile/DefaultSystemRoot/exp_10/ds_20/CCLE_copynumber_2013-12-03.seg.txt?downloadff=true&fileId=17597"
 
-import re
+import os
 import sys
 import gzip
-import json
+import argparse
+import numpy
+import pandas
 import bmeg.cna_pb2 as cna
-from google.protobuf import json_format
-
-from bx.intervals.intersection import Intersecter, Interval
-
-reAttr = re.compile(r'([^ ]+) \"(.*)\"')
-
-class GTFLine:
-    def __init__(self, seqname, source, feature, start, end, score, strand, frame, attr):
-        self.seqname = seqname
-        self.source = source
-        self.feature = feature
-        self.start = long(start)
-        self.end = long(end)
-        try:
-            self.score = float(score)
-        except ValueError:
-            self.score = None
-        self.strand = strand
-        try:
-            self.frame = int(frame)
-        except ValueError:
-            self.frame = None
-        self.attr = attr
-
-    def __str__(self):
-        return "\t".join( [
-            self.seqname,
-            self.source,
-            self.feature,
-            str(self.start),
-            str(self.end),
-            '.' if self.score is None else str(self.score) ,
-            self.strand,
-            '.' if self.frame is None else str(self.frame),
-            str(self.attr)
-            ])
-
-    def __repr__(self):
-        return "%s:%s:%s-%s" % (self.feature, self.seqname, self.start, self.end)
-
-    def gene_id(self):
-        return self.attr['gene_id']
-
-    def get_type(self):
-        return self.feature
-
-    def __getitem__(self, name):
-        return self.attr[name]
-
-
-
-def gtfParse(handle, source_filter=None, feature_filter=None):
-    for line in handle:
-        if not line.startswith("#"):
-            row = line.split("\t")
-            attr_str = row[8]
-            attr = {}
-            for s in attr_str.split("; "):
-                res = reAttr.search(s)
-                if res:
-                    attr[res.group(1)] = res.group(2)
-            if source_filter is None or source_filter==row[1]:
-                if feature_filter is None or feature_filter==row[2]:
-                    yield GTFLine(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], attr)
-
-class GTFGene:
-    def __init__(self, gene_id):
-        self.elements = {}
-        self.gene_id = gene_id
-        self.start = None
-        self.end = None
-        self.seqname = None
-
-    def append(self, elem):
-        if self.start is None or elem.start < self.start:
-            self.start = elem.start
-        if self.end is None or elem.end > self.end:
-            self.end = elem.end
-        self.seqname = elem.seqname
-        t = elem.get_type()
-        if t not in self.elements:
-            self.elements[t] = []
-        self.elements[t].append(elem)
-
-    def gene_total_length(self):
-        if 'start_codon' in self.elements and 'stop_codon' in self.elements:
-            end = self.elements['stop_codon'][0].end
-            start = self.elements['start_codon'][0].start
-            return max(start,end) - min(start,end)
-
-    def exon_total_length(self):
-        total = 0
-        if 'exon' in self.elements:
-            for ex in self.elements['exon']:
-                total += ex.end - ex.start
-        return total
-
-
-
-class GTFMap:
-    def __init__(self):
-        self.gene_map = {}
-        self.chrom_map = {}
-
-    def read(self, handle, source_filter=None, feature_filter=None):
-        for line in gtfParse(handle, source_filter=source_filter, feature_filter=feature_filter):
-            g = line.attr['gene_name'] #.gene_id()
-
-            if line.seqname not in self.chrom_map:
-                self.chrom_map[line.seqname] = []
-
-            if g not in self.gene_map:
-                gene = GTFGene(g)
-                self.gene_map[g] = gene
-                self.chrom_map[line.seqname].append(gene)
-
-            self.gene_map[g].append(line)
-
-    def __iter__(self):
-        for k in self.gene_map:
-            yield k
-
-    def __getitem__(self, n):
-        return self.gene_map[n]
-
-    def keys(self):
-        return self.gene_map.keys()
-
-    def has_item(self, gene, item):
-        if gene not in self.gene_map:
-            return False
-        if item not in self.gene_map[gene]:
-            return False
-        return True
-
-    def has_chrom(self, chrome):
-        return chrome in self.chrom_map
-
-    def get_chrom(self, chrome):
-        return self.chrom_map[chrome]
-
-    def get_item_len(self, gene, item):
-        total = 0
-        for i in self.gene_map[gene][item]:
-            total += i.end - i.start
-        return total
-
-    def get_item_span(self, gene, item):
-        start = None
-        end = None
-        for i in self.gene_map[gene][item]:
-            if start is None:
-                start = i.start
-            else:
-                start = min(start, i.start)
-            if end is None:
-                end = i.end
-            else:
-                end = max(end, i.end)
-        return start, end
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import gtf
+import emitter
+import gene_intervals
+import expression_store
 
 SEG_SAMPLE   = 0
 SEG_SEQ      = 1
@@ -181,64 +29,185 @@ def gid_biosample(sample):
 def gid_cnacallset_set(sample):
     return "cnaCallSet:biosample:CCLE:" + sample
 
-def parse(seg_file, gtf_file, out_base):
+SEG_CHUNK = 100000
+
+def gtf_genes(gtf_file, source_filter="protein_coding", feature_filter="gene"):
     with gzip.GzipFile(gtf_file) as handle:
-        g = GTFMap()
-        g.read(handle, source_filter="protein_coding", feature_filter="gene")
-
-    out_handles = {}
-    def emit_json(message):
-        if message.DESCRIPTOR.full_name not in out_handles:
-            out_handles[message.DESCRIPTOR.full_name] = open("ccle." + message.DESCRIPTOR.full_name + ".json", "w")
-        msg = json.loads(json_format.MessageToJson(message))
-        out_handles[message.DESCRIPTOR.full_name].write(json.dumps(msg))
-        out_handles[message.DESCRIPTOR.full_name].write("\n")
-
-    i_map = {}
-    for gene_name in g:
-        gene = g[gene_name]
-        #if args.fix_chrome and gene.seqname.startswith("chr"):
-        #    seqname = gene.seqname[3:]
-        #else:
-        seqname = gene.seqname
-        if seqname not in i_map:
-            i_map[seqname] = Intersecter()
-        i_map[seqname].add_interval( Interval(gene.start, gene.end, value=gene) )
+        table = gtf.read_table(handle, source_filter=source_filter, feature_filter=feature_filter, keys=['gene_name'])
+    names, chromosomes, starts, ends = table.spans('gene_name')
+    return names, chromosomes, starts, ends
+
+def read_segments(seg_file, chunk_size=SEG_CHUNK):
+    """
+    Yield the seg file in chunks of (samples, chromosomes, starts, stops,
+    values) arrays.
+    """
+    reader = pandas.read_csv(seg_file, sep="\t", header=None, skiprows=1, chunksize=chunk_size,
+        usecols=[SEG_SAMPLE, SEG_SEQ, SEG_START, SEG_STOP, SEG_VALUE],
+        dtype={SEG_SAMPLE: str, SEG_SEQ: str, SEG_START: numpy.float64, SEG_STOP: numpy.float64, SEG_VALUE: numpy.float64},
+        keep_default_na=False, float_precision='round_trip')
+    for chunk in reader:
+        yield (
+            chunk[SEG_SAMPLE].values,
+            chunk[SEG_SEQ].values,
+            chunk[SEG_START].values.astype(numpy.int64),
+            chunk[SEG_STOP].values.astype(numpy.int64),
+            chunk[SEG_VALUE].values)
+
+def segment_genes(index, chromosomes, starts, stops):
+    """
+    The overlapping gene names of every segment in a chunk, looked up one
+    chromosome at a time with the interval index.
+    """
+    genes = [[] for i in range(len(chromosomes))]
+    for chromosome in numpy.unique(chromosomes):
+        rows = numpy.flatnonzero(chromosomes == chromosome)
+        segments, hits = index.overlaps(chromosome, starts[rows], stops[rows] + 1)
+        for segment, hit in zip(rows[segments].tolist(), hits.tolist()):
+            genes[segment].append('gene:' + index.names[hit])
+    return genes
+
+def running_integral(starts, ends, weights):
+    """
+    Sweep over the start/end events of half open [start, end) intervals and
+    return the event positions with the integral of the summed weights of
+    the covering intervals up to each position, and the summed weight just
+    after it.
+    """
+    positions = numpy.concatenate([starts, ends])
+    deltas = numpy.concatenate([weights, -weights])
+    order = numpy.argsort(positions, kind='mergesort')
+    positions = positions[order]
+    slopes = numpy.cumsum(deltas[order])
+    areas = numpy.zeros(len(positions), dtype=slopes.dtype)
+    areas[1:] = numpy.cumsum(slopes[:-1] * numpy.diff(positions))
+    return positions, areas, slopes
+
+def integral_at(points, positions, areas, slopes):
+    """
+    Evaluate a running integral from running_integral at sorted or unsorted
+    points.
+    """
+    k = numpy.searchsorted(positions, points, side='right') - 1
+    before = k < 0
+    k[before] = 0
+    out = areas[k] + slopes[k] * (points - positions[k])
+    out[before] = 0
+    return out
+
+def gene_copy_number(index, chromosome, starts, stops, values, row):
+    """
+    Fill the slice of row for the genes on one chromosome with the length
+    weighted mean value of one sample's segments on it, NaN for genes no
+    segment touches. Segments [start, stop] are inclusive and genes are
+    overlapped the same way as in segment_genes.
+    """
+    offset, count = index.chromosome(chromosome)
+    if count == 0:
+        return
+    gene_starts = numpy.asarray(index.starts[offset:offset + count])
+    gene_ends = numpy.asarray(index.ends[offset:offset + count])
+
+    ends = stops + 1
+    positions, covered, depth = running_integral(starts, ends, numpy.ones(len(starts), dtype=numpy.int64))
+    weighted = running_integral(starts, ends, values)
+
+    lengths = integral_at(gene_ends, positions, covered, depth) - integral_at(gene_starts, positions, covered, depth)
+    sums = integral_at(gene_ends, *weighted) - integral_at(gene_starts, *weighted)
+    hit = lengths > 0
+    means = numpy.full(count, numpy.nan)
+    means[hit] = sums[hit] / lengths[hit]
+    row[offset:offset + count] = means
+
+class GeneMatrix(object):
+    """
+    Collects the segments of one sample at a time, across seg file chunks,
+    and writes its gene level copy number row to an expression store when
+    the next sample starts. The seg file has to be grouped by sample, as
+    the CCLE file is.
+    """
+
+    def __init__(self, path, index):
+        self.index = index
+        self.writer = expression_store.StoreWriter(path, index.names)
+        self.sample = None
+        self.parts = []
+        self.done = set()
+
+    def add(self, samples, chromosomes, starts, stops, values):
+        breaks = numpy.flatnonzero(samples[1:] != samples[:-1]) + 1
+        bounds = [0] + breaks.tolist() + [len(samples)]
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            if lo == hi:
+                continue
+            if samples[lo] != self.sample:
+                self.flush()
+                if samples[lo] in self.done:
+                    raise ValueError("seg file is not grouped by sample, %s appears again" % samples[lo])
+                self.sample = samples[lo]
+            self.parts.append((chromosomes[lo:hi], starts[lo:hi], stops[lo:hi], values[lo:hi]))
+
+    def flush(self):
+        if self.sample is None:
+            return
+        chromosomes, starts, stops, values = [numpy.concatenate(p) for p in zip(*self.parts)]
+        row = numpy.full(len(self.index), numpy.nan)
+        for chromosome in numpy.unique(chromosomes):
+            rows = chromosomes == chromosome
+            gene_copy_number(self.index, chromosome, starts[rows], stops[rows], values[rows], row)
+        self.writer.add(gid_biosample(self.sample), row)
+        self.done.add(self.sample)
+        self.sample = None
+        self.parts = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def parse(seg_file, gtf_file, out_base, cache_dir=gene_intervals.CACHE_DIR, matrix=None):
+    index = gene_intervals.load_or_build(gtf_file, lambda: gtf_genes(gtf_file), key='protein_coding:gene', cache_dir=cache_dir)
+
+    emit_json = emitter.JSONEmitter(multi="ccle")
+    gene_matrix = None
+    if matrix is not None:
+        gene_matrix = GeneMatrix(matrix, index)
 
     callset_set = set()
-    with open(seg_file) as handle:
-        handle.readline()
-        for line in handle:
+    for samples, chromosomes, starts, stops, values in read_segments(seg_file):
+        genes = segment_genes(index, chromosomes, starts, stops)
+        if gene_matrix is not None:
+            gene_matrix.add(samples, chromosomes, starts, stops, values)
+        for i in range(len(samples)):
             segment = cna.CNASegment()
-            row = line.split("\t")
-            cnacallset_id = gid_cnacallset_set(row[SEG_SAMPLE])
+            cnacallset_id = gid_cnacallset_set(samples[i])
             if cnacallset_id not in callset_set:
                 callset = cna.CNACallSet()
                 callset.id = cnacallset_id
-                callset.bio_sample_id = gid_biosample(row[SEG_SAMPLE])
+                callset.bio_sample_id = gid_biosample(samples[i])
                 emit_json(callset)
                 callset_set.add(cnacallset_id)
 
-            chrom = row[SEG_SEQ]
-            start = long(float(row[SEG_START]))
-            stop = long(float(row[SEG_STOP]))
-            segment.reference_name = chrom
-            segment.start = start
-            segment.end = stop
-            segment.value = float(row[SEG_VALUE])
+            segment.reference_name = chromosomes[i]
+            segment.start = long(starts[i])
+            segment.end = long(stops[i])
+            segment.value = float(values[i])
             segment.call_set_id = cnacallset_id
-            if chrom in i_map:
-                for hit in i_map[chrom].find(start, stop+1):
-                    segment.genes.append('gene:' + hit.value.gene_id)
+            segment.genes.extend(genes[i])
             emit_json(segment)
-
-def message_to_json(message):
-    msg = json_format.MessageToDict(message)
-    msg['#label'] = message.DESCRIPTOR.name
-    return json.dumps(msg)
+    emit_json.close()
+    if gene_matrix is not None:
+        gene_matrix.close()
+
+def parse_args(args):
+    args = args[1:]
+    parser = argparse.ArgumentParser(description="Convert a CCLE seg file to CNASegment records")
+    parser.add_argument('seg_file', help='CCLE seg file')
+    parser.add_argument('gtf_file', help='gzipped GTF with the protein coding genes')
+    parser.add_argument('out_base', help='output prefix')
+    parser.add_argument('--matrix', type=str, help='Directory to also write a sample x gene copy number matrix to as a columnar expression store, each gene the length weighted mean of the segments over it')
+    parser.add_argument('--cache-dir', type=str, default=gene_intervals.CACHE_DIR, help='Directory for the gene interval index')
+    return parser.parse_args(args)
 
 if __name__ == "__main__":
-    seg_file = sys.argv[1]
-    gtf_file = sys.argv[2]
-    out_base = sys.argv[3]
-    parse(seg_file, gtf_file, out_base)
+    options = parse_args(sys.argv)
+    parse(options.seg_file, options.gtf_file, options.out_base, options.cache_dir, options.matrix)
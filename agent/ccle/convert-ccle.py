@@ -28,11 +28,16 @@ curl -o CCLE_Expression_2012-09-29.res "https://portals.broadinstitute.org/ccle/
 
 from ga4gh import bio_metadata_pb2, variants_pb2, allele_annotations_pb2, metadata_pb2
 from bmeg import phenotype_pb2, genome_pb2, matrix_pb2
-from google.protobuf import json_format
-import json, sys, argparse, os
+import sys, argparse, os
 import csv #for drug data
 import string
 import re
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import emitter
+import expression_store
+import res_matrix
 
 ########################################
 
@@ -111,42 +116,26 @@ def convert_ccle_pharma_profiles(emit, csvpath):
         for d in drugs.values():
             emit(d)
 
-def convert_expression(emit, expressionpath):
-    with open(expressionpath) as handle:
-        reader = csv.reader(handle, delimiter="\t")
-        header = reader.next()
-        reader.next()
-        reader.next()
-        
-        values = {}
-        for i in header[2:]:
-            if len(header):
-                values[i] = []
+def convert_expression(emit, expressionpath, store=None):
+    samples, genes, values = res_matrix.read_res(expressionpath, 2)
+    genes, means = res_matrix.collapse_genes(genes, values)
 
-        gene_order = []
-        for line in reader:
-            if len(line[0]):
-                for a in zip(header, line)[2:]:
-                    if len(a[0]):
-                        values[a[0]].append(float(a[1]))
-                gene_order.append(line[0])
-
-        for k, v in values.items():
-            if len(k):
-                ge = matrix_pb2.GeneExpression()
-                ge.gid = gid_expression(k)
-                ge.biosample_id = gid_biosample(k)
-                vals = {}
-                counts = {}
-                for g, val in zip(gene_order, v):
-                    if g not in vals:
-                        vals[g] = []
-                        counts[g] = 0.0
-                    vals[g].append(val)
-                    counts[g] += 1.0
-                for g in vals:
-                    ge.expressions[g] = sum(vals[g]) / counts[g]
-                emit(ge)
+    writer = None
+    if store is not None:
+        writer = expression_store.StoreWriter(store, genes)
+
+    # one contiguous row of gene means per sample
+    for sample, row in zip(samples, numpy.ascontiguousarray(means.T)):
+        ge = matrix_pb2.GeneExpression()
+        ge.gid = gid_expression(sample)
+        ge.biosample_id = gid_biosample(sample)
+        ge.expressions.update(zip(genes, row.tolist()))
+        emit(ge)
+        if writer is not None:
+            writer.add(ge.biosample_id, row)
+
+    if writer is not None:
+        writer.close()
 
 def proto_list_append(message, a):
     v = message.values.add()
@@ -179,40 +168,20 @@ def convert_sample(emit, samplepath):
 
 ########################################
 
-def message_to_json(message):
-    msg = json.loads(json_format.MessageToJson(message))
-    msg['#label'] = message.DESCRIPTOR.name
-    return json.dumps(msg)
-
-def convert_to_protobuf(drugpath, samplepath, expressionpath, out, multi, format):
-    out_handles = {}
-    def emit_json_single(message):
-        if 'main' not in out_handles:
-            out_handles['main'] = open(out, "w")
-        msg = json.loads(json_format.MessageToJson(message))
-        msg["#label"] = message.DESCRIPTOR.full_name
-        out_handles['main'].write(json.dumps(msg))
-        out_handles['main'].write("\n")
-    def emit_json_multi(message):
-        if message.DESCRIPTOR.full_name not in out_handles:
-            out_handles[message.DESCRIPTOR.full_name] = open(multi + "." + message.DESCRIPTOR.full_name + ".json", "w")
-        msg = json.loads(json_format.MessageToJson(message))
-        out_handles[message.DESCRIPTOR.full_name].write(json.dumps(msg))
-        out_handles[message.DESCRIPTOR.full_name].write("\n")
-    if out is not None:
-        emit = emit_json_single
+def convert_to_protobuf(drugpath, samplepath, expressionpath, out, multi, format, store=None):
     if multi is not None:
-        emit = emit_json_multi
+        emit = emitter.JSONEmitter(multi=multi)
+    else:
+        emit = emitter.JSONEmitter(out=out, label_field="#label")
          
     if drugpath:
         convert_ccle_pharma_profiles(emit, drugpath)
     if samplepath:
         convert_sample(emit, samplepath)
     if expressionpath:
-        convert_expression(emit, expressionpath)
+        convert_expression(emit, expressionpath, store)
         
-    for handle in out_handles.values():
-        handle.close()
+    emit.close()
 
 def parse_args(args):
     # We don't need the first argument, which is the program name
@@ -229,8 +198,9 @@ def parse_args(args):
     parser.add_argument('--out', type=str, help='Path to output file (.json or .pbf_ext)')
     parser.add_argument('--multi', type=str, help='Path to output file (.json or .pbf_ext)')
     parser.add_argument('--format', type=str, default='json', help='Format of output: json or pbf (binary)')
+    parser.add_argument('--store', type=str, help='Directory to also write the expression data to as a columnar expression store')
     return parser.parse_args(args)
 
 if __name__ == '__main__':
     options = parse_args(sys.argv)
-    convert_to_protobuf(options.drug, options.sample, options.expression, options.out, options.multi, options.format)
+    convert_to_protobuf(options.drug, options.sample, options.expression, options.out, options.multi, options.format, options.store)
@@ -15,13 +15,16 @@ The four files of interest (for this converter) are:
 '''
 
 from bmeg import phenotype_pb2
-from google.protobuf import json_format
-import json, sys, argparse, os
+import sys, argparse, os
 import csv #for drug data
 import string
 import re
+import numpy
 import pandas
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import emitter
+
 def parse_args(args):
     # We don't need the first argument, which is the program name
     args = args[1:]
@@ -83,7 +86,35 @@ def process_drugs(emit, input): #row is a namedtuple
             emit(compound)
             compounds.add(compound_name)
 
+class DoseIndex(object):
+    """
+    The per experiment dose data sorted once by (master_cpd_id,
+    experiment_id), with the offsets of each group, so the points of a
+    curve are a slice rather than two filters over the whole table. Points
+    keep their order within a group.
+    """
+
+    def __init__(self, data):
+        data = data.sort_values(['master_cpd_id', 'experiment_id'], kind='mergesort')
+        self.doses = data['cpd_conc_umol'].values
+        self.responses = data['cpd_expt_avg_log2'].values
+
+        compounds = data['master_cpd_id'].values
+        experiments = data['experiment_id'].values
+        change = (compounds[1:] != compounds[:-1]) | (experiments[1:] != experiments[:-1])
+        starts = numpy.flatnonzero(numpy.concatenate([[len(data) > 0], change]))
+        ends = numpy.append(starts[1:], len(data))
+
+        self.offsets = {}
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            self.offsets[(compounds[start], experiments[start])] = (start, end)
+
+    def points(self, compound, experiment):
+        start, end = self.offsets.get((compound, experiment), (0, 0))
+        return zip(self.doses[start:end].tolist(), self.responses[start:end].tolist())
+
 def process_response(emit, input, data):
+    doses = DoseIndex(data)
     gid_set = set()
     for row in input.itertuples():
         if isinstance(row.ccle_primary_site, str):
@@ -110,10 +141,10 @@ def process_response(emit, input, data):
                 s.value = row.area_under_curve
                 s.unit = "uM"
 
-                for m in data.loc[lambda x: x.master_cpd_id==row.master_cpd_id, : ].loc[lambda x: x.experiment_id==row.experiment_id].itertuples():
+                for dose, value in doses.points(row.master_cpd_id, row.experiment_id):
                     dr = response.values.add()
-                    dr.dose = m.cpd_conc_umol
-                    dr.response = m.cpd_expt_avg_log2
+                    dr.dose = dose
+                    dr.response = value
             
                 emit(response)
                 gid_set.add(gid)
@@ -135,40 +166,17 @@ def convert_all_ctdd(responsePath, metadrugPath, metacelllinePath, metaexperimen
     ctdd_data = pandas.read_table(dataPath)
     #print ctdd_merged
     
-    out_handles = {}
-    def emit_json_single(message):
-        if 'main' not in out_handles:
-            out_handles['main'] = open(out, "w")
-        msg = json.loads(json_format.MessageToJson(message))
-        msg["#label"] = message.DESCRIPTOR.full_name
-        out_handles['main'].write(json.dumps(msg))
-        out_handles['main'].write("\n")
-
-    def emit_json_multi(message):
-        if message.DESCRIPTOR.full_name not in out_handles:
-            out_handles[message.DESCRIPTOR.full_name] = open(multi + "." + message.DESCRIPTOR.full_name + ".json", "w")
-        msg = json.loads(json_format.MessageToJson(message))
-        out_handles[message.DESCRIPTOR.full_name].write(json.dumps(msg))
-        out_handles[message.DESCRIPTOR.full_name].write("\n")
-
-    if out is not None:
-        emit = emit_json_single
     if multi is not None:
-        emit = emit_json_multi
-    
-    ctdd_merged.to_csv("test.out", sep="\t")    
+        emit = emitter.JSONEmitter(multi=multi)
+    else:
+        emit = emitter.JSONEmitter(out=out, label_field="#label")
     
     process_drugs(emit, ctdd_merged)
     process_response(emit, ctdd_merged, ctdd_data)
+    emit.close()
     
 ########################################
 
-def message_to_json(message):
-    msg = json.loads(json_format.MessageToJson(message))
-    msg['#label'] = message.DESCRIPTOR.name
-    return json.dumps(msg)
-
-
 def convert_to_profobuf(responsePath, metadrugPath, metacelllinePath, metaexperimentPath, dataPath, out, multi):
     if responsePath and metadrugPath and metacelllinePath and metaexperimentPath and (out or multi) and format:
         convert_all_ctdd(responsePath, metadrugPath, metacelllinePath, metaexperimentPath, dataPath, out, multi)
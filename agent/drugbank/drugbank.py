@@ -1,16 +1,52 @@
 #!/usr/bin/env python
 
-__all__ = ['DrugBankReader']
+"""
+Convert the DrugBank full database XML to Compound records and edges from
+each compound to the genes of its targets and enzymes.
 
+With --multi the records go to one JSON lines file per type:
+
+    PREFIX.bmeg.Compound.json   phenotype_pb2.Compound, gid compound:NAME,
+                                target set to the first target gene
+    PREFIX.targetsGene.json     {label, from, to, ...} compound -> gene:SYMBOL
+                                for every target polypeptide gene
+    PREFIX.enzymeGene.json      the same for enzymes
+
+Parsing runs in this process and hands batches of parsed drugs through a
+bounded queue to a writer process that builds the records and serializes
+them, so the two overlap and at most --queue-size batches are held in
+memory. Without --multi the parsed drugs are printed as nested JSON.
+
+example usage:
+
+    drugbank.py --multi drugbank drugbank.xml
+"""
+
+__all__ = ['parse_drugbank', 'convert_drugbank', 'drug_records']
+
+import os
 import sys
 import re
+import argparse
 import xml.sax
 import json
 import logging
+import multiprocessing
+from Queue import Full
+
+from bmeg import phenotype_pb2
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import emitter
+import sax_rules
 
 reWord = re.compile(r'\w')
 reSpace = re.compile(r'\s')
 
+# drugs per batch handed to the writer process, and batches the queue holds
+BATCH_SIZE = 100
+QUEUE_SIZE = 16
+
 
 def ignore(e, v,**kwds):
     return None
@@ -29,10 +65,12 @@ def create_dict_list(e, v, **kwds):
 
 def debug_emit(e, v, **kwds):
     print json.dumps(kwds)
-    
+
+def emit_drug(e, v, **kwds):
+    e(kwds)
 
 f_map = [
-    (['drugbank','drug'], None, debug_emit),    
+    (['drugbank','drug'], None, emit_drug),
 
     (['drugbank','drug','drugbank-id'], None, create_list),
     
@@ -60,7 +98,7 @@ f_map = [
     (['drugbank','drug','targets','target','polypeptide','synonyms'], None, pass_data),
     
     (['drugbank','drug','targets','target','polypeptide',
-        ['name','general-function','specific-function','gene-name','locus','cellular-location','molecular-weight','organism']], None, pass_data),
+        ['name','general-function','specific-function','gene-name','locus','cellular-location','molecular-weight','organism']], None, string_pass),
     
     (['drugbank','drug','targets','target','polypeptide'], None, pass_data),
 
@@ -77,11 +115,16 @@ f_map = [
         ['name','general-function','specific-function','gene-name','organism','molecular-weight','amino-acid-sequence','gene-sequence']], None, string_pass ),
     
     (['drugbank','drug','enzymes','enzyme','polypeptide'], None, pass_data ),
+    (['drugbank','drug','enzymes','enzyme',['id','name','organism','known-action']], None, string_pass ),
+    (['drugbank','drug','enzymes','enzyme','actions','action'], None, create_list ),
+    (['drugbank','drug','enzymes','enzyme','actions'], None, pass_data ),
     (['drugbank','drug','enzymes','enzyme'], 'enzymes', create_dict_list ),
     (['drugbank','drug','enzymes'], None, pass_data ),
 
     (['drugbank','drug','targets','target',
-        ['id','name','organism','known-action']], None, pass_data),
+        ['id','name','organism','known-action']], None, string_pass),
+    (['drugbank','drug','targets','target','actions','action'], None, create_list),
+    (['drugbank','drug','targets','target','actions'], None, pass_data),
 
     (['drugbank','drug','targets','target'], 'targets', create_dict_list),
     (['drugbank','drug','targets'], None, pass_data),
@@ -107,29 +150,22 @@ f_map = [
     (['drugbank','drug','dosages','dosage'], 'dosages', create_dict_list),
     (['drugbank','drug','dosages'], None, pass_data),
 
+    (['drugbank','drug','calculated-properties','property','*'], None, string_pass),
+    (['drugbank','drug','calculated-properties','property'], 'calculated-properties', create_dict_list),
+    (['drugbank','drug','calculated-properties'], None, pass_data),
+
 
 ]
 
+RULES = sax_rules.RuleTable(f_map, text_combiners=[string_pass, create_list])
+
 class StackLevel:
-    def __init__(self, name):
+    def __init__(self, name, state):
         self.data = {}
         self.name = name
         self.has_children = False
-
-def stack_match(query, elem):
-    match = True
-    if len(query) != len(elem):
-        return False
-    for q, e in zip(query, elem):
-        if isinstance(q, list):
-            if e not in q:
-                return False
-        else:
-            if q != "*" and q != e:
-                return False
-    return True
-
-NOT_FOUND = set()
+        self.state = state
+        self.text = [] if state.text else None
 
 class DrugBankHandler(xml.sax.ContentHandler):
     def __init__(self, record_write):
@@ -140,68 +176,218 @@ class DrugBankHandler(xml.sax.ContentHandler):
     def startElement(self, name, attrs):
         if len(self.stack):
             self.stack[-1].has_children = True
-        self.stack.append(StackLevel(name))
-        self.buffer = ""
+            state = self.stack[-1].state.child(name)
+        else:
+            state = RULES.root.child(name)
+        self.stack.append(StackLevel(name, state))
 
     def characters(self, text):
-        self.buffer += text
+        chunks = self.stack[-1].text
+        if chunks is not None:
+            chunks.append(text)
 
     def endElement(self, name):
-        found = False
-        stack_id = list(i.name for i in self.stack)
-        #print stack_id
         level = self.stack.pop()
-        for s, out_name, f in f_map:
-            if stack_match(s, stack_id):
-                found = True
-                if out_name is None:
-                    out_name = stack_id[-1]
-                v = f(self.record_write, self.buffer, **level.data)
-                if v is not None:
-                    if isinstance(v,list):
-                        if out_name in self.stack[-1].data:
-                            self.stack[-1].data[out_name].extend(v)
-                        else:
-                            self.stack[-1].data[out_name] = v
-                    elif isinstance(v,dict):
-                        if out_name in self.stack[-1].data:
-                            self.stack[-1].data[out_name] = dict(self.stack[-1].data, **v)
-                        else:
-                            self.stack[-1].data[out_name] = v
+        state = level.state
+        text = "" if level.text is None else "".join(level.text)
+        for out_name, f in state.combiners:
+            v = f(self.record_write, text, **level.data)
+            if v is not None:
+                if isinstance(v,list):
+                    if out_name in self.stack[-1].data:
+                        self.stack[-1].data[out_name].extend(v)
+                    else:
+                        self.stack[-1].data[out_name] = v
+                elif isinstance(v,dict):
+                    if out_name in self.stack[-1].data:
+                        self.stack[-1].data[out_name] = dict(self.stack[-1].data, **v)
                     else:
                         self.stack[-1].data[out_name] = v
-        if not found:
-            n = ",".join(stack_id)
-            if n not in NOT_FOUND:
-                NOT_FOUND.add(n)
-                logging.warning("combiner for %s not found" % (",".join(stack_id)))
-        self.buffer = ""
+                else:
+                    self.stack[-1].data[out_name] = v
+        if not state.combiners:
+            if level.text is not None:
+                # text of inline markup belongs to the enclosing element
+                self.stack[-1].text.append(text)
+            if not state.reported:
+                state.reported = True
+                logging.warning("combiner for %s not found" % (",".join(state.path())))
         
 
 
-def run_sax_parse(handle, queue):
+def gid_compound(name):
+    return "compound:" + name
+
+def gid_gene(symbol):
+    return "gene:" + symbol
+
+def nested_list(data, field, key):
+    # pass_data keeps the list a wrapper element collects under its own
+    # name, so <groups><group> arrives as {'groups': {'group': [...]}}
+    return data.get(field, {}).get(key, [])
+
+def calculated_property(drug, kind):
+    for prop in nested_list(drug, 'calculated-properties', 'calculated-properties'):
+        if prop.get('kind') == kind:
+            return prop.get('value')
+    return None
+
+def gene_edges(drug, label, field, gid):
+    '''
+    One edge per target or enzyme polypeptide with a gene name, carrying the
+    actions and known-action of the target.
+    '''
+    out = []
+    for target in nested_list(drug, field, field):
+        polypeptide = target.get('polypeptide', {})
+        gene = polypeptide.get('gene-name')
+        if not gene:
+            continue
+        edge = {
+            "label": label,
+            "from": gid,
+            "to": gid_gene(gene),
+            "organism": polypeptide.get('organism', target.get('organism', "")),
+            "actions": nested_list(target, 'actions', 'action'),
+        }
+        if 'known-action' in target:
+            edge["knownAction"] = target['known-action']
+        if 'id' in target:
+            edge["drugbankId"] = target['id']
+        out.append(edge)
+    return out
+
+def drug_records(drug):
+    '''
+    The Compound message of a parsed drug and its targetsGene and enzymeGene
+    edges. target holds the gene of the first target, the single edge the
+    Compound schema has; every target gets an edge of its own.
+    '''
+    compound = phenotype_pb2.Compound()
+    gid = gid_compound(drug['name'])
+    compound.id = gid
+    compound.gid = gid
+    compound.name = drug['name']
+    compound.status = ",".join(nested_list(drug, 'groups', 'group'))
+    smiles = calculated_property(drug, 'SMILES')
+    if smiles:
+        compound.smiles = smiles
+    if drug.get('mechanism-of-action'):
+        compound.report = drug['mechanism-of-action']
+    for synonym in nested_list(drug, 'synonyms', 'synonym'):
+        compound.synonyms.append(gid_compound(synonym))
+
+    targets = gene_edges(drug, "targetsGene", 'targets', gid)
+    enzymes = gene_edges(drug, "enzymeGene", 'enzymes', gid)
+    if targets:
+        compound.target = targets[0]["to"]
+    return compound, targets + enzymes
+
+def write_records(queue, prefix):
+    '''
+    Consumer: turn batches of parsed drugs into Compound and edge lines,
+    one file per type, until a None batch.
+    '''
+    emit = emitter.JSONEmitter(multi=prefix)
+    try:
+        while True:
+            batch = queue.get()
+            if batch is None:
+                break
+            for drug in batch:
+                if not drug.get('name'):
+                    logging.warning("drug without a name: %s" % (drug.get('drugbank-id')))
+                    continue
+                compound, edges = drug_records(drug)
+                emit(compound)
+                for edge in edges:
+                    emit.emit_dict(edge["label"], edge)
+    finally:
+        emit.close()
+
+def put_batch(queue, batch, consumer):
+    # a consumer that died would leave a full queue blocking the parser
+    while True:
+        try:
+            queue.put(batch, timeout=1)
+            return
+        except Full:
+            if not consumer.is_alive():
+                raise Exception("record writer exited with code %s" % (consumer.exitcode))
+
+def run_sax_parse(handle, queue, consumer, batch_size=BATCH_SIZE, engine='sax'):
+    '''
+    Producer: parse drugs and hand them to the consumer in batches.
+    '''
+    batch = []
     def record_write(record):
-        queue.send(record)
-        
-    handler = DrugBankHandler(record_write)
-    parser = xml.sax.make_parser()
-    parser.setContentHandler(handler)
-    parser.parse(handle)
-    queue.close()
+        batch.append(record)
+        if len(batch) >= batch_size:
+            put_batch(queue, list(batch), consumer)
+            del batch[:]
+
+    if engine == 'lxml':
+        sax_rules.iterparse(handle, RULES, record_write, attrs=False)
+    else:
+        handler = DrugBankHandler(record_write)
+        parser = xml.sax.make_parser()
+        parser.setContentHandler(handler)
+        parser.parse(handle)
+    if batch:
+        put_batch(queue, batch, consumer)
+    put_batch(queue, None, consumer)
+
+def convert_drugbank(handle, prefix, engine='sax', queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE):
+    '''
+    Parse in this process while a writer process serializes the records.
+    At most queue_size batches wait between the two.
+    '''
+    queue = multiprocessing.Queue(maxsize=queue_size)
+    consumer = multiprocessing.Process(target=write_records, args=(queue, prefix))
+    consumer.start()
+    try:
+        run_sax_parse(handle, queue, consumer, batch_size, engine)
+    except:
+        # batches left in the queue must not hold up the exit
+        queue.cancel_join_thread()
+        consumer.terminate()
+        raise
+    finally:
+        consumer.join()
+    if consumer.exitcode != 0:
+        raise Exception("record writer exited with code %s" % (consumer.exitcode))
 
 def emit(msg):
-    print msg
+    print json.dumps(msg)
 
-def parse_drugbank(handle):   
+ENGINES = ['sax', 'lxml']
+
+def parse_drugbank(handle, engine='sax'):
+    if engine == 'lxml':
+        sax_rules.iterparse(handle, RULES, emit, attrs=False)
+        return
     handler = DrugBankHandler(emit)
     parser = xml.sax.make_parser()
     parser.setContentHandler(handler)
     parser.parse(handle)
 
+def parse_args(args):
+    args = args[1:]
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path")
+    parser.add_argument("--engine", choices=ENGINES, default="sax", help="Parse with the SAX handler or with lxml iterparse, one drug at a time")
+    parser.add_argument("--multi", help="Write Compound and edge JSON lines to files with this prefix, instead of the parsed drugs to stdout")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE, help="Batches held between the parser and the writer")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Drugs per batch")
+    return parser.parse_args(args)
+
 if __name__ =="__main__":
     logging.basicConfig(level=logging.INFO)
-    path = sys.argv[1]
-    handle = open(path)
+    options = parse_args(sys.argv)
 
-    parse_drugbank(handle)
-    
\ No newline at end of file
+    with open(options.path) as handle:
+        if options.multi:
+            convert_drugbank(handle, options.multi, options.engine, options.queue_size, options.batch_size)
+        else:
+            parse_drugbank(handle, options.engine)
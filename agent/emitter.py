@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+
+'''
+Shared protobuf to JSON lines emitter for the BMEG agents.
+
+json_format.MessageToJson renders a pretty printed string that the agents
+then parse back with json.loads, decorate with a label and dump again. The
+functions here walk the set fields of a message once, using a cache of field
+names and converters keyed by message descriptor, and hand the resulting
+dict straight to the json encoder.
+
+The output is the same document MessageToJson produces (camelCase field
+names, int64 values as strings, enums by name, NaN/Infinity as strings,
+Struct/ListValue/Value rendered as plain JSON), written on a single line.
+
+example usage:
+
+    import emitter
+    emit = emitter.JSONEmitter(multi='ccle')
+    emit(message)
+    emit.close()
+'''
+
+import json
+import math
+import base64
+from json import encoder
+
+from google.protobuf import json_format
+from google.protobuf.descriptor import FieldDescriptor
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+BUFFER_SIZE = 1 << 20
+
+SEPARATORS = (',', ':')
+
+INT64_TYPES = frozenset([
+    FieldDescriptor.TYPE_INT64,
+    FieldDescriptor.TYPE_UINT64,
+    FieldDescriptor.TYPE_SINT64,
+    FieldDescriptor.TYPE_FIXED64,
+    FieldDescriptor.TYPE_SFIXED64
+])
+
+FLOAT_TYPES = frozenset([
+    FieldDescriptor.TYPE_FLOAT,
+    FieldDescriptor.TYPE_DOUBLE
+])
+
+STRUCT = 'google.protobuf.Struct'
+LIST_VALUE = 'google.protobuf.ListValue'
+VALUE = 'google.protobuf.Value'
+
+########################################
+
+def identity(value):
+    return value
+
+def int64_string(value):
+    return str(value)
+
+def bytes_string(value):
+    return base64.b64encode(value).decode('utf-8')
+
+def float_value(value):
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return 'Infinity' if value > 0 else '-Infinity'
+    return value
+
+def map_key(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value) if not isinstance(value, basestring) else value
+
+def enum_converter(field):
+    names = dict((v.number, v.name) for v in field.enum_type.values)
+    def convert(value):
+        return names.get(value, value)
+    return convert
+
+def struct_to_dict(message):
+    return dict((k, value_to_object(v)) for k, v in message.fields.items())
+
+def list_value_to_list(message):
+    return [value_to_object(v) for v in message.values]
+
+def value_to_object(message):
+    which = message.WhichOneof('kind')
+    if which is None or which == 'null_value':
+        return None
+    if which == 'list_value':
+        return list_value_to_list(message.list_value)
+    if which == 'struct_value':
+        return struct_to_dict(message.struct_value)
+    if which == 'number_value':
+        return float_value(message.number_value)
+    return getattr(message, which)
+
+def message_converter(message_type):
+    name = message_type.full_name
+    if name == STRUCT:
+        return struct_to_dict
+    if name == LIST_VALUE:
+        return list_value_to_list
+    if name == VALUE:
+        return value_to_object
+    if name.startswith('google.protobuf.'):
+        # Timestamp, Duration, wrappers and friends have their own rendering
+        return json_format.MessageToDict
+    return message_to_dict
+
+def scalar_converter(field):
+    if field.type == FieldDescriptor.TYPE_MESSAGE:
+        return message_converter(field.message_type)
+    if field.type == FieldDescriptor.TYPE_ENUM:
+        return enum_converter(field)
+    if field.type in INT64_TYPES:
+        return int64_string
+    if field.type in FLOAT_TYPES:
+        return float_value
+    if field.type == FieldDescriptor.TYPE_BYTES:
+        return bytes_string
+    return identity
+
+def is_map_entry(field):
+    return (field.type == FieldDescriptor.TYPE_MESSAGE and
+            field.message_type.GetOptions().map_entry)
+
+def is_repeated(field):
+    if hasattr(field, 'is_repeated'):
+        return field.is_repeated
+    return field.label == FieldDescriptor.LABEL_REPEATED
+
+def field_converter(field):
+    if is_map_entry(field):
+        key_field = field.message_type.fields_by_name['key']
+        value_convert = scalar_converter(field.message_type.fields_by_name['value'])
+        plain_keys = key_field.type == FieldDescriptor.TYPE_STRING
+        if plain_keys and value_convert in (identity, float_value):
+            # NaN and Infinity are caught by the encoder and patched in dict_to_json
+            return dict
+        if plain_keys:
+            return lambda value: dict((k, value_convert(v)) for k, v in value.items())
+        return lambda value: dict((map_key(k), value_convert(v)) for k, v in value.items())
+
+    convert = scalar_converter(field)
+    if is_repeated(field):
+        if convert in (identity, float_value):
+            return list
+        return lambda value: [convert(v) for v in value]
+    if convert is float_value:
+        return identity
+    return convert
+
+def json_name(field):
+    if field.is_extension:
+        return '[%s]' % field.full_name
+    name = getattr(field, 'json_name', None)
+    if name:
+        return name
+    parts = field.name.split('_')
+    return parts[0] + ''.join(p[:1].upper() + p[1:] for p in parts[1:])
+
+FIELD_CACHE = {}
+
+def descriptor_fields(descriptor):
+    fields = FIELD_CACHE.get(descriptor)
+    if fields is None:
+        fields = {}
+        FIELD_CACHE[descriptor] = fields
+    return fields
+
+def message_to_dict(message):
+    fields = descriptor_fields(message.DESCRIPTOR)
+    out = {}
+    for field, value in message.ListFields():
+        entry = fields.get(field)
+        if entry is None:
+            convert = field_converter(field)
+            entry = (json_name(field), None if convert is identity else convert)
+            fields[field] = entry
+        name, convert = entry
+        out[name] = value if convert is None else convert(value)
+    return out
+
+########################################
+
+def clean_floats(obj):
+    if isinstance(obj, float):
+        return float_value(obj)
+    if isinstance(obj, dict):
+        return dict((k, clean_floats(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [clean_floats(v) for v in obj]
+    return obj
+
+ENCODE = json.JSONEncoder(separators=SEPARATORS, allow_nan=False).encode
+
+def unserializable(obj):
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+if encoder.c_make_encoder is not None:
+    # JSONEncoder.encode builds a new C encoder, with a circular reference
+    # check, for every call; records are trees, so one is kept and reused
+    C_ENCODE = encoder.c_make_encoder(None, unserializable, encoder.encode_basestring_ascii,
+        None, SEPARATORS[1], SEPARATORS[0], False, False, False)
+
+    def ENCODE(msg):
+        return ''.join(C_ENCODE(msg, 0))
+
+def dict_to_json(msg):
+    try:
+        return ENCODE(msg)
+    except ValueError:
+        return ENCODE(clean_floats(msg))
+
+def message_to_json(message, label_field=None, full_name=False):
+    '''
+    Render a message as a single line of JSON. When label_field is given
+    the message type is stored under that key, using the full descriptor
+    name if full_name is set and the short name otherwise.
+    '''
+    msg = message_to_dict(message)
+    if label_field is not None:
+        descriptor = message.DESCRIPTOR
+        msg[label_field] = descriptor.full_name if full_name else descriptor.name
+    return dict_to_json(msg)
+
+########################################
+
+class JSONEmitter(object):
+    '''
+    Callable that writes messages as JSON lines.
+
+    With `out` every message goes to one file (or an already open handle such
+    as sys.stdout). With `multi` each message type gets its own file named
+    multi + separator + full type name + suffix, matching the `--multi` mode
+    of the agents. Files are opened with `mode`, so 'a' adds to earlier output.
+    '''
+
+    def __init__(self, out=None, multi=None, label_field=None, full_name=True, separator='.', suffix='.json', buffer_size=BUFFER_SIZE, mode='w'):
+        if out is None and multi is None:
+            raise ValueError('an output path or a multi prefix is required')
+        self.out = out
+        self.multi = multi
+        self.label_field = label_field
+        self.full_name = full_name
+        self.separator = separator
+        self.suffix = suffix
+        self.buffer_size = buffer_size
+        self.mode = mode
+        self.handles = {}
+        self.owned = []
+
+    def path(self, name):
+        return self.multi + self.separator + name + self.suffix
+
+    def open(self, path):
+        handle = open(path, self.mode, self.buffer_size)
+        self.owned.append(handle)
+        return handle
+
+    def handle(self, message):
+        return self.named_handle(message.DESCRIPTOR.full_name)
+
+    def named_handle(self, name):
+        if self.multi is None:
+            name = 'main'
+        handle = self.handles.get(name)
+        if handle is None:
+            if self.multi is not None:
+                handle = self.open(self.path(name))
+            elif hasattr(self.out, 'write'):
+                handle = self.out
+            else:
+                handle = self.open(self.out)
+            self.handles[name] = handle
+        return handle
+
+    def emit(self, message):
+        self.handle(message).write(message_to_json(message, self.label_field, self.full_name) + '\n')
+
+    __call__ = emit
+
+    def emit_dict(self, name, msg):
+        '''
+        Write a plain dict, such as an edge record, as a JSON line. With
+        multi it goes to the file for name, like a message type.
+        '''
+        self.emit_line(name, dict_to_json(msg))
+
+    def emit_fields(self, descriptor, msg):
+        '''
+        Write a dict laid out as message_to_dict gives a message of this
+        descriptor, labelled and routed the way emit writes the message.
+        '''
+        if self.label_field is not None:
+            msg[self.label_field] = descriptor.full_name if self.full_name else descriptor.name
+        self.named_handle(descriptor.full_name).write(dict_to_json(msg) + '\n')
+
+    def emit_line(self, name, line):
+        '''
+        Write a line already rendered by message_to_json or dict_to_json,
+        such as one made in a worker process, to the file for name.
+        '''
+        self.named_handle(name).write(line + '\n')
+
+    def close(self):
+        for handle in self.owned:
+            handle.close()
+        for handle in self.handles.values():
+            if handle not in self.owned:
+                handle.flush()
+        self.owned = []
+        self.handles = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
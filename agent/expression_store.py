@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+
+'''
+Columnar sample x gene expression store shared by the expression agents.
+
+A store is a directory holding a float32 samples x genes matrix cut into
+tiles of `chunks` = (samples, genes), so a gene column or a sample row only
+touches one band of tiles:
+
+    meta.json        shape, tile size, dtype and compression
+    genes.tsv        one gene per column, in column order
+    samples.tsv      one line per row, the sample id first and any extra
+                     tab separated fields after it
+    tiles/I.J.f4     raw little endian float32 tile, memory mapped on read
+    tiles/I.J.f4.z   or the same tile byte shuffled and zlib compressed
+
+Genes a sample was not measured for are NaN. Tiles are written raw unless
+the writer is given compression='zlib', which makes the store smaller but
+has every tile read inflated into memory instead of mapped.
+
+example usage:
+
+    import expression_store
+    with expression_store.StoreWriter('gtex.expression', genes) as store:
+        store.add('GTEX-1117F-0226-SM-5GZZ7', values)
+
+    store = expression_store.ExpressionStore('gtex.expression')
+    store.column('TP53')
+    store.row('GTEX-1117F-0226-SM-5GZZ7')
+    store.submatrix(genes=['TP53', 'BRCA1'])
+'''
+
+import os
+import json
+import zlib
+import shutil
+import collections
+
+import numpy
+
+try:
+    long
+except NameError:
+    long = int
+
+INTEGER_TYPES = (int, long, numpy.integer)
+
+FORMAT = 'bmeg-expression'
+VERSION = 1
+
+DTYPE = numpy.dtype('<f4')
+
+CHUNK_SAMPLES = 128
+CHUNK_GENES = 2048
+
+COMPRESSION_LEVEL = 6
+CACHE_TILES = 32
+
+META = 'meta.json'
+GENES = 'genes.tsv'
+SAMPLES = 'samples.tsv'
+TILES = 'tiles'
+
+########################################
+
+def shuffle(tile):
+    # group the bytes of each float by significance so zlib sees the
+    # repetitive exponent bytes together
+    return tile.view(numpy.uint8).reshape(-1, DTYPE.itemsize).T.tobytes()
+
+def unshuffle(data, shape):
+    raw = numpy.frombuffer(data, dtype=numpy.uint8).reshape(DTYPE.itemsize, -1)
+    return numpy.ascontiguousarray(raw.T).view(DTYPE).reshape(shape)
+
+def tile_name(i, j, compression):
+    name = '%d.%d.f4' % (i, j)
+    if compression == 'zlib':
+        name += '.z'
+    return name
+
+def sample_fields(sample):
+    if isinstance(sample, (tuple, list)):
+        return [str(s) for s in sample]
+    return [str(sample)]
+
+########################################
+
+class StoreWriter(object):
+    '''
+    Writes a store one sample row at a time. Rows are held until a band of
+    chunks[0] samples is full, then cut into tiles, so memory is bounded by
+    one band rather than the whole matrix. The store is written to a
+    temporary directory and moved into place on close. compression is None
+    for raw, memory mappable tiles or 'zlib'.
+    '''
+
+    def __init__(self, path, genes, chunks=(CHUNK_SAMPLES, CHUNK_GENES), compression=None, level=COMPRESSION_LEVEL):
+        if compression not in (None, 'zlib'):
+            raise ValueError('unknown compression %s' % compression)
+        self.path = path
+        self.genes = list(genes)
+        self.chunks = tuple(chunks)
+        self.compression = compression
+        self.level = level
+        self.count = 0
+        self.band = 0
+        self.rows = []
+
+        self.work = path + '.partial'
+        if os.path.exists(self.work):
+            shutil.rmtree(self.work)
+        os.makedirs(os.path.join(self.work, TILES))
+        self.samples = open(os.path.join(self.work, SAMPLES), 'w')
+
+    def add(self, sample, values):
+        '''
+        Add one row. values are in the order of genes given to the writer.
+        '''
+        values = numpy.asarray(values, dtype=DTYPE)
+        if values.shape != (len(self.genes),):
+            raise ValueError('expected %d values for %s, found %s' % (len(self.genes), sample, values.shape))
+        self.samples.write('\t'.join(sample_fields(sample)) + '\n')
+        self.rows.append(values)
+        self.count += 1
+        if len(self.rows) == self.chunks[0]:
+            self.flush()
+
+    def add_matrix(self, samples, matrix):
+        '''
+        Add a samples x genes matrix, such as the values of a DataFrame.
+        '''
+        for sample, values in zip(samples, matrix):
+            self.add(sample, values)
+
+    def write_tile(self, j, tile):
+        path = os.path.join(self.work, TILES, tile_name(self.band, j, self.compression))
+        tile = numpy.ascontiguousarray(tile, dtype=DTYPE)
+        if self.compression == 'zlib':
+            data = zlib.compress(shuffle(tile), self.level)
+        else:
+            data = tile.tobytes()
+        with open(path, 'wb') as handle:
+            handle.write(data)
+
+    def flush(self):
+        if not self.rows:
+            return
+        band = numpy.vstack(self.rows)
+        width = self.chunks[1]
+        for j, start in enumerate(range(0, len(self.genes), width)):
+            self.write_tile(j, band[:, start:start + width])
+        self.rows = []
+        self.band += 1
+
+    def meta(self):
+        return {
+            'format': FORMAT,
+            'version': VERSION,
+            'dtype': DTYPE.str,
+            'shape': [self.count, len(self.genes)],
+            'chunks': list(self.chunks),
+            'compression': self.compression
+        }
+
+    def close(self):
+        self.flush()
+        self.samples.close()
+        with open(os.path.join(self.work, GENES), 'w') as handle:
+            for gene in self.genes:
+                handle.write(gene + '\n')
+        with open(os.path.join(self.work, META), 'w') as handle:
+            json.dump(self.meta(), handle, indent=2, sort_keys=True)
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.work, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def write_frame(path, frame, **kwargs):
+    '''
+    Write a pandas DataFrame with samples as the index and genes as columns.
+    '''
+    with StoreWriter(path, [str(g) for g in frame.columns], **kwargs) as store:
+        store.add_matrix(frame.index, frame.values)
+
+########################################
+
+class ExpressionStore(object):
+    '''
+    Reads slices of a store. Genes and samples can be given by name or by
+    integer position. Uncompressed tiles are memory mapped; compressed tiles
+    are inflated on first use and the most recent `cache_tiles` are kept.
+    '''
+
+    def __init__(self, path, cache_tiles=CACHE_TILES):
+        self.path = path
+        with open(os.path.join(path, META)) as handle:
+            meta = json.load(handle)
+        if meta.get('format') != FORMAT:
+            raise ValueError('%s is not an expression store' % path)
+        if meta['version'] > VERSION:
+            raise ValueError('unsupported expression store version %s' % meta['version'])
+
+        self.shape = tuple(meta['shape'])
+        self.chunks = tuple(meta['chunks'])
+        self.compression = meta['compression']
+        self.dtype = numpy.dtype(meta['dtype'])
+
+        with open(os.path.join(path, GENES)) as handle:
+            self.genes = [line.rstrip('\n') for line in handle]
+        with open(os.path.join(path, SAMPLES)) as handle:
+            self.sample_rows = [tuple(line.rstrip('\n').split('\t')) for line in handle]
+        self.samples = [row[0] for row in self.sample_rows]
+
+        self.gene_index = dict((gene, i) for i, gene in enumerate(self.genes))
+        self.sample_index = dict((sample, i) for i, sample in enumerate(self.samples))
+
+        self.cache_tiles = cache_tiles
+        self.tiles = collections.OrderedDict()
+
+    def tile_shape(self, i, j):
+        rows = min(self.chunks[0], self.shape[0] - i * self.chunks[0])
+        columns = min(self.chunks[1], self.shape[1] - j * self.chunks[1])
+        return rows, columns
+
+    def read_tile(self, i, j):
+        path = os.path.join(self.path, TILES, tile_name(i, j, self.compression))
+        shape = self.tile_shape(i, j)
+        if self.compression == 'zlib':
+            with open(path, 'rb') as handle:
+                return unshuffle(zlib.decompress(handle.read()), shape)
+        return numpy.memmap(path, dtype=self.dtype, mode='r', shape=shape)
+
+    def tile(self, i, j):
+        key = (i, j)
+        tile = self.tiles.pop(key, None)
+        if tile is None:
+            tile = self.read_tile(i, j)
+            if len(self.tiles) >= self.cache_tiles:
+                self.tiles.popitem(last=False)
+        self.tiles[key] = tile
+        return tile
+
+    def resolve(self, keys, index, size):
+        if keys is None:
+            return numpy.arange(size)
+        if isinstance(keys, slice):
+            return numpy.arange(size)[keys]
+        positions = []
+        for key in keys:
+            if isinstance(key, INTEGER_TYPES):
+                positions.append(int(key))
+            else:
+                positions.append(index[key])
+        return numpy.array(positions, dtype=numpy.intp)
+
+    def position(self, key, index):
+        if isinstance(key, INTEGER_TYPES):
+            return int(key)
+        return index[key]
+
+    def column(self, gene):
+        '''
+        Values of one gene across all samples.
+        '''
+        g = self.position(gene, self.gene_index)
+        j, offset = divmod(g, self.chunks[1])
+        bands = len(range(0, self.shape[0], self.chunks[0]))
+        if bands == 0:
+            return numpy.empty(0, dtype=self.dtype)
+        return numpy.concatenate([self.tile(i, j)[:, offset] for i in range(bands)])
+
+    def row(self, sample):
+        '''
+        Values of one sample across all genes.
+        '''
+        s = self.position(sample, self.sample_index)
+        i, offset = divmod(s, self.chunks[0])
+        columns = len(range(0, self.shape[1], self.chunks[1]))
+        if columns == 0:
+            return numpy.empty(0, dtype=self.dtype)
+        return numpy.concatenate([self.tile(i, j)[offset, :] for j in range(columns)])
+
+    def submatrix(self, samples=None, genes=None):
+        '''
+        A len(samples) x len(genes) array. Either may be None for all of
+        them, a slice, or a list of names or positions; the result follows
+        the order given.
+        '''
+        rows = self.resolve(samples, self.sample_index, self.shape[0])
+        columns = self.resolve(genes, self.gene_index, self.shape[1])
+        out = numpy.empty((len(rows), len(columns)), dtype=self.dtype)
+
+        row_tiles = rows // self.chunks[0]
+        column_tiles = columns // self.chunks[1]
+        for i in numpy.unique(row_tiles):
+            row_mask = row_tiles == i
+            local_rows = rows[row_mask] - i * self.chunks[0]
+            for j in numpy.unique(column_tiles):
+                column_mask = column_tiles == j
+                local_columns = columns[column_mask] - j * self.chunks[1]
+                tile = self.tile(int(i), int(j))
+                out[numpy.ix_(row_mask, column_mask)] = tile[numpy.ix_(local_rows, local_columns)]
+        return out
+
+    def frame(self, samples=None, genes=None):
+        '''
+        The submatrix as a pandas DataFrame labelled by sample and gene.
+        '''
+        import pandas
+        rows = self.resolve(samples, self.sample_index, self.shape[0])
+        columns = self.resolve(genes, self.gene_index, self.shape[1])
+        return pandas.DataFrame(
+            self.submatrix(rows, columns),
+            index=[self.samples[r] for r in rows],
+            columns=[self.genes[c] for c in columns])
@@ -7,20 +7,23 @@ Authors: Malisa Smith smimal@ohsu.edu, Ryan Spangler spanglry@ohsu.edu
 import re
 import os
 import sys
-import gzip
 import json
+import zlib
+import heapq
+import shutil
 import string
 import logging
 import argparse
+import operator
+import tempfile
+import itertools
+import multiprocessing
 from ga4gh import bio_metadata_pb2, variants_pb2, allele_annotations_pb2
-from google.protobuf import json_format
 
-########################################
-
-def proto_list_append(message, a):
-    v = message.values.add()
-    v.string_value = a
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import emitter
 
+########################################
 
 class Converter(object):
     def __init__(self, bioPrefix, variantPrefix, variantSetPrefix, callSetPrefix, variantAnnotationPrefix, transcriptEffectPrefix, hugoPrefix, typeField, centerCol):
@@ -55,117 +58,393 @@ class Converter(object):
     def gid_gene(self, name):
         return '%s:%s' % (self.hugoPrefix, name)
 
+# maf columns read by MafConverter, each with the header spellings seen in
+# the CCLE, MC3 and GDC mafs
+MAF_COLUMNS = [
+    ['Hugo_Symbol'],
+    ['Chromosome'],
+    ['Start_Position', 'Start_position'],
+    ['End_Position', 'End_position'],
+    ['Variant_Type'],
+    ['Reference_Allele'],
+    ['Tumor_Seq_Allele1'],
+    ['Tumor_Seq_Allele2'],
+    ['Tumor_Sample_Barcode']
+]
+
+HUGO_SYMBOL, CHROMOSOME, START, END, VARIANT_TYPE, REFERENCE_ALLELE, TUMOR_ALLELE1, TUMOR_ALLELE2, TUMOR_SAMPLE_BARCODE, CENTER = range(10)
+
+CHUNK_SIZE = 1 << 22
+GZIP_MAGIC = b'\x1f\x8b'
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+def maf_blocks(path, chunk_size=CHUNK_SIZE):
+    """
+    Yield the text of a maf in blocks, gzipped or not, sniffing the magic
+    number rather than trusting the file extension. Gzip is inflated with
+    zlib directly, a member at a time, so bgzipped mafs read as one stream.
+    """
+    with open(path, 'rb') as handle:
+        block = handle.read(chunk_size)
+        if not block.startswith(GZIP_MAGIC):
+            while block:
+                yield block
+                block = handle.read(chunk_size)
+            return
+
+        inflate = zlib.decompressobj(GZIP_WBITS)
+        while block:
+            text = inflate.decompress(block, chunk_size)
+            if inflate.unused_data:
+                # the member ended, the rest of the block starts the next
+                block = inflate.unused_data
+                text += inflate.flush()
+                inflate = zlib.decompressobj(GZIP_WBITS)
+            else:
+                block = inflate.unconsumed_tail or handle.read(chunk_size)
+            if text:
+                yield text
+        text = inflate.flush()
+        if text:
+            yield text
+
+class MafReader(object):
+    """
+    Streams a maf as chunks of tuples. Column positions are resolved once
+    from the header, so every row becomes a tuple holding only the requested
+    columns, in the order they were requested. Optional columns missing from
+    the header read as ''.
+    """
+
+    def __init__(self, path, columns, optional=[], chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.columns = columns
+        self.optional = optional
+        self.chunk_size = chunk_size
+
+    def resolve(self, header):
+        positions = dict((name, i) for i, name in enumerate(header))
+        indices = []
+        for names in self.columns:
+            found = [positions[n] for n in names if n in positions]
+            if not found:
+                raise Exception('%s: maf header is missing column %s' % (self.path, names[0]))
+            indices.append(found[0])
+        for name in self.optional:
+            indices.append(positions.get(name))
+
+        if None not in indices:
+            getter = operator.itemgetter(*indices)
+        else:
+            getter = lambda row: tuple('' if i is None else row[i] for i in indices)
+        width = max(i for i in indices if i is not None) + 1
+
+        def parse(line):
+            row = line.rstrip('\r').split('\t')
+            row.extend([''] * (width - len(row)))
+            return getter(row)
+
+        def parse_rows(lines):
+            # columns past the last one read are left unsplit
+            try:
+                return [getter(line.rstrip('\r').split('\t', width)) for line in lines if line and line[0] != '#']
+            except IndexError:
+                # a block with a short row, which is padded with ''
+                return [parse(line) for line in lines if line and line[0] != '#']
+        return parse_rows
+
+    def parse_lines(self, lines, parse):
+        if parse is None:
+            for i, line in enumerate(lines):
+                if line and not line.startswith('#'):
+                    parse = self.resolve(line.rstrip('\r').split('\t'))
+                    lines = lines[i + 1:]
+                    break
+            else:
+                return [], None
+        return parse(lines), parse
+
+    def __iter__(self):
+        parse = None
+        remainder = ''
+        for block in maf_blocks(self.path, self.chunk_size):
+            lines = (remainder + block).split('\n')
+            remainder = lines.pop()
+            rows, parse = self.parse_lines(lines, parse)
+            if rows:
+                yield rows
+        rows, parse = self.parse_lines([remainder], parse)
+        if rows:
+            yield rows
+
+VARIANT = variants_pb2.Variant.DESCRIPTOR
+CALL = variants_pb2.Call.DESCRIPTOR
+VARIANT_ANNOTATION = allele_annotations_pb2.VariantAnnotation.DESCRIPTOR
+TRANSCRIPT_EFFECT = allele_annotations_pb2.TranscriptEffect.DESCRIPTOR
+ONTOLOGY_TERM = TRANSCRIPT_EFFECT.fields_by_name['effects'].message_type
+
+def json_names(descriptor):
+    return dict((field.name, emitter.json_name(field)) for field in descriptor.fields)
+
+# fields of the rows held by VariantIndex; the gid comes first so that
+# sorting rows also groups them by variant
+(V_ID, V_CHROMOSOME, V_START, V_END, V_REFERENCE, V_ALTERNATE, V_HUGO_SYMBOL,
+    V_VARIANT_TYPE, V_CENTER, V_SAMPLE) = range(10)
+
+BUFFER_ROWS = 500000
+
+class VariantIndex(object):
+    """
+    Bounded memory external sort of maf rows keyed by variant gid.
+
+    Rows are hashed into partitions, buffered, and spilled to sorted run
+    files under workdir whenever buffer_rows rows are held. Merging the runs
+    of a partition yields every row of a variant next to each other, so each
+    variant can be emitted once with all of its calls no matter how large
+    the maf is.
+    """
+
+    def __init__(self, workdir, name='index', partitions=1, buffer_rows=BUFFER_ROWS):
+        self.workdir = workdir
+        self.name = name
+        self.partitions = partitions
+        self.buffer_rows = buffer_rows
+        self.buffers = [[] for i in range(partitions)]
+        self.size = 0
+        self.runs = [[] for i in range(partitions)]
+
+    def add(self, record):
+        if self.partitions == 1:
+            partition = 0
+        else:
+            partition = (zlib.crc32(record[V_ID]) & 0xffffffff) % self.partitions
+        self.buffers[partition].append('\t'.join(record))
+        self.size += 1
+        if self.size >= self.buffer_rows:
+            self.spill()
+
+    def groups(self, partition=0):
+        """
+        The rows of each variant of a partition, in gid order. A partition
+        that never spilled is sorted and grouped in memory.
+        """
+        if not self.runs[partition]:
+            lines = self.buffers[partition]
+            self.buffers[partition] = []
+            lines.sort()
+            return group_lines(lines)
+        self.spill()
+        return variant_groups(self.runs[partition])
+
+    def spill(self):
+        for partition, lines in enumerate(self.buffers):
+            if lines:
+                lines.sort()
+                path = os.path.join(self.workdir, '%s.%d.%d.tsv' % (self.name, partition, len(self.runs[partition])))
+                with open(path, 'w', emitter.BUFFER_SIZE) as handle:
+                    for line in lines:
+                        handle.write(line + '\n')
+                self.runs[partition].append(path)
+        self.buffers = [[] for i in range(self.partitions)]
+        self.size = 0
+
+def read_run(path):
+    with open(path, 'r', emitter.BUFFER_SIZE) as handle:
+        for line in handle:
+            yield line
+
+def group_lines(lines):
+    """Yield the rows of one variant at a time from sorted lines."""
+    rows = (line.rstrip('\n').split('\t') for line in lines)
+    for variant_id, group in itertools.groupby(rows, operator.itemgetter(V_ID)):
+        yield list(group)
+
+def variant_groups(paths):
+    """Merge sorted run files, yielding the rows of one variant at a time."""
+    runs = [read_run(path) for path in paths]
+    return group_lines(heapq.merge(*runs))
+
 class MafConverter(Converter):
     #def __init__(self, **kwargs):
     #    super(MafConverter, self).__init__(**kwargs)
 
-    def convert(self, emit, mafpath):
-        center = 2
-        ncbi_build = 3
-        chromosome = 4
-        start = 5
-        end = 6
-        strand = 7
-        variant_type = 9
-        reference_allele = 10
-        tumor_allele1 = 11
-        tumor_allele2 = 12
-        tumor_sample_barcode = 15
-
-        normal_sample_barcode = 16 
-        normal_allele1 = 17 
-        normal_allele2 = 18 
-        verification_status = 23
-        validation_status = 24
-        mutation_status = 25
-        sequencing_phase = 26
-        sequence_source = 27
-        bam_file = 30
-
-        sequencer = 31
-        genome_change = 32
-
-        # Information indices for VariantCallEffect and Gene
-        hugo_symbol = 0
-        entrez_gene_id = 1
-        variant_classification = 8
-        
+    def convert(self, index, mafpath):
         logging.info('converting maf: ' + mafpath)
-        
+
         samples = set()
-        variants = set()
+        add = index.add
+        gid_variant = self.gid_variant
+        reader = MafReader(mafpath, MAF_COLUMNS, optional=[self.centerCol])
+        for chunk in reader:
+            for row in chunk:
+                alternate = ','.join(set([row[TUMOR_ALLELE1], row[TUMOR_ALLELE2]]))
+                start = str(long(row[START]))
+                end = str(long(row[END]))
+                variant_id = gid_variant(
+                    row[CHROMOSOME],
+                    start,
+                    end,
+                    row[REFERENCE_ALLELE],
+                    alternate)
+                add((
+                    variant_id,
+                    row[CHROMOSOME],
+                    start,
+                    end,
+                    row[REFERENCE_ALLELE],
+                    alternate,
+                    row[HUGO_SYMBOL],
+                    row[VARIANT_TYPE],
+                    row[CENTER],
+                    row[TUMOR_SAMPLE_BARCODE]))
+                samples.add(row[TUMOR_SAMPLE_BARCODE])
 
-        header = None
-        if mafpath.endswith(".gz"):
-            inhandle = gzip.GzipFile(mafpath)
-        else:
-            inhandle = open(mafpath)
-        for line_raw in inhandle:
-            if line_raw.startswith('Hugo_Symbol'):
-                header = line_raw.rstrip().split("\t")
-            elif line_raw.startswith('#'):
-                pass
-            else:
-                line = line_raw.rstrip().split('\t')
-                row = dict(zip(header, line))
-                alternate_bases = set([line[tumor_allele1], line[tumor_allele2]])
-                variant_id = self.gid_variant(
-                    line[chromosome],
-                    long(line[start]),
-                    long(line[end]),
-                    line[reference_allele],
-                    ','.join(alternate_bases))
-
-
-                variant = variants_pb2.Variant()
-                variant.id = variant_id
-                variant.start = long(line[start])
-                variant.end = long(line[end])
-                variant.reference_name = line[chromosome]
-                variant.reference_bases = line[reference_allele]
-                for a in set( [line[tumor_allele1], line[tumor_allele2] ] ):
-                    variant.alternate_bases.append(a)
-                #proto_list_append(variant.info["hugo"], line[hugo_symbol])
-                if self.centerCol in row:
-                    for c in row[self.centerCol].split("|"):
-                        proto_list_append(variant.info["center"], c)
-                #proto_list_append(variant.info["variant_type"], line[variant_type])
-                call = variant.calls.add()
-                call.call_set_id = self.gid_call_set(line[tumor_sample_barcode])
-                samples.add(line[tumor_sample_barcode])
-                emit(variant)
-
-                annotation_id = self.gid_variant_annotation(variant_id, '')
-                annotation = allele_annotations_pb2.VariantAnnotation()
-                annotation.id = annotation_id
-                annotation.variant_id = variant_id
-                feature_id = self.gid_gene(line[hugo_symbol])
-                effect = line[variant_type]
-                transcript_effect = annotation.transcript_effects.add()
-                transcript_effect.alternate_bases = ','.join(alternate_bases)
-                transcript_effect.feature_id = feature_id
-                transcript_effect.id = self.gid_transcript_effect(
-                    feature_id,
-                    annotation_id,
-                    ','.join(alternate_bases))
-
-                ontology = transcript_effect.effects.add()
-                ontology.term = effect
-                #annotations.append(annotation)
-                emit(annotation)
-        
-        for sample in samples:
+        return samples
+
+    def emit_variants(self, emit, groups):
+        """
+        Emit one Variant and one VariantAnnotation per group of rows, in the
+        gid order the groups come in. The Variant carries a call for each
+        distinct sample and the union of the centers. The rows of a group
+        are sorted by their fields, so the annotation takes the Hugo symbol
+        and variant type of the first of them, the smallest Hugo symbol,
+        when the rows of a variant disagree.
+
+        The records are built as the dicts message_to_dict would give for
+        the messages, with field names from the descriptors, rather than as
+        messages, since filling and walking the messages took most of the
+        run time.
+        """
+        v = json_names(VARIANT)
+        call_set_id = json_names(CALL)['call_set_id']
+        a = json_names(VARIANT_ANNOTATION)
+        t = json_names(TRANSCRIPT_EFFECT)
+        term = json_names(ONTOLOGY_TERM)['term']
+        for rows in groups:
+            first = rows[0]
+            variant_id = first[V_ID]
+            alternate = first[V_ALTERNATE]
+
+            centers = []
+            samples = []
+            for row in rows:
+                if row[V_CENTER]:
+                    for c in row[V_CENTER].split("|"):
+                        if c not in centers:
+                            centers.append(c)
+                if row[V_SAMPLE] not in samples:
+                    samples.append(row[V_SAMPLE])
+
+            # unset proto3 fields (empty strings, int64 0) are left out
+            variant = {
+                v['id']: variant_id,
+                v['alternate_bases']: alternate.split(','),
+                v['calls']: [{call_set_id: self.gid_call_set(sample)} for sample in samples]
+            }
+            if first[V_START] != '0':
+                variant[v['start']] = first[V_START]
+            if first[V_END] != '0':
+                variant[v['end']] = first[V_END]
+            if first[V_CHROMOSOME]:
+                variant[v['reference_name']] = first[V_CHROMOSOME]
+            if first[V_REFERENCE]:
+                variant[v['reference_bases']] = first[V_REFERENCE]
+            if centers:
+                variant[v['info']] = {'center': centers}
+            emit.emit_fields(VARIANT, variant)
+
+            annotation_id = self.gid_variant_annotation(variant_id, '')
+            feature_id = self.gid_gene(first[V_HUGO_SYMBOL])
+            transcript_effect = {
+                t['id']: self.gid_transcript_effect(feature_id, annotation_id, alternate),
+                t['feature_id']: feature_id,
+                t['effects']: [{term: first[V_VARIANT_TYPE]} if first[V_VARIANT_TYPE] else {}]
+            }
+            if alternate:
+                transcript_effect[t['alternate_bases']] = alternate
+            annotation = {
+                a['id']: annotation_id,
+                a['variant_id']: variant_id,
+                a['transcript_effects']: [transcript_effect]
+            }
+            emit.emit_fields(VARIANT_ANNOTATION, annotation)
+
+    def emit_callsets(self, emit, samples):
+        for sample in sorted(samples):
             callset = variants_pb2.CallSet()
             callset.id = self.gid_call_set(sample)
             callset.name = sample
             callset.biosample_id = self.gid_biosample("CCLE", sample)
             emit(callset)
 
-        inhandle.close()
+def maf_paths(maf):
+    if os.path.isdir(maf):
+        return [os.path.join(maf, path) for path in sorted(os.listdir(maf)) if path.endswith('.maf') or path.endswith('.maf.gz')]
+    return [maf]
 
+def index_maf(task):
+    """
+    Sort the rows of a single maf into partitioned runs. Runs in a worker
+    process; returns the samples seen and the run files of each partition.
+    """
+    converter, mafpath, workdir, name, partitions = task
+    index = VariantIndex(workdir, name=name, partitions=partitions)
+    samples = converter.convert(index, mafpath)
+    index.spill()
+    return samples, index.runs
 
-def convert_to_profobuf(maf, vcf, out, multi, format, bioPrefix, variantPrefix, variantSetPrefix, callSetPrefix, variantAnnotationPrefix, transcriptEffectPrefix, hugoPrefix, typeField, centerCol):
+def emit_partition(task):
+    """
+    Merge the runs of one partition and write its variants to per type
+    shard files. Runs in a worker process.
+    """
+    converter, paths, prefix, label_field = task
+    emit = emitter.JSONEmitter(multi=prefix, label_field=label_field)
+    converter.emit_variants(emit, variant_groups(paths))
+    shards = dict((name, emit.path(name)) for name in emit.handles)
+    emit.close()
+    return shards
+
+def merge_shards(results, out, multi):
+    """
+    Concatenate shard files in partition order, then type order, so the
+    merged output does not depend on which worker finished first.
+    """
     out_handles = {}
+    def target(name):
+        key = 'main' if out else name
+        if key not in out_handles:
+            path = out if out else multi + '.' + name + '.json'
+            out_handles[key] = open(path, 'w', emitter.BUFFER_SIZE)
+        return out_handles[key]
+
+    for shards in results:
+        for name in sorted(shards):
+            with open(shards[name]) as handle:
+                shutil.copyfileobj(handle, target(name), emitter.BUFFER_SIZE)
+
+    for handle in out_handles.values():
+        handle.close()
+
+def convert_parallel(m, paths, workdir, out, multi, workers, label_field):
+    pool = multiprocessing.Pool(workers)
+    try:
+        tasks = [(m, path, workdir, 'maf%06d' % i, workers) for i, path in enumerate(paths)]
+        samples = set()
+        runs = [[] for i in range(workers)]
+        for maf_samples, maf_runs in pool.imap(index_maf, tasks):
+            samples.update(maf_samples)
+            for partition, partition_runs in enumerate(maf_runs):
+                runs[partition].extend(partition_runs)
+
+        tasks = [(m, runs[i], os.path.join(workdir, 'part%06d' % i), label_field) for i in range(workers)]
+        merge_shards(pool.imap(emit_partition, tasks), out, multi)
+    finally:
+        pool.close()
+        pool.join()
+    return samples
+
+def convert_to_profobuf(maf, vcf, out, multi, format, bioPrefix, variantPrefix, variantSetPrefix, callSetPrefix, variantAnnotationPrefix, transcriptEffectPrefix, hugoPrefix, typeField, centerCol, workers=1):
     if maf:
         m = MafConverter(
             bioPrefix=bioPrefix,
@@ -178,30 +457,27 @@ def convert_to_profobuf(maf, vcf, out, multi, format, bioPrefix, variantPrefix,
             typeField=typeField,
             centerCol=centerCol
         )
-        def emit_json_single(message):
-            if 'main' not in out_handles:
-                out_handles['main'] = open(out, 'w')
-            msg = json.loads(json_format.MessageToJson(message))
-            msg[typeField] = message.DESCRIPTOR.full_name
-            out_handles['main'].write(json.dumps(msg))
-            out_handles['main'].write("\n")
-        def emit_json_multi(message):
-            if message.DESCRIPTOR.full_name not in out_handles:
-                out_handles[message.DESCRIPTOR.full_name] = open(multi + '.' + message.DESCRIPTOR.full_name + '.json', 'w')
-            msg = json.loads(json_format.MessageToJson(message))
-            out_handles[message.DESCRIPTOR.full_name].write(json.dumps(msg))
-            out_handles[message.DESCRIPTOR.full_name].write('\n')
-
-        emit = emit_json_single if out else emit_json_multi
-        if os.path.isdir(maf):
-            for path in os.listdir(maf):
-                if path[-4:] == '.maf':
-                    m.convert(emit, maf + '/' + path)
-        else:
-            m.convert(emit, maf)
-
-    for handle in out_handles.values():
-        handle.close()
+        if out:
+            multi = None
+        label_field = typeField if out else None
+        paths = maf_paths(maf)
+        workdir = tempfile.mkdtemp(prefix='maf-index-', dir=os.path.dirname(os.path.abspath(out or multi)))
+        try:
+            if workers > 1:
+                samples = convert_parallel(m, paths, workdir, out, multi, workers, label_field)
+                # merged shards never hold CallSets, so the single output file is appended to
+                emit = emitter.JSONEmitter(out=out, multi=multi, label_field=label_field, mode='a' if out else 'w')
+            else:
+                emit = emitter.JSONEmitter(out=out, multi=multi, label_field=label_field)
+                index = VariantIndex(workdir)
+                samples = set()
+                for path in paths:
+                    samples.update(m.convert(index, path))
+                m.emit_variants(emit, index.groups())
+            m.emit_callsets(emit, samples)
+            emit.close()
+        finally:
+            shutil.rmtree(workdir)
 
 def parse_args(args):
     # We don't need the first argument, which is the program name
@@ -225,6 +501,7 @@ def parse_args(args):
     parser.add_argument('--transcriptEffectPrefix', default='transcriptEffect')
     parser.add_argument('--hugoPrefix', default='gene')
     parser.add_argument('--center', dest="centerCol", default='Center', help='caller field')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes converting maf files in parallel')
     
     parser.add_argument('--format', type=str, default='json', help='Format of output: json or pbf (binary)')
     return parser.parse_args(args)
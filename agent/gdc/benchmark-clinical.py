@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+'''
+Time the single pass tcga_clinical extractor against the minidom tree and
+the dom_scan walk per query path it replaced.
+
+Runs over directories of TCGA clinical and biospecimen XML files when they
+are given, otherwise over synthetic files shaped like them (namespaced
+elements, xsd_ver and preferred_name attributes, stage_event with tnm
+categories, samples down to aliquots, drugs, radiations and follow ups).
+Every file is read for all subtypes by both and the records have to match.
+
+example usage:
+
+    python agent/gdc/benchmark-clinical.py --clinical ~/Data/gdc/clinical --biospecimen ~/Data/gdc/biospecimen
+    python agent/gdc/benchmark-clinical.py --patients 300
+'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from cStringIO import StringIO
+from xml.dom.minidom import parseString
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import tcga_clinical
+
+WORDS = ['tumor', 'lung', 'adenocarcinoma', 'resection', 'biopsy', 'negative', 'positive', 'left', 'right', 'upper', 'lobe']
+
+NAMESPACES = (
+    'xmlns:admin="http://tcga.nci/bcr/xml/administration/2.7" '
+    'xmlns:shared="http://tcga.nci/bcr/xml/shared/2.7" '
+    'xmlns:clin_shared="http://tcga.nci/bcr/xml/clinical/shared/2.7" '
+    'xmlns:shared_stage="http://tcga.nci/bcr/xml/clinical/shared/stage/2.7" '
+    'xmlns:bio="http://tcga.nci/bcr/xml/biospecimen/2.7" '
+    'xmlns:rx="http://tcga.nci/bcr/xml/clinical/pharmaceutical/2.7" '
+    'xmlns:rad="http://tcga.nci/bcr/xml/clinical/radiation/2.7" '
+    'xmlns:follow_up="http://tcga.nci/bcr/xml/clinical/luad/followup/2.7/1.0"')
+
+def getText(nodelist):
+    rc = []
+    for node in nodelist:
+        if node.nodeType == node.TEXT_NODE:
+            rc.append(node.data)
+    return ''.join(rc)
+
+def dom_scan(node, query):
+    stack = query.split('/')
+    if node.localName == stack[0]:
+        return dom_scan_iter(node, stack[1:], [stack[0]])
+
+def dom_scan_iter(node, stack, prefix):
+    if len(stack):
+        for child in node.childNodes:
+                if child.nodeType == child.ELEMENT_NODE:
+                    if child.localName == stack[0]:
+                        for out in dom_scan_iter(child, stack[1:], prefix + [stack[0]]):
+                            yield out
+                    elif '*' == stack[0]:
+                        for out in dom_scan_iter(child, stack[1:], prefix + [child.localName]):
+                            yield out
+    else:
+        if node.nodeType == node.ELEMENT_NODE:
+            yield node, prefix, dict(node.attributes.items()), getText( node.childNodes )
+        elif node.nodeType == node.TEXT_NODE:
+            yield node, prefix, None, getText( node.childNodes )
+
+def extract_attribute(data, stack, attr, text):
+    if 'xsd_ver' in attr:
+        p_name = attr.get('preferred_name', stack[-1])
+        if len(p_name) == 0:
+            p_name = stack[-1]
+        data[p_name] = text
+
+def dom_records(raw):
+    '''
+    The records of every subtype the way the converters read them: a
+    minidom tree and one dom_scan per query path.
+    '''
+    root_node = parseString(raw).childNodes[0]
+    out = {}
+    admin = {}
+    for node, stack, attr, text in dom_scan(root_node, 'tcga_bcr/admin/*'):
+        admin[stack[-1]] = text
+    out['admin'] = [(None, admin)]
+
+    patient_barcode = None
+    for node, stack, attr, text in dom_scan(root_node, 'tcga_bcr/patient/bcr_patient_barcode'):
+        patient_barcode = text
+    patient_data = {}
+    for node, stack, attr, text in dom_scan(root_node, 'tcga_bcr/patient/*'):
+        extract_attribute(patient_data, stack, attr, text)
+    out['patient'] = [(patient_barcode, patient_data)]
+    stage_data = {}
+    for query in ['tcga_bcr/patient/stage_event/*', 'tcga_bcr/patient/stage_event/*/*', 'tcga_bcr/patient/stage_event/tnm_categories/*/*']:
+        for node, stack, attr, text in dom_scan(root_node, query):
+            extract_attribute(stage_data, stack, attr, text)
+    out['stage_event'] = [(patient_barcode, stage_data)]
+
+    for subtype, path, barcode_name in tcga_clinical.RECORDS[2:]:
+        records = []
+        for s_node, s_stack, s_attr, s_text in dom_scan(root_node, '/'.join(['tcga_bcr'] + path)):
+            barcode = None
+            for c_node, c_stack, c_attr, c_text in dom_scan(s_node, path[-1] + '/' + barcode_name):
+                barcode = c_text
+            data = {'sequence': s_attr['sequence']} if subtype == 'followup' else {}
+            for c_node, c_stack, c_attr, c_text in dom_scan(s_node, path[-1] + '/*'):
+                if 'xsd_ver' in c_attr:
+                    data[c_attr.get('preferred_name', c_stack[-1])] = c_text
+            records.append((barcode, data))
+        out[subtype] = records
+    return out
+
+def stream_records(handle):
+    out = dict((subtype, []) for subtype in tcga_clinical.SUBTYPES)
+    def record_write(subtype, barcode, data):
+        out[subtype].append((barcode, data))
+    tcga_clinical.parse_clinical(handle, tcga_clinical.SUBTYPES, record_write)
+    return out
+
+########################################
+
+def sentence(count):
+    return ' '.join(random.choice(WORDS) for i in range(count))
+
+def field(prefix, name, text, preferred_name=None):
+    if preferred_name is None:
+        preferred_name = random.choice(['', name])
+    return '<%s:%s display_order="%d" preferred_name="%s" xsd_ver="2.6">%s</%s:%s>' % (
+        prefix, name, random.randint(1, 9999), preferred_name, text, prefix, name)
+
+def fields(prefix, name, count):
+    return ''.join(field(prefix, '%s_%d' % (name, i), sentence(random.randint(1, 4))) for i in range(count))
+
+def admin(disease):
+    return ('<admin:admin><admin:bcr xsd_ver="1.17">Nationwide Children&apos;s Hospital</admin:bcr>'
+        '<admin:file_uuid xsd_ver="1.17">%08x-0000</admin:file_uuid><admin:batch_number xsd_ver="1.17">%d.1.0</admin:batch_number>'
+        '<admin:project_code xsd_ver="2.5">TCGA</admin:project_code><admin:disease_code xsd_ver="2.5">%s</admin:disease_code>'
+        '<admin:day_of_dcc_upload xsd_ver="1.17">%d</admin:day_of_dcc_upload></admin:admin>' % (
+            random.getrandbits(32), random.randint(1, 400), disease, random.randint(1, 28)))
+
+def patient_fields(barcode):
+    return ('<admin:additional_studies/>' + field('shared', 'bcr_patient_barcode', barcode, '') +
+        field('shared', 'tissue_source_site', barcode[5:7], '') +
+        field('shared', 'gender', random.choice(['MALE', 'FEMALE']), 'gender') +
+        '<shared:tumor_tissue_site xsd_ver="2.6" preferred_name="" display_order="9999">%s\n  <clin_shared:note>ignored</clin_shared:note>\n  &amp; %s</shared:tumor_tissue_site>' % (sentence(2), sentence(1)) +
+        '<clin_shared:race_list><clin_shared:race xsd_ver="2.6" preferred_name="race">WHITE</clin_shared:race></clin_shared:race_list>' +
+        fields('clin_shared', 'clinical', 60))
+
+def stage_event():
+    return ('<shared_stage:stage_event system="AJCC">' + field('shared_stage', 'system_version', '6th', 'ajcc_cancer_staging_handbook_edition') +
+        field('shared_stage', 'pathologic_stage', 'Stage IV', '') + field('shared_stage', 'gender', 'override', 'gender') +
+        '<shared_stage:tnm_categories><shared_stage:clinical_categories>' + fields('shared_stage', 'clinical_T', 3) +
+        '</shared_stage:clinical_categories><shared_stage:pathologic_categories>' + fields('shared_stage', 'pathologic', 4) +
+        '</shared_stage:pathologic_categories></shared_stage:tnm_categories></shared_stage:stage_event>')
+
+def clinical_file(barcode, disease):
+    out = ['<?xml version="1.0" encoding="UTF-8"?>\n<%s:tcga_bcr %s xmlns:%s="http://tcga.nci/bcr/xml/clinical/%s/2.7" schemaVersion="2.7">\n' % (disease.lower(), NAMESPACES, disease.lower(), disease.lower())]
+    out.append(admin(disease))
+    out.append('<%s:patient>' % disease.lower())
+    out.append(patient_fields(barcode))
+    out.append(stage_event())
+    out.append('<rx:drugs>%s</rx:drugs>' % ''.join(
+        '<rx:drug>%s%s</rx:drug>' % (field('rx', 'bcr_drug_barcode', '%s-D%d' % (barcode, d), ''), fields('rx', 'drug', 20))
+        for d in range(random.randint(0, 6))))
+    out.append('<rad:radiations>%s</rad:radiations>' % ''.join(
+        '<rad:radiation>%s%s</rad:radiation>' % (field('rad', 'bcr_radiation_barcode', '%s-R%d' % (barcode, r), ''), fields('rad', 'radiation', 15))
+        for r in range(random.randint(0, 3))))
+    out.append('<follow_up:follow_ups>%s</follow_up:follow_ups>' % ''.join(
+        '<follow_up:follow_up version="1.0" sequence="%d">%s%s</follow_up:follow_up>' % (f, field('shared', 'bcr_followup_barcode', '%s-F%d' % (barcode, f), ''), fields('follow_up', 'follow_up', 40))
+        for f in range(random.randint(0, 5))))
+    out.append('</%s:patient>\n</%s:tcga_bcr>\n' % (disease.lower(), disease.lower()))
+    return ''.join(out)
+
+def biospecimen_file(barcode, disease):
+    out = ['<?xml version="1.0" encoding="UTF-8"?>\n<bio:tcga_bcr %s schemaVersion="2.7">\n' % NAMESPACES]
+    out.append(admin(disease))
+    out.append('<bio:patient>')
+    out.append(field('shared', 'bcr_patient_barcode', barcode, '') + field('shared', 'tissue_source_site', barcode[5:7], ''))
+    out.append('<bio:samples>')
+    for s in range(random.randint(1, 3)):
+        sample = '%s-%02dA' % (barcode, s + 1)
+        out.append('<bio:sample>' + field('bio', 'bcr_sample_barcode', sample, '') + fields('bio', 'sample', 15) + '<bio:portions>')
+        for p in range(random.randint(1, 3)):
+            portion = '%s-%02d' % (sample, p + 11)
+            out.append('<bio:portion>' + field('bio', 'bcr_portion_barcode', portion, '') + fields('bio', 'portion', 8) + '<bio:analytes>')
+            for a in 'DRW'[:random.randint(1, 3)]:
+                analyte = portion + a
+                out.append('<bio:analyte>' + field('bio', 'bcr_analyte_barcode', analyte, '') + fields('bio', 'analyte', 10) + '<bio:aliquots>')
+                for q in range(random.randint(1, 4)):
+                    out.append('<bio:aliquot>' + field('bio', 'bcr_aliquot_barcode', '%s-%02d' % (analyte, q), '') + fields('bio', 'aliquot', 8) + '</bio:aliquot>')
+                out.append('</bio:aliquots></bio:analyte>')
+            out.append('</bio:analytes></bio:portion>')
+        out.append('</bio:portions></bio:sample>')
+    out.append('</bio:samples>' + field('shared', 'patient_id', barcode[8:], '') + '</bio:patient>\n</bio:tcga_bcr>\n')
+    return ''.join(out)
+
+def write_synthetic(path, patients):
+    for directory in ['clinical', 'biospecimen']:
+        os.makedirs(os.path.join(path, directory))
+    for i in range(patients):
+        barcode = 'TCGA-%02d-%04d' % (i % 90 + 1, i)
+        disease = random.choice(['LUAD', 'BRCA', 'GBM'])
+        with open(os.path.join(path, 'clinical', 'nationwidechildrens.org_clinical.%s.xml' % barcode), 'w') as handle:
+            handle.write(clinical_file(barcode, disease))
+        with open(os.path.join(path, 'biospecimen', 'nationwidechildrens.org_biospecimen.%s.xml' % barcode), 'w') as handle:
+            handle.write(biospecimen_file(barcode, disease))
+    return os.path.join(path, 'clinical'), os.path.join(path, 'biospecimen')
+
+def list_files(directories):
+    out = []
+    for directory in directories:
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.xml'):
+                out.append(os.path.join(directory, name))
+    return out
+
+def run(read, files):
+    results = []
+    start = time.time()
+    for path in files:
+        with open(path) as handle:
+            results.append(read(handle))
+    return time.time() - start, results
+
+def parse_args(args):
+    args = args[1:]
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clinical', help='directory of clinical XML files')
+    parser.add_argument('--biospecimen', help='directory of biospecimen XML files')
+    parser.add_argument('--patients', type=int, default=200, help='number of synthetic patients, one file of each kind')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(args)
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv)
+    random.seed(options.seed)
+
+    tmp = None
+    directories = [d for d in [options.clinical, options.biospecimen] if d]
+    if not directories:
+        tmp = tempfile.mkdtemp()
+        directories = write_synthetic(tmp, options.patients)
+
+    try:
+        files = list_files(directories)
+        old_time, old = run(lambda handle: dom_records(handle.read()), files)
+        new_time, new = run(stream_records, files)
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp)
+
+    for path, a, b in zip(files, old, new):
+        for subtype in tcga_clinical.SUBTYPES:
+            if a[subtype] != b[subtype]:
+                raise Exception('%s: %s records differ' % (path, subtype))
+    records = sum(len(r[s]) for r in new for s in tcga_clinical.SUBTYPES)
+    print('%d files, %d records' % (len(files), records))
+    print('%-14s %8.2fs %10.1f files/sec' % ('minidom scan', old_time, len(files) / old_time))
+    print('%-14s %8.2fs %10.1f files/sec' % ('single pass', new_time, len(files) / new_time))
+    print('%-14s %.2fx' % ('speedup', old_time / new_time))
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+'''
+Check and time the gdc_scan download engine against a local stand-in for
+the GDC data endpoint.
+
+Starts a threaded BaseHTTPServer that serves synthetic files at
+GDC_API_URL/data/<file_id>, answers Range requests with 206 and a range
+past the end with 416, and can cut a response short. Then checks that:
+
+    an interrupted download leaves a .part file that the next call resumes
+    with a Range request, ending with the right md5
+    a .part file that already holds every byte is finished on a 416
+    a .part file longer than the file is discarded on a 416, by the length
+    in its Content-Range, or by file_size when the 416 has none
+    a server that ignores Range restarts the file from the start
+    an md5 mismatch raises and removes the .part file
+    download_files retries a cut download, and a second run without a
+    manifest or md5sums skips the finished files by their size
+
+and times download_files over --files files of --size MB on --workers
+threads.
+
+example usage:
+
+    python agent/gdc/benchmark-download.py --files 16 --size 8 --workers 4
+'''
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.files = {}
+        # file_id -> bytes to send before closing, applied once
+        self.cut = {}
+        self.ignore_range = set()
+        self.no_content_range = set()
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_port
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        file_id = self.path.rstrip('/').split('/')[-1]
+        data = server.files.get(file_id)
+        requested = self.headers.getheader('Range')
+        with server.lock:
+            server.requests.append((file_id, requested))
+            cut = server.cut.pop(file_id, None)
+        if data is None:
+            self.send_error(404)
+            return
+
+        start = 0
+        if requested and file_id not in server.ignore_range:
+            start = int(requested.split('=')[1].split('-')[0])
+            if start >= len(data):
+                self.send_response(416)
+                if file_id not in server.no_content_range:
+                    self.send_header('Content-Range', 'bytes */%d' % len(data))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        body = data[start:]
+        if cut is not None:
+            body = body[:cut]
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_server():
+    server = StandInServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def synthetic_file(size):
+    return os.urandom(size)
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+def check(condition, message):
+    if not condition:
+        raise Exception('check failed: ' + message)
+    print('ok   ' + message)
+
+def check_resume(gdc_scan, server, directory):
+    data = synthetic_file(3 * 1024 * 1024 + 17)
+    server.files['resume'] = data
+    server.cut['resume'] = 1024 * 1024
+    path = os.path.join(directory, 'resume.bin')
+    error = None
+    try:
+        gdc_scan.download_file(path, 'resume', md5sum=md5(data), chunk_size=64 * 1024)
+    except IOError as e:
+        error = e
+    part = path + gdc_scan.PART_SUFFIX
+    check(error is not None and os.path.getsize(part) == 1024 * 1024 and not os.path.exists(path), 'an interrupted download raises and leaves its .part file')
+    del server.requests[:]
+    digest = gdc_scan.download_file(path, 'resume', md5sum=md5(data), chunk_size=64 * 1024)
+    check(server.requests == [('resume', 'bytes=%d-' % (1024 * 1024))], 'the next download resumes with a Range request')
+    check(digest == md5(data) and open(path, 'rb').read() == data and not os.path.exists(part), 'the resumed file has the right md5 and is renamed into place')
+
+def check_complete_part(gdc_scan, server, directory):
+    data = synthetic_file(100000)
+    server.files['whole'] = data
+    path = os.path.join(directory, 'whole.bin')
+    with open(path + gdc_scan.PART_SUFFIX, 'wb') as handle:
+        handle.write(data)
+    del server.requests[:]
+    gdc_scan.download_file(path, 'whole', md5sum=md5(data))
+    check(server.requests == [('whole', 'bytes=100000-')] and open(path, 'rb').read() == data, 'a complete .part file is finished on a 416')
+
+def check_oversized_part(gdc_scan, server, directory):
+    data = synthetic_file(100000)
+    server.files['oversized'] = data
+    path = os.path.join(directory, 'oversized.bin')
+    with open(path + gdc_scan.PART_SUFFIX, 'wb') as handle:
+        handle.write(data + synthetic_file(3000))
+    del server.requests[:]
+    gdc_scan.download_file(path, 'oversized')
+    check(server.requests == [('oversized', 'bytes=103000-'), ('oversized', None)] and open(path, 'rb').read() == data,
+        'a .part file longer than the file is downloaded again on a 416')
+
+    server.no_content_range.add('oversized')
+    os.remove(path)
+    with open(path + gdc_scan.PART_SUFFIX, 'wb') as handle:
+        handle.write(data + synthetic_file(3000))
+    gdc_scan.download_file(path, 'oversized', file_size=len(data))
+    check(open(path, 'rb').read() == data, 'without a Content-Range the .part file is checked against file_size')
+
+def check_ignored_range(gdc_scan, server, directory):
+    data = synthetic_file(200000)
+    server.files['norange'] = data
+    server.ignore_range.add('norange')
+    path = os.path.join(directory, 'norange.bin')
+    with open(path + gdc_scan.PART_SUFFIX, 'wb') as handle:
+        handle.write(data[:5000])
+    gdc_scan.download_file(path, 'norange', md5sum=md5(data))
+    check(open(path, 'rb').read() == data, 'a server ignoring Range restarts the file')
+
+def check_md5_mismatch(gdc_scan, server, directory):
+    server.files['corrupt'] = synthetic_file(50000)
+    path = os.path.join(directory, 'corrupt.bin')
+    error = None
+    try:
+        gdc_scan.download_file(path, 'corrupt', md5sum='0' * 32)
+    except Exception as e:
+        error = str(e)
+    check(error is not None and error.startswith('md5 mismatch') and not os.path.exists(path) and not os.path.exists(path + gdc_scan.PART_SUFFIX),
+        'an md5 mismatch raises and removes the .part file')
+
+def file_records(server, directory, count, size, prefix):
+    records = []
+    for i in range(count):
+        file_id = '%s-%04d' % (prefix, i)
+        data = synthetic_file(size)
+        server.files[file_id] = data
+        records.append({'file_id': file_id, 'file_name': os.path.join(directory, file_id + '.bin'),
+            'md5sum': md5(data), 'file_size': len(data)})
+    return records
+
+def check_download_files(gdc_scan, server, directory):
+    records = file_records(server, directory, 6, 300000, 'pool')
+    server.cut[records[2]['file_id']] = 1000
+    manifest = gdc_scan.Manifest(os.path.join(directory, 'manifest.tsv'))
+    failures = gdc_scan.download_files(records, workers=3, manifest=manifest)
+    check(not failures and all(open(r['file_name'], 'rb').read() == server.files[r['file_id']] for r in records), 'download_files retries a cut download')
+
+    del server.requests[:]
+    for r in records:
+        del r['md5sum']
+    failures = gdc_scan.download_files(records, workers=3, manifest=gdc_scan.Manifest(None))
+    check(not failures and not server.requests, 'finished files without md5sums are skipped by their size')
+
+def parse_args(args):
+    args = args[1:]
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=16, help='number of files to time')
+    parser.add_argument('--size', type=int, default=8, help='size of each file in MB')
+    parser.add_argument('--workers', type=int, default=4)
+    return parser.parse_args(args)
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv)
+    server = start_server()
+    os.environ['GDC_API_URL'] = server.url()
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import gdc_scan
+
+    directory = tempfile.mkdtemp()
+    try:
+        for step in [check_resume, check_complete_part, check_oversized_part, check_ignored_range, check_md5_mismatch, check_download_files]:
+            step(gdc_scan, server, directory)
+
+        records = file_records(server, directory, options.files, options.size * 1024 * 1024, 'timed')
+        start = time.time()
+        failures = gdc_scan.download_files(records, workers=options.workers)
+        elapsed = time.time() - start
+        check(not failures, 'timed downloads finished')
+        total = options.files * options.size
+        print('%d files, %d MB on %d workers: %.2fs, %.1f MB/s' % (options.files, total, options.workers, elapsed, total / elapsed))
+    finally:
+        shutil.rmtree(directory)
+        server.shutdown()
@@ -7,47 +7,22 @@
 
 import os
 import re
-import json
+import sys
 from copy import deepcopy
 import argparse
-from xml.dom.minidom import parseString
-from google.protobuf import json_format
 
 from ga4gh import bio_metadata_pb2
 from bmeg import matrix_pb2
 
-def getText(nodelist):
-    rc = []
-    for node in nodelist:
-        if node.nodeType == node.TEXT_NODE:
-            rc.append(node.data)
-    return ''.join(rc)
-
-def dom_scan(node, query):
-    stack = query.split('/')
-    if node.localName == stack[0]:
-        return dom_scan_iter(node, stack[1:], [stack[0]])
-
-def dom_scan_iter(node, stack, prefix):
-    if len(stack):
-        for child in node.childNodes:
-                if child.nodeType == child.ELEMENT_NODE:
-                    if child.localName == stack[0]:
-                        for out in dom_scan_iter(child, stack[1:], prefix + [stack[0]]):
-                            yield out
-                    elif '*' == stack[0]:
-                        for out in dom_scan_iter(child, stack[1:], prefix + [child.localName]):
-                            yield out
-    else:
-        if node.nodeType == node.ELEMENT_NODE:
-            yield node, prefix, dict(node.attributes.items()), getText( node.childNodes )
-        elif node.nodeType == node.TEXT_NODE:
-            yield node, prefix, None, getText( node.childNodes )
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import emitter
+import tcga_clinical
 
 def record_initial_state(generators):
     state = {}
     state['types'] = generators.keys()
     state['generators'] = generators
+    state['failures'] = []
     for key in generators:
         state[key] = {}
 
@@ -64,16 +39,11 @@ def process_input(state, path, process):
 
     return state
 
-def message_to_json(message):
-    msg = json.loads(json_format.MessageToJson(message))
-    msg['#label'] = message.DESCRIPTOR.name
-    return json.dumps(msg)
-
 def output_state(state, path):
     for type in state['types']:
         json = []
         for key in state[type]:
-            message = message_to_json(state[type][key])
+            message = emitter.message_to_json(state[type][key], '#label')
             json.append(message)
         out = '\n'.join(json)
         outpath = 'tcga.' + type + '.json'
@@ -194,117 +164,71 @@ class BiosampleGenerator(RecordGenerator):
 
         return sample
 
-def extract_attribute(data, stack, attr, text):
-    if 'xsd_ver' in attr:
-        p_name = attr.get('preferred_name', stack[-1])
-        if len(p_name) == 0:
-            p_name = stack[-1]
-        data[p_name] = text
+# subtype -> tcga_clinical subtypes to read
+SUBTYPES = {
+    'Individual': ['admin', 'patient', 'stage_event'],
+    'Biosample': ['admin', 'patient', 'sample'],
+    'portion': ['portion'],
+    'analyte': ['analyte'],
+    'aliquot': ['aliquot'],
+    'drug': ['drug'],
+    'radiation': ['radiation'],
+    'followup': ['followup']
+}
+
+# record subtype -> generator, for the records emitted as they are
+RECORD_TYPES = {
+    'portion': 'Portion',
+    'analyte': 'Analyte',
+    'aliquot': 'Aliquot',
+    'drug': 'Drug',
+    'radiation': 'Radiation',
+    'followup': 'Followup'
+}
 
 class ClinicalParser:
     def __init__(self):
         pass
-    
-    def parseXMLFile(self, state, dom, subtype):
-        root_node = dom.childNodes[0]
-        admin = {}
-        for node, stack, attr, text in dom_scan(root_node, 'tcga_bcr/admin/*'):
-            admin[stack[-1]] = text
-        
+
+    def readXMLFile(self, handle, subtype):
+        '''
+        The records of one file in a single pass, as (subtype, barcode, data).
+        '''
+        records = []
+        def record_write(name, barcode, data):
+            records.append((name, barcode, data))
+        tcga_clinical.parse_clinical(handle, SUBTYPES[subtype], record_write)
+        return records
+
+    def parseXMLFile(self, state, handle, subtype):
+        # the whole file is read before the state changes, so a file that
+        # fails to parse adds nothing
+        records = self.readXMLFile(handle, subtype)
+
         patient_barcode = None
-        for node, stack, attr, text in dom_scan(root_node, 'tcga_bcr/patient/bcr_patient_barcode'):
-            patient_barcode = text
-        
-        patient_data = admin
-        for node, stack, attr, text in dom_scan(root_node, 'tcga_bcr/patient/*'):
-            extract_attribute(patient_data, stack, attr, text)
+        patient_data = {}
+        for name, barcode, data in records:
+            if name in ['admin', 'patient']:
+                patient_data.update(data)
+            if name == 'patient':
+                patient_barcode = barcode
 
         if subtype == 'Individual':
-            for node, stack, attr, text in dom_scan(root_node, 'tcga_bcr/patient/stage_event/*'):
-                extract_attribute(patient_data, stack, attr, text)
-            for node, stack, attr, text in dom_scan(root_node, 'tcga_bcr/patient/stage_event/*/*'):
-                extract_attribute(patient_data, stack, attr, text)
-            for node, stack, attr, text in dom_scan(root_node, 'tcga_bcr/patient/stage_event/tnm_categories/*/*'):
-                extract_attribute(patient_data, stack, attr, text)
+            for name, barcode, data in records:
+                if name == 'stage_event':
+                    patient_data.update(data)
             self.emit( state, patient_barcode, patient_data, subtype )
-        
+
         if subtype == 'Biosample':
-            for s_node, s_stack, s_attr, s_text in dom_scan(root_node, 'tcga_bcr/patient/samples/sample'):
-                sample_barcode = None
-                for c_node, c_stack, c_attr, c_text in dom_scan(s_node, 'sample/bcr_sample_barcode'):
-                    sample_barcode = c_text
-                sample_data = deepcopy(patient_data)
-                for c_node, c_stack, c_attr, c_text in dom_scan(s_node, 'sample/*'):
-                    if 'xsd_ver' in c_attr:
-                        sample_data[c_attr.get('preferred_name', c_stack[-1])] = c_text
-                self.emit( state, sample_barcode, sample_data, subtype )
-
-        if subtype == 'portion':
-            for s_node, s_stack, s_attr, s_text in dom_scan(root_node, 'tcga_bcr/patient/samples/sample/portions/portion'):
-                portion_barcode = None
-                for c_node, c_stack, c_attr, c_text in dom_scan(s_node, 'portion/bcr_portion_barcode'):
-                    portion_barcode = c_text
-                portion_data = {}    
-                for c_node, c_stack, c_attr, c_text in dom_scan(s_node, 'portion/*'):
-                    if 'xsd_ver' in c_attr:
-                        portion_data[c_attr.get('preferred_name', c_stack[-1])] = c_text
-                self.emit( state, portion_barcode, portion_data, 'Portion' )
-        
-        if subtype == 'analyte':
-            for s_node, s_stack, s_attr, s_text in dom_scan(root_node, 'tcga_bcr/patient/samples/sample/portions/portion/analytes/analyte'):
-                analyte_barcode = None
-                for c_node, c_stack, c_attr, c_text in dom_scan(s_node, 'analyte/bcr_analyte_barcode'):
-                    analyte_barcode = c_text
-                analyte_data = {}    
-                for c_node, c_stack, c_attr, c_text in dom_scan(s_node, 'analyte/*'):
-                    if 'xsd_ver' in c_attr:
-                        analyte_data[c_attr.get('preferred_name', c_stack[-1])] = c_text
-                self.emit( state, analyte_barcode, analyte_data, 'Analyte' )
-
-        if subtype == 'aliquot':
-            for s_node, s_stack, s_attr, s_text in dom_scan(root_node, 'tcga_bcr/patient/samples/sample/portions/portion/analytes/analyte/aliquots/aliquot'):
-                aliquot_barcode = None
-                for c_node, c_stack, c_attr, c_text in dom_scan(s_node, 'aliquot/bcr_aliquot_barcode'):
-                    aliquot_barcode = c_text
-                aliquot_data = {}    
-                for c_node, c_stack, c_attr, c_text in dom_scan(s_node, 'aliquot/*'):
-                    if 'xsd_ver' in c_attr:
-                        aliquot_data[c_attr.get('preferred_name', c_stack[-1])] = c_text
-                self.emit( state, aliquot_barcode, aliquot_data, 'Aliquot' )
-        
-        if subtype == 'drug':
-            for s_node, s_stack, s_attr, s_text in dom_scan(root_node, 'tcga_bcr/patient/drugs/drug'):
-                drug_barcode = None
-                for c_node, c_stack, c_attr, c_text in dom_scan(s_node, 'drug/bcr_drug_barcode'):
-                    drug_barcode = c_text
-                drug_data = {}    
-                for c_node, c_stack, c_attr, c_text in dom_scan(s_node, 'drug/*'):
-                    if 'xsd_ver' in c_attr:
-                        drug_data[c_attr.get('preferred_name', c_stack[-1])] = c_text
-                self.emit( state, drug_barcode, drug_data, 'Drug' )
-
-        if subtype == 'radiation':
-            for s_node, s_stack, s_attr, s_text in dom_scan(root_node, 'tcga_bcr/patient/radiations/radiation'):
-                radiation_barcode = None
-                for c_node, c_stack, c_attr, c_text in dom_scan(s_node, 'radiation/bcr_radiation_barcode'):
-                    radiation_barcode = c_text
-                radiation_data = {}    
-                for c_node, c_stack, c_attr, c_text in dom_scan(s_node, 'radiation/*'):
-                    if 'xsd_ver' in c_attr:
-                        radiation_data[c_attr.get('preferred_name', c_stack[-1])] = c_text
-                self.emit( state, radiation_barcode, radiation_data, 'Radiation' )
-
-        if subtype == 'followup':
-            for s_node, s_stack, s_attr, s_text in dom_scan(root_node, 'tcga_bcr/patient/follow_ups/follow_up'):
-                follow_up_barcode = None
-                sequence = s_attr['sequence']
-                for c_node, c_stack, c_attr, c_text in dom_scan(s_node, 'follow_up/bcr_followup_barcode'):
-                    follow_up_barcode = c_text
-                follow_up_data = { 'sequence' : sequence}
-                for c_node, c_stack, c_attr, c_text in dom_scan(s_node, 'follow_up/*'):
-                    if 'xsd_ver' in c_attr:
-                        follow_up_data[c_attr.get('preferred_name', c_stack[-1])] = c_text
-                self.emit( state, follow_up_barcode, follow_up_data, 'Followup' )
+            for name, barcode, data in records:
+                if name == 'sample':
+                    sample_data = deepcopy(patient_data)
+                    sample_data.update(data)
+                    self.emit( state, barcode, sample_data, subtype )
+
+        for name, barcode, data in records:
+            if name in RECORD_TYPES:
+                self.emit( state, barcode, data, RECORD_TYPES[name] )
 
         return state
 
@@ -328,16 +252,14 @@ def initial_state():
 
 def build_processor(extract, subtype):
     def process(state, file):
-        raw = file.read()
+        print('parsing', file.name)
         try:
-            print('parsing', file.name)
-            dom = parseString(raw)
-        except:
-            dom = None
-                        
-        if dom:
-            return extract.parseXMLFile(state, dom, subtype)
-        else:
+            return extract.parseXMLFile(state, file, subtype)
+        except Exception as e:
+            # one bad file is reported and skipped, it does not end the run
+            failure = {'file': file.name, 'exception': '%s: %s' % (type(e).__name__, e)}
+            print('failed %(file)s: %(exception)s' % failure)
+            state['failures'].append(failure)
             return state
 
     return process
@@ -363,3 +285,5 @@ if __name__ == '__main__':
     process_input(state, args.biospecimen, process_biosample)
     extract_cohorts(state)
     output_state(state, args.output)
+    if state['failures']:
+        print('%d files failed to parse' % len(state['failures']))
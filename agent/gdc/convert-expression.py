@@ -1,21 +1,29 @@
 #!/usr/bin/env python
 
+import io
 import os
 import re
 import sys
 import csv
 import gzip
 import json
+import shutil
 import string
 import argparse
+import multiprocessing
 from sets import Set
 from pprint import pprint
-from google.protobuf import json_format
+
+import numpy
+import pandas
 
 import ga4gh.bio_metadata_pb2
 import bmeg.matrix_pb2
 import gdc_scan as scan
-from google.protobuf import json_format
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import emitter
+import expression_store
 
 # example usage:
 # python -m convert.gdc.convert-expression --ensembl ~/Data/hugo/ensembl.json --path ~/Data/gdc/prad/source/ --out ~/Data/gdc/prad/schema/prad-expression.json --tree ~/Data/gdc/gene-expression-file-samples.json
@@ -50,81 +58,252 @@ def ensembl_hugo(path):
     with open(path) as ensembl:
         return json.loads(ensembl.read())
 
-def translate_values(ensembl, raw):
-    expression = {}
+class ExpressionError(Exception):
+    def __init__(self, message, line=None):
+        super(ExpressionError, self).__init__(message)
+        self.line = line
+
+def open_expression(path):
+    if path[-3:] == '.gz':
+        return io.BufferedReader(gzip.open(path, 'rb'), emitter.BUFFER_SIZE)
+    return open(path, 'rb', emitter.BUFFER_SIZE)
 
-    symbols = []
-    for line in raw.split('\n'):
-        parts = line.split('\t')
+def scan_values(lines):
+    ids = []
+    values = []
+
+    for number, line in enumerate(lines, 1):
+        parts = line.rstrip('\r\n').split('\t')
         if len(parts) > 1:
+            if len(parts) != 2:
+                raise ExpressionError('expected 2 columns, found %d' % len(parts), number)
             full_symbol, value = parts
-            symbol = full_symbol.split('.')[0]
-            symbols.append(symbol)
-            if symbol in ensembl:
-                expression[ensembl[symbol]] = float(value)
-            else:
-                pass # print('symbol not found: ' + symbol)
+            try:
+                values.append(float(value))
+            except ValueError as e:
+                raise ExpressionError(str(e), number)
+            ids.append(full_symbol)
 
-    return expression
+    return numpy.array(ids, dtype=object), numpy.array(values, dtype=numpy.float64)
 
-def process_expression(tree, ensembl, file, raw, emit):
-    print('processing ' + file)
+def read_values(path):
+    """
+    Parse an FPKM file into an array of ensembl ids and an array of values
+    with the pandas C parser. Anything it rejects is scanned again line by
+    line, so a bad file is reported with the line it failed on.
+    """
+    try:
+        with open_expression(path) as handle:
+            frame = pandas.read_csv(handle, sep='\t', header=None, dtype={0: object, 1: numpy.float64}, float_precision='round_trip')
+        if frame.shape[1] == 2:
+            return frame[0].values, frame[1].values
+    except ValueError:
+        pass
+
+    with open_expression(path) as handle:
+        return scan_values(handle)
+
+class GeneOrder(object):
+    """
+    The ensembl ids of an FPKM file resolved to HUGO symbols. Files from the
+    same GDC pipeline list genes in the same order, so the lookup is done
+    once and take() reorders every file's values with a single index.
+    When the same symbol appears twice the later row wins.
+    """
+
+    def __init__(self, ensembl, ids, columns=None):
+        self.ids = ids
+        rows = {}
+        for row, full_symbol in enumerate(ids):
+            symbol = ensembl.get(full_symbol.split('.')[0])
+            if symbol is not None:
+                rows[symbol] = row
+        self.genes = sorted(rows)
+        self.index = numpy.array([rows[gene] for gene in self.genes], dtype=numpy.intp)
+        self.columns = None
+        if columns is not None:
+            self.columns = numpy.array([columns[gene] for gene in self.genes], dtype=numpy.intp)
+
+    def matches(self, ids):
+        return len(ids) == len(self.ids) and bool((ids == self.ids).all())
+
+    def take(self, values):
+        return values[self.index]
+
+def sample_row(tree, file):
+    sample = tree[file]['samples'][0]
+    biosample_id = 'biosample:' + tree[file]['project_id'] + ':' + sample['submitter_id']
+    return biosample_id, sample['sample_type'], file
+
+def process_expression(tree, file, genes, values):
+    biosample_id, sample_type, file = sample_row(tree, file)
 
-    if file in tree:
-        sample = tree[file]['samples'][0]
-        expression = translate_values(ensembl, raw)
-        
-        out = bmeg.matrix_pb2.GeneExpression()
-        for k,v in expression.items():
-            if v != 0.0:
-                out.expressions[k] = v
-        out.biosample_id = 'biosample:' + tree[file]['project_id'] + ':' + sample['submitter_id']
-        out.type = sample['sample_type']
-        emit(out)
-        
-
-def convert_expression(path, ensembl, tree, emit):
+    out = bmeg.matrix_pb2.GeneExpression()
+    expressions = out.expressions
+    floats = values.tolist()
+    for i in numpy.flatnonzero(values).tolist():
+        expressions[genes[i]] = floats[i]
+    out.biosample_id = biosample_id
+    out.type = sample_type
+    return out
+
+MATRIX_DTYPE = numpy.dtype('<f4')
+
+def matrix_columns(ensembl):
+    genes = sorted(set(ensembl.values()))
+    return genes, dict((gene, column) for column, gene in enumerate(genes))
+
+class MatrixWriter(object):
     """
-    def sample_gid(data):
-        return 'biosample:' + data['sample']['submitter_id']
-
-    state = {
-        'GeneExpression': {},
-        'types': ['GeneExpression'],
-        'generators': {
-            'expression': ExpressionGenerator(sample_gid)
+    Dense samples x genes float32 output. Rows go to prefix.npy, which
+    numpy.load can memory map, with one line per row in prefix.samples.tsv
+    (biosample id, sample type, file) and one line per column in
+    prefix.genes.tsv. Genes a file does not measure are NaN. Rows are
+    spooled to a scratch file until close, since the number of files that
+    convert is only known at the end.
+    """
+
+    def __init__(self, prefix, genes):
+        self.prefix = prefix
+        self.genes = genes
+        self.count = 0
+        self.rows = open(prefix + '.rows', 'wb', emitter.BUFFER_SIZE)
+        self.samples = open(prefix + '.samples.tsv', 'w')
+
+    def add(self, sample, row):
+        self.samples.write('\t'.join(sample) + '\n')
+        self.rows.write(row.astype(MATRIX_DTYPE, copy=False).tobytes())
+        self.count += 1
+
+    def close(self):
+        self.rows.close()
+        self.samples.close()
+        with open(self.prefix + '.genes.tsv', 'w') as genes:
+            for gene in self.genes:
+                genes.write(gene + '\n')
+
+        header = {
+            'descr': numpy.lib.format.dtype_to_descr(MATRIX_DTYPE),
+            'fortran_order': False,
+            'shape': (self.count, len(self.genes))
         }
-    }
+        with open(self.prefix + '.npy', 'wb') as out:
+            numpy.lib.format.write_array_header_1_0(out, header)
+            with open(self.prefix + '.rows', 'rb') as rows:
+                shutil.copyfileobj(rows, out, emitter.BUFFER_SIZE)
+        os.remove(self.prefix + '.rows')
+
+# set in each worker process by init_worker, so the tree and ensembl map are
+# not pickled for every file
+WORKER_STATE = {}
+
+def init_worker(tree, ensembl, columns=None, json_lines=True):
+    WORKER_STATE['tree'] = tree
+    WORKER_STATE['ensembl'] = ensembl
+    WORKER_STATE['columns'] = columns
+    WORKER_STATE['json'] = json_lines
+    WORKER_STATE['order'] = None
+
+def gene_order(ids):
+    order = WORKER_STATE['order']
+    if order is None or not order.matches(ids):
+        order = GeneOrder(WORKER_STATE['ensembl'], ids, WORKER_STATE['columns'])
+        WORKER_STATE['order'] = order
+    return order
+
+def convert_file(path):
     """
-    
-    files = os.listdir(path)
-    failed = []
+    Convert one expression file. Returns (file, line, sample, row, failure):
+    the JSON line if json output is on, the sample_row key and dense matrix
+    row if matrix columns were given, and on error a dict naming the
+    exception and the input line it was raised on.
+    """
+    file = os.path.basename(path)
+    print('processing ' + file)
+    try:
+        ids, values = read_values(path)
+        order = gene_order(ids)
+        expression = order.take(values)
 
-    print('iterating through files')
-    for file in files:
+        line = None
+        if WORKER_STATE['json']:
+            out = process_expression(WORKER_STATE['tree'], file, order.genes, expression)
+            line = emitter.message_to_json(out, '#label')
+
+        sample = None
+        row = None
+        if order.columns is not None:
+            sample = sample_row(WORKER_STATE['tree'], file)
+            row = numpy.empty(len(WORKER_STATE['columns']), dtype=MATRIX_DTYPE)
+            row.fill(numpy.nan)
+            row[order.columns] = expression
+
+        return file, line, sample, row, None
+    except Exception as e:
+        failure = {
+            'file': file,
+            'exception': '%s: %s' % (type(e).__name__, e),
+            'line': getattr(e, 'line', None)
+        }
+        return file, None, None, None, failure
+
+def expression_files(path, tree):
+    files = []
+    skipped = []
+    for file in sorted(os.listdir(path)):
         if re.search(r'\.FPKM\.', file):
-            opener = open
-            if file[-3:] == '.gz':
-                opener = gzip.open
+            if file in tree:
+                files.append(os.path.join(path, file))
+            else:
+                skipped.append(file)
+    return files, skipped
 
-            try:
-                with opener(os.path.join(path, file), 'rb') as f:
-                    process_expression(tree, ensembl, file, f.read(), emit)
-            except:
-               failed.append(file)
+def convert_expression(path, ensembl, tree, handle=None, workers=1, matrices=[], columns=None):
+    """
+    Convert every FPKM file under path, in file name order, on `workers`
+    processes. GeneExpression lines go to handle, if given, and dense rows
+    to each of the matrix writers (MatrixWriter or an expression store).
+    Returns the list of failures, one dict with file, exception and line
+    per file.
+    """
+    files, skipped = expression_files(path, tree)
+    if skipped:
+        print('skipping %d files not found in the tree' % len(skipped))
 
-    print('failed!\n' + str(failed))
+    state = (tree, ensembl, columns if matrices else None, handle is not None)
+    print('iterating through files')
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, init_worker, state)
+        results = pool.imap(convert_file, files, chunksize=4)
+    else:
+        pool = None
+        init_worker(*state)
+        results = (convert_file(f) for f in files)
 
-    return state
+    failures = []
+    try:
+        for file, line, sample, row, failure in results:
+            if failure is not None:
+                failures.append(failure)
+                continue
+            if handle is not None:
+                handle.write(line + '\n')
+            for matrix in matrices:
+                matrix.add(sample, row)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-def message_to_json(message):
-    msg = json.loads(json_format.MessageToJson(message))
-    msg['#label'] = message.DESCRIPTOR.name
-    return json.dumps(msg)
+    return failures
 
 def convert(options):
+    if not (options.out or options.matrix or options.store):
+        raise ValueError('one of --out, --matrix or --store is required')
+
     print('fetching tree')
     if options.tree == 'gdc':
+        scan.configure_cache(options.cache_dir, offline=options.offline)
         tree = file_tree()
     else:
         with open(options.tree) as tree_file:
@@ -132,11 +311,31 @@ def convert(options):
 
     print('mapping ensembl to hugo')
     ensembl = ensembl_hugo(options.ensembl)
-    handle = open(options.out, "w")
-    def emit(record):
-        handle.write(message_to_json(record) + "\n")
-    convert_expression(options.path, ensembl, tree, emit)
-    handle.close()
+
+    handle = None
+    matrices = []
+    genes, columns = matrix_columns(ensembl)
+    if options.out:
+        handle = open(options.out, 'w', emitter.BUFFER_SIZE)
+    if options.matrix:
+        matrices.append(MatrixWriter(options.matrix, genes))
+    if options.store:
+        matrices.append(expression_store.StoreWriter(options.store, genes))
+
+    try:
+        failures = convert_expression(options.path, ensembl, tree, handle, workers=options.workers, matrices=matrices, columns=columns)
+    finally:
+        if handle is not None:
+            handle.close()
+        for matrix in matrices:
+            matrix.close()
+
+    for failure in failures:
+        print('failed %(file)s at line %(line)s: %(exception)s' % failure)
+    if options.failures:
+        with open(options.failures, 'w') as report:
+            json.dump(failures, report, indent=2)
+    return failures
 
 def parse_args(args):
     args = args[1:]
@@ -145,7 +344,13 @@ def parse_args(args):
     parser.add_argument('--ensembl', type=str, help='path to ensembl to hugo mapping')
     parser.add_argument('--path', type=str, help='path to expression files')
     parser.add_argument('--out', type=str, help='path to output file')
+    parser.add_argument('--matrix', type=str, help='prefix for a dense samples x genes float32 matrix (.npy, .samples.tsv, .genes.tsv)')
+    parser.add_argument('--store', type=str, help='directory to write a columnar expression store')
     parser.add_argument('--tree', type=str, default='gdc', help='path to case tree')
+    parser.add_argument('--cache-dir', type=str, help='cache GDC API responses in this directory')
+    parser.add_argument('--offline', action='store_true', help='build the gdc tree only from cached responses')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes converting files in parallel')
+    parser.add_argument('--failures', type=str, help='path to write a json report of the files that failed')
     
     return parser.parse_args(args)
 
@@ -1,13 +1,35 @@
 #!/usr/bin/env python
 
 import os
+import re
 import json
+import time
+import hashlib
+import tempfile
 import argparse
 import requests
+import itertools
+import threading
+import collections
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from multiprocessing.pool import ThreadPool
 from pprint import pformat, pprint
 
-URL_BASE="https://gdc-api.nci.nih.gov/v0/"
-LEGACY_BASE="https://gdc-api.nci.nih.gov/v0/legacy/"
+# GDC_API_URL points the scanner at another server, such as a local stand-in
+URL_BASE=os.environ.get('GDC_API_URL', "https://gdc-api.nci.nih.gov/v0/")
+LEGACY_BASE=URL_BASE + "legacy/"
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+PART_SUFFIX = '.part'
+
+# pages fetched ahead of the consumer by gdc_paginate
+PREFETCH = 4
+RETRIES = 5
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gdc_scan')
+CACHE_TTL = 7 * 24 * 60 * 60
+CACHE_MAX_BYTES = 1 << 30
 
 PROJECTS="projects"
 FILES="files"
@@ -41,41 +63,169 @@ def expand_filter(d):
         content = {'field': field, 'value': value}
     return {'op': op, 'content': content}
 
+def gdc_session(pool_size=PREFETCH, retries=RETRIES):
+    """
+    A keep-alive Session that retries failed connections and throttled or
+    failing responses with exponential backoff.
+    """
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+SESSION = gdc_session()
+
+class ResponseCache(object):
+    """
+    Content addressed store of GDC API responses on disk. Entries older than
+    `ttl` seconds are refetched unless the cache is offline, in which case
+    any stored response is served and a missing one is an error. Once the
+    cache holds more than `max_bytes`, the oldest entries are evicted.
+    """
+
+    def __init__(self, path, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES, offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.size = sum(os.path.getsize(p) for p, mtime in self.entries())
+
+    def key(self, url, params):
+        # the full url, so responses from another GDC_API_URL are not reused
+        normalized = json.dumps([url, params], sort_keys=True)
+        return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def entries(self):
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                if name.endswith('.json'):
+                    p = os.path.join(root, name)
+                    yield p, os.path.getmtime(p)
+
+    def get(self, key):
+        p = self.entry_path(key)
+        try:
+            if not self.offline and time.time() - os.path.getmtime(p) > self.ttl:
+                return None
+            with open(p) as handle:
+                return json.load(handle)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, response):
+        p = self.entry_path(key)
+        directory = os.path.dirname(p)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+        handle, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(handle, 'w') as out:
+            json.dump(response, out)
+        previous = os.path.getsize(p) if os.path.exists(p) else 0
+        os.rename(temp, p)
+        with self.lock:
+            self.size += os.path.getsize(p) - previous
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # drop the oldest entries until the cache is back under 90% of its limit
+        for p, mtime in sorted(self.entries(), key=lambda e: e[1]):
+            if self.size <= self.max_bytes * 0.9:
+                break
+            size = os.path.getsize(p)
+            os.remove(p)
+            self.size -= size
+
+CACHE = None
+
+def configure_cache(cache_dir=None, offline=False, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES):
+    global CACHE
+    if cache_dir or offline:
+        CACHE = ResponseCache(cache_dir or DEFAULT_CACHE_DIR, ttl=ttl, max_bytes=max_bytes, offline=offline)
+    else:
+        CACHE = None
+    return CACHE
+
 def gdc_request(endpoint, params={}, legacy=False):
     base = (LEGACY_BASE if legacy else URL_BASE)
     url = base + endpoint
     default = {'size': 1000, 'expand': []}
     all_params = merge(default, params)
+
+    if CACHE is not None:
+        key = CACHE.key(url, all_params)
+        cached = CACHE.get(key)
+        if cached is not None:
+            return cached
+        if CACHE.offline:
+            raise Exception('offline and no cached response for %s %s' % (url, json.dumps(all_params, sort_keys=True)))
+
     all_params['expand'] = ','.join(all_params['expand'])
     if 'filters' in all_params:
         all_params['filters'] = json.dumps(expand_filter(all_params['filters']))
     if 'fields' in all_params:
         all_params['fields'] = ','.join(all_params['fields'])
 
-    request = requests.get(url, params=all_params)
+    request = SESSION.get(url, params=all_params)
     # print(request.url)
     # print(request.json())
-    return request.json()
-
-def gdc_paginate(endpoint, params={}, legacy=False, key='hits'):
-    response = gdc_request(endpoint, params=params, legacy=legacy)
-    data = response['data']
+    # an error body is not a response to cache
+    request.raise_for_status()
+    response = request.json()
+    if CACHE is not None:
+        CACHE.put(key, response)
+    return response
+
+def page_hits(data, key):
     for h in data[key]:
         if isinstance(data[key], list):
             yield h
         else:
             yield (h, data[key][h])
 
-    while not 'size' in params and 'pagination' in data and data['pagination']['size'] > 0 and data['pagination']['page'] < data['pagination']['pages']:
-        params['from'] = data['pagination']['from'] + data['pagination']['count']
-        response = gdc_request(endpoint, params=params, legacy=legacy)
-        data = response['data']
+def gdc_paginate(endpoint, params={}, legacy=False, key='hits', prefetch=PREFETCH):
+    """
+    Yield every hit of a paginated query in order. Once the first page
+    reveals how many pages there are, up to `prefetch` of the following
+    pages are requested concurrently while earlier ones are consumed.
+    """
+    response = gdc_request(endpoint, params=params, legacy=legacy)
+    data = response['data']
+    for h in page_hits(data, key):
+        yield h
+
+    pagination = data.get('pagination')
+    if 'size' in params or not pagination or pagination['size'] <= 0 or pagination['page'] >= pagination['pages']:
+        return
+
+    remaining = pagination['pages'] - pagination['page']
+    offsets = iter([pagination['from'] + pagination['size'] * (i + 1) for i in range(remaining)])
 
-        for h in data[key]:
-            if isinstance(data[key], list):
+    def fetch(offset):
+        return gdc_request(endpoint, params=merge(params, {'from': offset}), legacy=legacy)['data']
+
+    pool = ThreadPool(prefetch)
+    try:
+        pending = collections.deque(pool.apply_async(fetch, (offset,)) for offset in itertools.islice(offsets, prefetch))
+        while pending:
+            data = pending.popleft().get()
+            for offset in itertools.islice(offsets, 1):
+                pending.append(pool.apply_async(fetch, (offset,)))
+            for h in page_hits(data, key):
                 yield h
-            else:
-                yield (h, data[key][h])
+    finally:
+        pool.terminate()
     
 def build_conditions(args):
     conditions = [{'in': {'files.access': ['open']}}]
@@ -206,21 +356,157 @@ def process_files(args, process=lambda file: None):
 
     return files
 
-def download_file(file_name, file_id, legacy=False):
-    try:
-        print('downloading ' + file_name)
-        base = LEGACY_BASE if legacy else URL_BASE
-        r = requests.get(base + 'data' + '/' + file_id, stream=True)
-        with open(file_name, 'wb') as f:
-            for chunk in r.iter_content(1024):
+class Manifest(object):
+    """
+    Append only record of completed downloads, one `file_id  md5sum  file_name`
+    line per file, so an interrupted run can pick up where it left off.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.completed = {}
+        if path and os.path.exists(path):
+            with open(path) as handle:
+                for line in handle:
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) == 3:
+                        self.completed[parts[0]] = (parts[1], parts[2])
+
+    def complete(self, file_id, file_name):
+        entry = self.completed.get(file_id)
+        return entry is not None and entry[1] == file_name and os.path.exists(file_name)
+
+    def add(self, file_id, md5sum, file_name):
+        with self.lock:
+            self.completed[file_id] = (md5sum, file_name)
+            if self.path:
+                with open(self.path, 'a') as handle:
+                    handle.write('%s\t%s\t%s\n' % (file_id, md5sum, file_name))
+
+def file_md5(path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5
+
+def range_total(response):
+    # a 416 gives the length of the whole file as 'bytes */<length>'
+    match = re.match(r'bytes \*/(\d+)$', response.headers.get('Content-Range', ''))
+    if match:
+        return int(match.group(1))
+
+def download_file(file_name, file_id, legacy=False, md5sum=None, chunk_size=DOWNLOAD_CHUNK_SIZE, session=requests, file_size=None):
+    """
+    Download into file_name + '.part', resuming a previous partial download
+    with an HTTP Range request, then check the md5 and rename into place.
+    Returns the md5 of the file and raises on any failure, leaving the part
+    file behind for the next attempt unless its checksum was wrong. A part
+    file the server rejects with a 416 is only kept if its size matches the
+    length in the 416's Content-Range, or file_size when there is none;
+    otherwise it is discarded and the file downloaded again.
+    """
+    print('downloading ' + file_name)
+    base = LEGACY_BASE if legacy else URL_BASE
+    part = file_name + PART_SUFFIX
+    headers = {}
+    if os.path.exists(part):
+        md5 = file_md5(part, chunk_size)
+        offset = os.path.getsize(part)
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+    else:
+        md5 = hashlib.md5()
+        offset = 0
+
+    url = base + 'data' + '/' + file_id
+    response = session.get(url, stream=True, headers=headers)
+    if response.status_code == 416:
+        total = range_total(response)
+        if total is None and file_size is not None:
+            total = int(file_size)
+        if offset != total and not (total is None and md5sum):
+            # a stale part file, or one longer than the file, is not resumed
+            print('restarting %s: %d bytes in part file, expected %s' % (file_name, offset, total))
+            response.close()
+            md5 = hashlib.md5()
+            offset = 0
+            response = session.get(url, stream=True)
+
+    if response.status_code == 416 and offset:
+        # the part file already holds every byte
+        response.close()
+    else:
+        response.raise_for_status()
+        if offset and response.status_code != 206:
+            md5 = hashlib.md5()
+            offset = 0
+        expected = response.headers.get('Content-Length')
+        received = 0
+        with open(part, 'ab' if offset else 'wb') as f:
+            for chunk in response.iter_content(chunk_size):
+                md5.update(chunk)
                 f.write(chunk)
-
-    except Exception as e:
-        print(str(e))
-
-def download_recent(file_name, file_id, legacy=False):
-    if not os.path.exists(file_name):
-        download_file(file_name, file_id, legacy=legacy)
+                received += len(chunk)
+        if expected is not None and received < int(expected):
+            # keep the part file so the next attempt resumes from here
+            raise IOError('connection closed after %d of %s bytes of %s' % (received, expected, file_name))
+
+    digest = md5.hexdigest()
+    if md5sum and digest != md5sum:
+        os.remove(part)
+        raise Exception('md5 mismatch for %s: expected %s got %s' % (file_name, md5sum, digest))
+    os.rename(part, file_name)
+    return digest
+
+def download_recent(file_name, file_id, legacy=False, md5sum=None, manifest=None, chunk_size=DOWNLOAD_CHUNK_SIZE, session=requests, file_size=None):
+    if manifest is not None and manifest.complete(file_id, file_name):
+        return
+    # a file finished by an earlier run that kept no manifest is checked by
+    # its md5, or by its size when the record has no md5
+    if os.path.exists(file_name) and md5sum and file_md5(file_name, chunk_size).hexdigest() == md5sum:
+        digest = md5sum
+    elif os.path.exists(file_name) and not md5sum and file_size is not None and os.path.getsize(file_name) == int(file_size):
+        digest = file_md5(file_name, chunk_size).hexdigest()
+    else:
+        digest = download_file(file_name, file_id, legacy=legacy, md5sum=md5sum, chunk_size=chunk_size, session=session, file_size=file_size)
+    if manifest is not None:
+        manifest.add(file_id, digest, file_name)
+
+def download_files(files, legacy=False, workers=4, manifest=None, chunk_size=DOWNLOAD_CHUNK_SIZE, retries=3):
+    """
+    Download GDC file records (as returned by the files endpoint) on a pool
+    of threads. Returns a list of (file_name, error) for the files that
+    still failed after `retries` attempts.
+    """
+    local = threading.local()
+    sessions = []
+
+    def fetch(file):
+        if not hasattr(local, 'session'):
+            local.session = gdc_session(pool_size=1)
+            sessions.append(local.session)
+        error = None
+        for attempt in range(retries):
+            try:
+                download_recent(file['file_name'], file['file_id'], legacy=legacy, md5sum=file.get('md5sum'),
+                                manifest=manifest, chunk_size=chunk_size, session=local.session, file_size=file.get('file_size'))
+                return None
+            except Exception as e:
+                error = e
+                print('attempt %d failed for %s: %s' % (attempt + 1, file['file_name'], e))
+        return (file['file_name'], str(error))
+
+    pool = ThreadPool(workers)
+    try:
+        failures = [f for f in pool.imap_unordered(fetch, files) if f is not None]
+    finally:
+        pool.close()
+        pool.join()
+        for session in sessions:
+            session.close()
+    return failures
 
 def file_list(args):
     if args.id:
@@ -235,9 +521,16 @@ def file_list(args):
 
 def file_download(args):
     if args.id:
-        download_file(args.id + '.out', args.id, legacy=args.legacy)
+        download_file(args.id + '.out', args.id, legacy=args.legacy, chunk_size=args.chunk_size)
     else:
-        process_files(args, process=lambda f: download_recent(f['file_name'], f['file_id'], legacy=args.legacy))
+        manifest = Manifest(args.manifest)
+        files = process_files(args)
+        failures = download_files(files, legacy=args.legacy, workers=args.workers, manifest=manifest,
+                                  chunk_size=args.chunk_size, retries=args.retries)
+        for file_name, error in failures:
+            print('failed to download %s: %s' % (file_name, error))
+        if failures:
+            raise SystemExit('%d of %d downloads failed' % (len(failures), len(files)))
 
 def file_facets(args):
     result = facets(FILES, args.attribute, legacy=args.legacy)
@@ -309,7 +602,11 @@ METHODS = {
                 ['--id', {'type': str}],
                 ['--project', {'type': str}],
                 ['--size', {'type': int}],
-                ['--type', {'type': str}]
+                ['--type', {'type': str}],
+                ['--workers', {'type': int, 'default': 4}],
+                ['--chunk-size', {'type': int, 'default': DOWNLOAD_CHUNK_SIZE}],
+                ['--retries', {'type': int, 'default': 3}],
+                ['--manifest', {'type': str, 'default': 'gdc-manifest.tsv'}]
             ]
         },
 
@@ -334,8 +631,12 @@ if __name__ == '__main__':
                 for opt in v['opts']:
                     parser_k.add_argument(opt[0], **opt[1])
             parser_k.add_argument('--legacy', action='store_true')
+            parser_k.add_argument('--cache-dir', type=str, help='cache API responses in this directory')
+            parser_k.add_argument('--cache-ttl', type=int, default=CACHE_TTL, help='seconds before a cached response is refetched')
+            parser_k.add_argument('--offline', action='store_true', help='answer only from the response cache')
             parser_k.set_defaults(func=v['func'])
 
     args = parser.parse_args()
-    
+    configure_cache(args.cache_dir, offline=args.offline, ttl=args.cache_ttl)
+
     args.func(args)
\ No newline at end of file
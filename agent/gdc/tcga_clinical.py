@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+'''
+Single pass extraction of records from TCGA clinical and biospecimen XML.
+
+The converters used to load each file into a minidom tree and walk it once
+per query path: tcga_bcr/admin/*, tcga_bcr/patient/*, three walks over
+stage_event, then one walk per sample, portion, analyte, aliquot, drug,
+radiation or follow_up and two more inside each of those. Here the paths of
+every requested record type are compiled into one sax_rules table and a
+namespace aware SAX handler reports each record when its element closes.
+Only the text of the field elements is kept, so memory holds the open
+records rather than the document.
+
+A record is reported as record_write(subtype, barcode, data):
+
+    admin        tcga_bcr/admin/*, every child by element name
+    patient      tcga_bcr/patient/*, by preferred_name, then element name
+    stage_event  patient/stage_event/*, stage_event/*/* and
+                 stage_event/tnm_categories/*/*, merged in that order
+    sample       .../samples/sample/*
+    portion      .../portions/portion/*
+    analyte      .../analytes/analyte/*
+    aliquot      .../aliquots/aliquot/*
+    drug         tcga_bcr/patient/drugs/drug/*
+    radiation    tcga_bcr/patient/radiations/radiation/*
+    followup     tcga_bcr/patient/follow_ups/follow_up/*, plus its sequence if set
+
+Fields are the elements with an xsd_ver attribute, keyed by preferred_name
+(for patient and stage_event an empty preferred_name falls back to the
+element name), with the text directly inside the element, as minidom's
+getText gave it. patient and stage_event are reported when the patient
+closes, after the records inside it.
+
+example usage:
+
+    import tcga_clinical
+    def record_write(subtype, barcode, data):
+        ...
+    with open('nationwidechildrens.org_clinical.TCGA-05-4244.xml') as handle:
+        tcga_clinical.parse_clinical(handle, ['patient', 'stage_event'], record_write)
+'''
+
+import os
+import sys
+import xml.sax
+from xml.sax.handler import feature_namespaces
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sax_rules
+
+SAMPLE = ['patient', 'samples', 'sample']
+PORTION = SAMPLE + ['portions', 'portion']
+ANALYTE = PORTION + ['analytes', 'analyte']
+ALIQUOT = ANALYTE + ['aliquots', 'aliquot']
+
+# subtype, path below tcga_bcr, barcode element
+RECORDS = [
+    ('admin', ['admin'], None),
+    ('patient', ['patient'], 'bcr_patient_barcode'),
+    ('sample', SAMPLE, 'bcr_sample_barcode'),
+    ('portion', PORTION, 'bcr_portion_barcode'),
+    ('analyte', ANALYTE, 'bcr_analyte_barcode'),
+    ('aliquot', ALIQUOT, 'bcr_aliquot_barcode'),
+    ('drug', ['patient', 'drugs', 'drug'], 'bcr_drug_barcode'),
+    ('radiation', ['patient', 'radiations', 'radiation'], 'bcr_radiation_barcode'),
+    ('followup', ['patient', 'follow_ups', 'follow_up'], 'bcr_followup_barcode'),
+]
+
+# stage_event field paths below tcga_bcr, in the order they are merged
+STAGE_EVENT = [
+    ['patient', 'stage_event', '*'],
+    ['patient', 'stage_event', '*', '*'],
+    ['patient', 'stage_event', 'tnm_categories', '*', '*'],
+]
+
+SUBTYPES = [r[0] for r in RECORDS] + ['stage_event']
+
+# rule actions
+OPEN = 'open'
+FIELD = 'field'
+STAGE = 'stage'
+
+XSD_VER = (None, 'xsd_ver')
+PREFERRED_NAME = (None, 'preferred_name')
+SEQUENCE = (None, 'sequence')
+
+def compile_rules(subtypes):
+    '''
+    The rule table for the requested subtypes. A rule's out_name carries
+    the subtype, or the merge order of a stage_event path.
+    '''
+    subtypes = set(subtypes)
+    unknown = subtypes.difference(SUBTYPES)
+    if unknown:
+        raise ValueError('unknown subtypes: %s' % (', '.join(sorted(unknown))))
+    if 'stage_event' in subtypes:
+        # stage_event fields are kept on the open patient
+        subtypes.add('patient')
+
+    rules = []
+    for subtype, path, barcode in RECORDS:
+        if subtype in subtypes:
+            rules.append((['tcga_bcr'] + path, subtype, OPEN))
+            rules.append((['tcga_bcr'] + path + ['*'], subtype, FIELD))
+    if 'stage_event' in subtypes:
+        for order, path in enumerate(STAGE_EVENT):
+            rules.append((['tcga_bcr'] + path, order, STAGE))
+    return sax_rules.RuleTable(rules)
+
+class Record(object):
+    __slots__ = ('subtype', 'barcode_name', 'barcode', 'data', 'stage')
+
+    def __init__(self, subtype, barcode_name):
+        self.subtype = subtype
+        self.barcode_name = barcode_name
+        self.barcode = None
+        self.data = {}
+        self.stage = []
+
+    def field(self, name, attrs, text):
+        if name == self.barcode_name:
+            self.barcode = text
+        if self.barcode_name is None:
+            self.data[name] = text
+        elif XSD_VER in attrs:
+            key = attrs.get(PREFERRED_NAME, name)
+            if self.subtype == 'patient' and len(key) == 0:
+                key = name
+            self.data[key] = text
+
+    def stage_event(self):
+        data = {}
+        for order, key, text in sorted(self.stage, key=lambda s: s[0]):
+            data[key] = text
+        return data
+
+class Level(object):
+    __slots__ = ('state', 'name', 'attrs', 'text')
+
+    def __init__(self, state, name, attrs, text):
+        self.state = state
+        self.name = name
+        self.attrs = attrs
+        self.text = text
+
+BARCODES = dict((r[0], r[2]) for r in RECORDS)
+
+class ClinicalHandler(xml.sax.ContentHandler):
+    '''
+    Reports the records of the requested subtypes. Expects namespace
+    events, as parse_clinical sets up, and matches on local names.
+    '''
+
+    def __init__(self, record_write, subtypes=SUBTYPES):
+        xml.sax.ContentHandler.__init__(self)
+        self.record_write = record_write
+        self.subtypes = frozenset(subtypes)
+        self.rules = compile_rules(subtypes)
+        self.stack = []
+        self.records = []
+
+    def startElementNS(self, name, qname, attrs):
+        local = name[1]
+        if self.stack:
+            state = self.stack[-1].state.child(local)
+        else:
+            state = self.rules.root.child(local)
+        text = None
+        for out_name, action in state.combiners:
+            if action is OPEN:
+                record = Record(out_name, BARCODES[out_name])
+                if out_name == 'followup' and SEQUENCE in attrs:
+                    record.data['sequence'] = attrs[SEQUENCE]
+                self.records.append(record)
+            else:
+                text = []
+        self.stack.append(Level(state, local, attrs if text is not None else None, text))
+
+    def characters(self, content):
+        text = self.stack[-1].text
+        if text is not None:
+            text.append(content)
+
+    def endElementNS(self, name, qname):
+        level = self.stack.pop()
+        for out_name, action in level.state.combiners:
+            if action is OPEN:
+                self.close(self.records.pop())
+            elif action is FIELD:
+                self.records[-1].field(level.name, level.attrs, ''.join(level.text))
+            elif XSD_VER in level.attrs:
+                # a stage_event field, kept on the patient, the outermost
+                # open record
+                key = level.attrs.get(PREFERRED_NAME, level.name)
+                if len(key) == 0:
+                    key = level.name
+                self.records[0].stage.append((out_name, key, ''.join(level.text)))
+
+    def close(self, record):
+        if record.subtype in self.subtypes:
+            self.record_write(record.subtype, record.barcode, record.data)
+        if record.subtype == 'patient' and 'stage_event' in self.subtypes:
+            self.record_write('stage_event', record.barcode, record.stage_event())
+
+def parse_clinical(handle, subtypes, record_write):
+    '''
+    Report the records of subtypes in one TCGA clinical or biospecimen XML
+    file as record_write(subtype, barcode, data).
+    '''
+    handler = ClinicalHandler(record_write, subtypes)
+    parser = xml.sax.make_parser()
+    parser.setFeature(feature_namespaces, True)
+    parser.setContentHandler(handler)
+    parser.parse(handle)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+'''
+Time gdsc_convert.convert_gdsc on the synthetic fixture.
+
+Runs the conversion once with an empty workbook cache (Excel parsing plus
+writing the cache) and once with the cache warm, then times the response
+curve builder alone on the merged raw and fitted tables repeated --scale
+times, writing through a --multi style emitter in a scratch directory.
+
+example usage:
+
+    python agent/gdsc/make-fixture.py
+    python agent/gdsc/benchmark-gdsc.py --scale 200
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import pandas
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import gdsc_convert
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixture')
+
+def fixture_paths(fixture):
+    names = [
+        'GDSC-CCLE-CTRP_conversion.xlsx',
+        'Cell_Lines_Details.xlsx',
+        'Screened_Compounds.xlsx',
+        'v17a_public_raw_data.xlsx',
+        'v17_fitted_dose_response.xlsx'
+    ]
+    return [os.path.join(fixture, name) for name in names]
+
+def report(name, elapsed, records):
+    rate = records / elapsed if elapsed > 0 else float('inf')
+    print('%-14s %8d records %8.2fs %12.1f records/sec' % (name, records, elapsed, rate))
+
+def timed_convert(name, paths, workdir, cache_dir):
+    emit = gdsc_convert.gdsc_emitter(multi=os.path.join(workdir, name))
+    counted = []
+    def count(message):
+        counted.append(1)
+        emit(message)
+    start = time.time()
+    gdsc_convert.convert_gdsc(*paths, emit=count, cache_dir=cache_dir)
+    emit.close()
+    report(name, time.time() - start, len(counted))
+
+def timed_curves(paths, workdir, cache_dir, scale):
+    conv, cell_info, compounds_file, raw_file, fitted_file = paths
+    samples, cl_info = gdsc_convert.sample_table(conv, cell_info, lambda message: None, cache_dir)
+    compounds = gdsc_convert.compound_table(compounds_file, cache_dir)
+    raw = gdsc_convert.read_excel_cached(raw_file, cache_dir=cache_dir)
+    fitted = gdsc_convert.read_excel_cached(fitted_file, cache_dir=cache_dir)
+    merge = pandas.merge(raw, fitted, on=["COSMIC_ID", "DRUG_ID"])
+    merge = merge[merge["COSMIC_ID"].astype(int).isin(cl_info.index)]
+    merge = pandas.concat([merge] * scale, ignore_index=True)
+
+    emit = gdsc_convert.gdsc_emitter(multi=os.path.join(workdir, 'curves'))
+    start = time.time()
+    gdsc_convert.gdsc_curves(merge, compounds, samples, emit)
+    emit.close()
+    report('curves x%d' % (scale), time.time() - start, len(merge))
+
+def parse_args(args):
+    args = args[1:]
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixture', type=str, default=FIXTURE, help='directory holding the five workbooks')
+    parser.add_argument('--scale', type=int, default=100, help='times to repeat the merged table for the curve builder')
+    return parser.parse_args(args)
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv)
+    paths = fixture_paths(options.fixture)
+    workdir = tempfile.mkdtemp(prefix='gdsc-benchmark-')
+    try:
+        cache_dir = os.path.join(workdir, 'cache')
+        timed_convert('cold cache', paths, workdir, cache_dir)
+        timed_convert('warm cache', paths, workdir, cache_dir)
+        timed_curves(paths, workdir, cache_dir, options.scale)
+    finally:
+        shutil.rmtree(workdir)
@@ -6,5 +6,10 @@
 # curl -O ftp://ftp.sanger.ac.uk/pub/project/cancerrxgene/releases/release-6.0/Screened_Compounds.xlsx
 # curl -O ftp://ftp.sanger.ac.uk/pub/project/cancerrxgene/releases/release-6.0/v17a_public_raw_data.xlsx
 
-./gdsc-convert.py GDSC-CCLE-CTRP_conversion.xlsx Cell_Lines_Details.xlsx Screened_Compounds.xlsx v17a_public_raw_data.xlsx v17_fitted_dose_response.xlsx
-
+./gdsc_convert.py \
+  --conversion GDSC-CCLE-CTRP_conversion.xlsx \
+  --cell-info Cell_Lines_Details.xlsx \
+  --compounds Screened_Compounds.xlsx \
+  --raw v17a_public_raw_data.xlsx \
+  --fitted v17_fitted_dose_response.xlsx \
+  --multi gdsc
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+'''
+Convert the GDSC release 6.0 cell line and drug response workbooks into
+Biosample and ResponseCurve records.
+
+curl -O ftp://ftp.sanger.ac.uk/pub/project/cancerrxgene/releases/release-6.0/Cell_Lines_Details.xlsx
+curl -O ftp://ftp.sanger.ac.uk/pub/project/cancerrxgene/releases/release-6.0/v17_fitted_dose_response.xlsx
+curl -O ftp://ftp.sanger.ac.uk/pub/project/cancerrxgene/releases/release-6.0/GDSC-CCLE-CTRP_conversion.xlsx
+curl -O ftp://ftp.sanger.ac.uk/pub/project/cancerrxgene/releases/release-6.0/Screened_Compounds.xlsx
+curl -O ftp://ftp.sanger.ac.uk/pub/project/cancerrxgene/releases/release-6.0/v17a_public_raw_data.xlsx
+
+example usage:
+
+    python gdsc_convert.py --multi gdsc
+'''
+
+import os
+import sys
+import hashlib
+import argparse
+import numpy
+import pandas
+import numbers
+from bmeg import phenotype_pb2
+from ga4gh import bio_metadata_pb2
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import emitter
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gdsc')
+HASH_BLOCK = 1 << 20
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def read_cache(path):
+    if not path.endswith('.feather'):
+        return pandas.read_pickle(path)
+    frame = pandas.read_feather(path)
+    # feather reads missing text cells back as None; read_excel gives NaN
+    for column in frame.columns[frame.dtypes == object]:
+        frame[column] = frame[column].where(frame[column].notnull(), numpy.nan)
+    return frame
+
+def write_cache(frame, base):
+    """
+    Write the frame as feather when pyarrow can store it unchanged, and as a
+    pickle otherwise (no pyarrow, or mixed type columns feather refuses).
+    The file is renamed into place so an interrupted run never leaves a
+    partial cache.
+    """
+    try:
+        frame.to_feather(base + '.tmp.feather')
+        if not read_cache(base + '.tmp.feather').equals(frame):
+            raise ValueError('feather does not round trip')
+        os.rename(base + '.tmp.feather', base + '.feather')
+    except Exception:
+        if os.path.exists(base + '.tmp.feather'):
+            os.remove(base + '.tmp.feather')
+        frame.to_pickle(base + '.tmp.pkl')
+        os.rename(base + '.tmp.pkl', base + '.pkl')
+
+def read_excel_cached(path, index_col=None, cache_dir=CACHE_DIR):
+    """
+    read_excel, with the parsed first sheet cached under cache_dir keyed by
+    the sha1 of the workbook, so later runs on the same file skip the Excel
+    parser. The index is set after loading so one cache entry serves any
+    index_col.
+    """
+    frame = None
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        base = os.path.join(cache_dir, '%s.%s' % (os.path.basename(path), file_hash(path)))
+        for cached in (base + '.feather', base + '.pkl'):
+            if os.path.exists(cached):
+                frame = read_cache(cached)
+                break
+
+    if frame is None:
+        frame = pandas.read_excel(path)
+        if cache_dir is not None:
+            write_cache(frame, base)
+
+    if index_col is not None:
+        frame = frame.set_index(frame.columns[index_col])
+    return frame
+
+def proto_list_append(message, a):
+    v = message.values.add()
+    v.string_value = a
+
+DILUTIONS = 9
+RESPONSES = ['raw_max'] + ['raw%d' % (i) for i in range(2, 10)]
+CONTROLS = ['control%d' % (i) for i in range(1, 49)]
+BLANKS = ['blank%d' % (i) for i in range(1, 33)]
+
+def numeric_columns(frame, columns):
+    """
+    The columns as a float array. Cells that are not numbers, such as text
+    in the spreadsheet, become NaN and so are skipped like missing values.
+    """
+    out = numpy.empty((len(frame), len(columns)), dtype=numpy.float64)
+    for i, column in enumerate(columns):
+        values = frame[column]
+        if values.dtype == object:
+            values = values.map(lambda v: v if isinstance(v, numbers.Number) else numpy.nan)
+        out[:, i] = values.values.astype(numpy.float64)
+    return out
+
+def gdsc_doses(max_conc, fold_dilution):
+    # each dose is the previous one divided by the fold dilution
+    doses = numpy.empty((len(max_conc), DILUTIONS), dtype=numpy.float64)
+    doses[:, 0] = max_conc
+    for i in range(1, DILUTIONS):
+        doses[:, i] = doses[:, i - 1] / fold_dilution
+    return doses
+
+def present_values(values):
+    mask = ~numpy.isnan(values)
+    return [row[keep].tolist() for row, keep in zip(values, mask)]
+
+def gdsc_curves(merge, compound_table, sample_table, emit):
+    """
+    Emit a ResponseCurve for each row of the merged raw and fitted tables.
+    Doses, responses, summaries, controls and blanks are computed for the
+    whole table as arrays before any message is built.
+    """
+    doses = gdsc_doses(
+        numeric_columns(merge, ['MAX_CONC'])[:, 0],
+        numeric_columns(merge, ['FOLD_DILUTION'])[:, 0]).tolist()
+    responses = merge[RESPONSES].values.tolist()
+    summaries = merge[['LN_IC50', 'AUC', 'RMSE']].values.tolist()
+    controls = present_values(numeric_columns(merge, CONTROLS))
+    blanks = present_values(numeric_columns(merge, BLANKS))
+    samples = merge["COSMIC_ID"].tolist()
+    compounds = merge["DRUG_ID"].tolist()
+
+    for i in range(len(merge)):
+        sample_name = sample_table[samples[i]]
+        compound_name = compound_table[ int(compounds[i]) ]
+
+        response = phenotype_pb2.ResponseCurve()
+        response.gid = "responseCurve:%s:%s" % (sample_name, compound_name)
+        response.responseType = phenotype_pb2.ResponseCurve.ACTIVITY
+        response.compound = compound_name
+        response.sample = sample_name
+
+        ic50, auc, rmse = summaries[i]
+        for summary_type, value in ((phenotype_pb2.ResponseSummary.IC50, ic50), (phenotype_pb2.ResponseSummary.AUC, auc), (phenotype_pb2.ResponseSummary.RMSE, rmse)):
+            s = response.summary.add()
+            s.type = summary_type
+            s.value = value
+            s.unit = "uM"
+
+        for dose, value in zip(doses[i], responses[i]):
+            dr = response.values.add()
+            dr.dose = dose
+            dr.response = value
+
+        response.controls.extend(controls[i])
+        response.blanks.extend(blanks[i])
+        emit(response)
+
+def gdsc_cell_info(row, emit):
+    sample = bio_metadata_pb2.Biosample()
+    sample.id = "biosample:GDSC:%s" % row["Sample Name"]
+    sample.dataset_id = "GDSC"
+
+    dis = row['GDSC\nTissue\ndescriptor 2']
+    if not isinstance(dis, float):
+        sample.disease.term = dis.lower().replace('_', ' ')
+
+    proto_list_append(sample.attributes.attr['sampleType'], "cellline")
+    label = row['Cancer Type\n(matching TCGA label)']
+    if not isinstance(label, float) and len(label):
+        proto_list_append(sample.attributes.attr['source'], label)
+    emit(sample)
+
+def sample_table(conv_file, cell_info_file, emit, cache_dir=CACHE_DIR):
+    """
+    Map COSMIC ids to biosample ids, preferring the CCLE name from the
+    conversion table. Cell lines only known to GDSC get a Biosample record.
+    Returns the table and the cell line details indexed by COSMIC id.
+    """
+    cl_info = read_excel_cached(conv_file, index_col=0, cache_dir=cache_dir)
+    samples = {}
+    for row in cl_info.iterrows():
+        samples[row[0]] = "biosample:CCLE:%s" % (row[1]['CCLE name'])
+
+    cl_info = read_excel_cached(cell_info_file, index_col=1, cache_dir=cache_dir)
+    for row in cl_info.iterrows():
+        if row[0] not in samples:
+            samples[row[0]] = "biosample:GDSC:%s" % (row[1]['Sample Name'])
+            gdsc_cell_info(row[1], emit)
+    return samples, cl_info
+
+def compound_table(compound_info_file, cache_dir=CACHE_DIR):
+    comp_info = read_excel_cached(compound_info_file, index_col=0, cache_dir=cache_dir)
+    compounds = {}
+    for row in comp_info.iterrows():
+        compounds[int(row[0])] = "compound:%s" % (row[1]['Drug Name'])
+    return compounds
+
+def convert_gdsc(conv_file, cell_info_file, compound_info_file, raw_file, fitted_file, emit, cache_dir=CACHE_DIR):
+    """
+    Emit the GDSC Biosamples and ResponseCurves through emit, any callable
+    taking a message such as an emitter.JSONEmitter.
+    """
+    samples, cl_info = sample_table(conv_file, cell_info_file, emit, cache_dir)
+    compounds = compound_table(compound_info_file, cache_dir)
+
+    raw = read_excel_cached(raw_file, cache_dir=cache_dir)
+    fitted = read_excel_cached(fitted_file, cache_dir=cache_dir)
+
+    merge = pandas.merge(raw, fitted, on=["COSMIC_ID", "DRUG_ID"])
+    merge = merge[merge["COSMIC_ID"].astype(int).isin(cl_info.index)]
+
+    gdsc_curves(merge, compounds, samples, emit)
+
+def gdsc_emitter(out=None, multi=None):
+    if multi is not None:
+        return emitter.JSONEmitter(multi=multi)
+    return emitter.JSONEmitter(out=out or sys.stdout, label_field="#label")
+
+def parse_args(args):
+    args = args[1:]
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--conversion', type=str, default='GDSC-CCLE-CTRP_conversion.xlsx', help='GDSC to CCLE cell line conversion workbook')
+    parser.add_argument('--cell-info', type=str, default='Cell_Lines_Details.xlsx', help='GDSC cell line details workbook')
+    parser.add_argument('--compounds', type=str, default='Screened_Compounds.xlsx', help='GDSC screened compounds workbook')
+    parser.add_argument('--raw', type=str, default='v17a_public_raw_data.xlsx', help='GDSC raw dose response workbook')
+    parser.add_argument('--fitted', type=str, default='v17_fitted_dose_response.xlsx', help='GDSC fitted dose response workbook')
+    parser.add_argument('--out', type=str, help='path to a single output file, stdout if neither this nor --multi is given')
+    parser.add_argument('--multi', type=str, help='prefix for one output file per message type')
+    parser.add_argument('--cache-dir', type=str, default=CACHE_DIR, help='directory caching the parsed workbooks')
+    parser.add_argument('--no-cache', action='store_true', help='always parse the workbooks')
+    return parser.parse_args(args)
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv)
+    cache_dir = None if options.no_cache else options.cache_dir
+    with gdsc_emitter(options.out, options.multi) as emit:
+        convert_gdsc(options.conversion, options.cell_info, options.compounds, options.raw, options.fitted, emit, cache_dir)
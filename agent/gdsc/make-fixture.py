@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+'''
+Write a small synthetic copy of the five GDSC release 6.0 workbooks, with
+the sheet layout and column names gdsc_convert.py reads, for trying the
+converter and for benchmark-gdsc.py.
+
+Cell lines are split between ones with a CCLE name in the conversion table
+and ones only known to GDSC, some tissue and TCGA labels are missing, and
+the raw data has missing controls and blanks and a cell line absent from
+the details table, so every branch of the converter is exercised.
+
+example usage:
+
+    python agent/gdsc/make-fixture.py --out agent/gdsc/fixture
+'''
+
+import os
+import sys
+import random
+import argparse
+
+import pandas
+
+RAW_COLUMNS = (
+    ['COSMIC_ID', 'DRUG_ID', 'MAX_CONC', 'FOLD_DILUTION', 'raw_max'] +
+    ['raw%d' % (i) for i in range(2, 10)] +
+    ['control%d' % (i) for i in range(1, 49)] +
+    ['blank%d' % (i) for i in range(1, 33)])
+
+def maybe(value, rate):
+    return value if random.random() < rate else float('nan')
+
+def frame(rows, columns):
+    return pandas.DataFrame(rows, columns=columns)
+
+def make_fixture(out, cells, drugs, ccle):
+    if not os.path.exists(out):
+        os.makedirs(out)
+    cosmic = [900000 + i for i in range(cells)]
+
+    frame([(c, 'CCL%d_LUNG' % (i)) for i, c in enumerate(cosmic[:ccle])],
+        ['COSMIC_ID', 'CCLE name']).to_excel(os.path.join(out, 'GDSC-CCLE-CTRP_conversion.xlsx'), index=False)
+
+    frame([('CELL-%d' % (i), c, 'lung_NSCLC' if i % 3 else float('nan'), 'LUAD' if i % 4 else float('nan')) for i, c in enumerate(cosmic)],
+        ['Sample Name', 'COSMIC identifier', 'GDSC\nTissue\ndescriptor 2', 'Cancer Type\n(matching TCGA label)']).to_excel(os.path.join(out, 'Cell_Lines_Details.xlsx'), index=False)
+
+    frame([(d, 'Drug%d' % (d)) for d in range(1, drugs + 1)],
+        ['DRUG_ID', 'Drug Name']).to_excel(os.path.join(out, 'Screened_Compounds.xlsx'), index=False)
+
+    raw = []
+    fitted = []
+    # the last cell line is missing from the details table and is dropped
+    for c in cosmic + [999999]:
+        for d in range(1, drugs + 1):
+            if random.random() < 0.5:
+                continue
+            row = [c, d, random.choice([0.5, 2.0, 10.0]), random.choice([2, 4]), random.random()]
+            row += [random.random() for i in range(2, 10)]
+            row += [maybe(random.random(), 0.8) for i in range(1, 49)]
+            row += [maybe(random.random(), 0.6) for i in range(1, 33)]
+            raw.append(row)
+            fitted.append((c, d, random.random() * 4, random.random(), random.random() / 10))
+
+    frame(raw, RAW_COLUMNS).to_excel(os.path.join(out, 'v17a_public_raw_data.xlsx'), index=False)
+    frame(fitted, ['COSMIC_ID', 'DRUG_ID', 'LN_IC50', 'AUC', 'RMSE']).to_excel(os.path.join(out, 'v17_fitted_dose_response.xlsx'), index=False)
+
+def parse_args(args):
+    args = args[1:]
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixture'), help='directory to write the workbooks to')
+    parser.add_argument('--cells', type=int, default=20, help='number of cell lines')
+    parser.add_argument('--drugs', type=int, default=6, help='number of compounds')
+    parser.add_argument('--ccle', type=int, default=8, help='number of cell lines with a CCLE name')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(args)
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv)
+    random.seed(options.seed)
+    make_fixture(options.out, options.cells, options.drugs, options.ccle)
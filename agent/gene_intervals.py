@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+'''
+Persisted gene interval index for overlapping genomic segments with genes.
+
+Genes are stored per chromosome sorted by start, as plain .npy arrays that
+are memory mapped on load:
+
+    chromosomes.json   chromosome -> [offset, count] into the arrays
+    names.txt          one gene name per line, in array order
+    starts.npy         gene starts (int64), sorted within each chromosome
+    ends.npy           gene ends (int64)
+    max_ends.npy       running maximum of ends within each chromosome
+
+An index is built once per annotation file, keyed by the sha1 of the file
+and the parameters used to select genes, and reused on later runs.
+
+Queries are half open, like the bx-python Intersecter.find they replace:
+a gene overlaps [start, end) when gene.start < end and gene.end > start.
+For a batch of queries the candidate genes are bounded with two binary
+searches, the first gene whose running max end passes the query start and
+the last gene starting before the query end, then filtered by end.
+
+example usage:
+
+    import gene_intervals
+    index = gene_intervals.load_or_build(gtf_path, build, key='protein_coding:gene')
+    segments, genes = index.overlaps('7', starts, ends)
+'''
+
+import os
+import json
+import shutil
+import hashlib
+
+import numpy
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gene_intervals')
+HASH_BLOCK = 1 << 20
+
+CHROMOSOMES = 'chromosomes.json'
+NAMES = 'names.txt'
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_index(path, names, chromosomes, starts, ends):
+    '''
+    Write an index for genes given as parallel sequences of name,
+    chromosome, start and end. The directory is built next to path and
+    renamed into place.
+    '''
+    starts = numpy.asarray(starts, dtype=numpy.int64)
+    ends = numpy.asarray(ends, dtype=numpy.int64)
+    chromosomes = list(chromosomes)
+    order = sorted(range(len(names)), key=lambda i: (chromosomes[i], starts[i], ends[i], names[i]))
+    order = numpy.array(order, dtype=numpy.intp)
+
+    sorted_starts = starts[order]
+    sorted_ends = ends[order]
+    max_ends = numpy.empty_like(sorted_ends)
+    offsets = {}
+    position = 0
+    while position < len(order):
+        chromosome = chromosomes[order[position]]
+        end = position
+        while end < len(order) and chromosomes[order[end]] == chromosome:
+            end += 1
+        offsets[chromosome] = [position, end - position]
+        max_ends[position:end] = numpy.maximum.accumulate(sorted_ends[position:end])
+        position = end
+
+    work = path + '.partial'
+    if os.path.exists(work):
+        shutil.rmtree(work)
+    os.makedirs(work)
+    numpy.save(os.path.join(work, 'starts.npy'), sorted_starts)
+    numpy.save(os.path.join(work, 'ends.npy'), sorted_ends)
+    numpy.save(os.path.join(work, 'max_ends.npy'), max_ends)
+    with open(os.path.join(work, NAMES), 'w') as handle:
+        for i in order:
+            handle.write(names[i] + '\n')
+    with open(os.path.join(work, CHROMOSOMES), 'w') as handle:
+        json.dump(offsets, handle, indent=2, sort_keys=True)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(work, path)
+
+class GeneIntervals(object):
+    '''
+    A gene interval index loaded from disk. names, starts and ends are in
+    index order, grouped by chromosome.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, CHROMOSOMES)) as handle:
+            self.chromosomes = json.load(handle)
+        with open(os.path.join(path, NAMES)) as handle:
+            self.names = [line.rstrip('\n') for line in handle]
+        self.starts = numpy.load(os.path.join(path, 'starts.npy'), mmap_mode='r')
+        self.ends = numpy.load(os.path.join(path, 'ends.npy'), mmap_mode='r')
+        self.max_ends = numpy.load(os.path.join(path, 'max_ends.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.names)
+
+    def chromosome(self, chromosome):
+        '''
+        The offset and count of the genes on a chromosome.
+        '''
+        return self.chromosomes.get(chromosome, (0, 0))
+
+    def overlaps(self, chromosome, starts, ends):
+        '''
+        All overlapping (query, gene) pairs for half open [start, end)
+        queries on one chromosome, as two arrays: positions into
+        starts/ends and gene positions in the index. Pairs are ordered by
+        query, then by gene start.
+        '''
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        ends = numpy.asarray(ends, dtype=numpy.int64)
+        offset, count = self.chromosome(chromosome)
+        if count == 0 or len(starts) == 0:
+            empty = numpy.zeros(0, dtype=numpy.intp)
+            return empty, empty
+
+        gene_starts = self.starts[offset:offset + count]
+        gene_ends = self.ends[offset:offset + count]
+        max_ends = self.max_ends[offset:offset + count]
+
+        # genes before lo all end at or before the query start and genes
+        # from hi on start at or after the query end
+        lo = numpy.searchsorted(max_ends, starts, side='right')
+        hi = numpy.searchsorted(gene_starts, ends, side='left')
+        counts = numpy.maximum(hi - lo, 0)
+
+        total = counts.sum()
+        segments = numpy.repeat(numpy.arange(len(starts)), counts)
+        firsts = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        genes = numpy.arange(total) - firsts + numpy.repeat(lo, counts)
+
+        keep = gene_ends[genes] > starts[segments]
+        return segments[keep], genes[keep] + offset
+
+def load_or_build(path, build, key='', cache_dir=CACHE_DIR):
+    '''
+    Load the index for the annotation file at path, calling build() to get
+    (names, chromosomes, starts, ends) and writing the index first if
+    there is none for this file and key.
+    '''
+    digest = hashlib.sha1((file_hash(path) + ':' + key).encode('utf-8')).hexdigest()
+    index_path = os.path.join(cache_dir, '%s.%s' % (os.path.basename(path), digest))
+    if not os.path.exists(os.path.join(index_path, CHROMOSOMES)):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        names, chromosomes, starts, ends = build()
+        write_index(index_path, names, chromosomes, starts, ends)
+    return GeneIntervals(index_path)
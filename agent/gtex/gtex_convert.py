@@ -5,13 +5,20 @@
 
 from ga4gh.schemas.ga4gh import bio_metadata_pb2
 from bmeg import matrix_pb2
-from google.protobuf.json_format import MessageToDict
 
+import os
+import sys
 import csv
-import json
+import gzip
+import numpy
 import pandas
+import tempfile
 import argparse
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import emitter
+import expression_store
+
 INDIVIDUAL_HEADERS = [
     "hasBrainTissue",
     "pathologyNotes",
@@ -43,15 +50,11 @@ def proto_list_append(message, a):
     v.string_value = a
 
 
-def emit_json(prefix, out_handles, message):
-    name = message.DESCRIPTOR.full_name
-    if name not in out_handles:
-        out_handles[name] = open(prefix + name, "w")
-    out_handles[name].write(json.dumps(MessageToDict(message)))
-    out_handles[name].write("\n")
+def gtex_emitter(prefix):
+    return emitter.JSONEmitter(multi=prefix, separator='', suffix='')
 
 def parse_bio(bio, out):
-    out_handles = {}
+    emit_json = gtex_emitter(out)
     with open(bio) as handle:
         reader = csv.DictReader(handle, delimiter="\t")
         
@@ -62,7 +65,7 @@ def parse_bio(bio, out):
             #out.individual_age_at_collection.age = row['ageBracket']
             for i in INDIVIDUAL_HEADERS:
                 proto_list_append( ind.info[i], row[i] )
-            emit_json(out, out_handles, ind )
+            emit_json(ind)
 
             sam = bio_metadata_pb2.Biosample()
             sam.id = row['sampleId']
@@ -70,30 +73,132 @@ def parse_bio(bio, out):
             sam.individual_id = row['subjectId']
             for i in SAMPLE_HEADERS:
                 proto_list_append( sam.info[i], row[i] )
-            emit_json(out, out_handles, sam)
-    for handle in out_handles.values():
-        handle.close()
+            emit_json(sam)
+    emit_json.close()
                 
 
 
-def parse_expression(path, out):
-    df = pandas.read_csv(path, compression="gzip", sep="\t", index_col=0, skiprows=2)
-    
-    df = df.groupby("Description").mean().transpose()
-
-    out_handles = {}
-
-    for row in df.iterrows():
-        gex = matrix_pb2.GeneExpression()
-        gex.id = "GeneExpression:%s" % (row[0])
-        gex.source = "gtex"
-        gex.biosample_id = "biosample:%s" % (row[0])
-        gex.scale = matrix_pb2.RPKM
-        for k, v in row[1].iteritems():
-            gex.expressions[k] = v
-        emit_json(out, out_handles, gex)
-    for handle in out_handles.values():
-        handle.close()
+# GCT rows spooled per chunk, and sample rows collapsed and emitted per block
+CHUNK_ROWS = 1000
+BLOCK_SAMPLES = 128
+
+def gct_dimensions(path):
+    with gzip.open(path) as handle:
+        handle.readline()
+        rows, columns = handle.readline().split()[:2]
+    return int(rows), int(columns)
+
+class SampleSpool(object):
+    """
+    A samples x columns float64 scratch file, written a chunk of columns at
+    a time and read back a block of whole sample rows at a time. It is read
+    and written through a file handle rather than mapped, so only the chunk
+    or block in hand is resident.
+    """
+
+    def __init__(self, path, samples, columns):
+        self.samples = samples
+        self.columns = columns
+        self.handle = open(path, "w+b")
+        self.handle.truncate(samples * columns * 8)
+
+    def write_columns(self, start, values):
+        """
+        Write a samples x k array to columns start..start+k, one
+        contiguous run per sample.
+        """
+        values = numpy.ascontiguousarray(values, dtype=numpy.float64)
+        for sample in range(self.samples):
+            self.handle.seek((sample * self.columns + start) * 8)
+            values[sample].tofile(self.handle)
+
+    def read_rows(self, start, stop):
+        stop = min(stop, self.samples)
+        self.handle.seek(start * self.columns * 8)
+        return numpy.fromfile(self.handle, dtype=numpy.float64, count=(stop - start) * self.columns).reshape(stop - start, self.columns)
+
+    def close(self):
+        self.handle.close()
+
+def spool_gct(path, spool_path, chunk_rows=CHUNK_ROWS):
+    """
+    Stream a GCT in chunks of rows into a SampleSpool at spool_path, each
+    chunk transposed as it is written, so the values of a sample are one
+    contiguous row with a column per GCT row. Returns the Description of
+    each column, the sample names and the spool.
+    """
+    rows, columns = gct_dimensions(path)
+    spool = None
+    descriptions = []
+
+    reader = pandas.read_csv(path, compression="gzip", sep="\t", index_col=0, skiprows=2, chunksize=chunk_rows)
+    for chunk in reader:
+        values = numpy.asarray(chunk.iloc[:, 1:].values, dtype=numpy.float64)
+        if spool is None:
+            samples = list(chunk.columns[1:])
+            spool = SampleSpool(spool_path, len(samples), rows)
+        if len(descriptions) + len(chunk) > rows:
+            raise ValueError('%s has more rows than its header declares' % path)
+        spool.write_columns(len(descriptions), values.T)
+        descriptions.extend(chunk["Description"].values)
+
+    return descriptions, samples, spool
+
+def gene_groups(descriptions):
+    """
+    The sorted unique genes, the spool columns ordered by gene (in file
+    order within a gene) and the start of each gene's run in that order.
+    """
+    genes, index = numpy.unique(numpy.array(descriptions, dtype=object), return_inverse=True)
+    order = numpy.argsort(index, kind='mergesort')
+    starts = numpy.flatnonzero(numpy.diff(numpy.concatenate([[-1], index[order]])))
+    return genes.tolist(), order, starts
+
+def collapse_rows(block, order, starts):
+    """
+    Average the columns of a block of sample rows that share a gene, the
+    way groupby("Description").mean() does (NaN values are skipped).
+    """
+    values = block[:, order]
+    present = ~numpy.isnan(values)
+    sums = numpy.add.reduceat(numpy.where(present, values, 0.0), starts, axis=1)
+    counts = numpy.add.reduceat(present, starts, axis=1)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return numpy.where(counts > 0, sums / counts, numpy.nan)
+
+def parse_expression(path, out, store=None, chunk_rows=CHUNK_ROWS, block_samples=BLOCK_SAMPLES):
+    emit_json = gtex_emitter(out)
+    handle, spool_path = tempfile.mkstemp(prefix="gtex-expression-", suffix=".f8", dir=os.path.dirname(os.path.abspath(out)))
+    os.close(handle)
+
+    try:
+        descriptions, samples, spool = spool_gct(path, spool_path, chunk_rows)
+        genes, order, starts = gene_groups(descriptions)
+        writer = None
+        if store is not None:
+            writer = expression_store.StoreWriter(store, genes)
+
+        for start in range(0, len(samples), block_samples):
+            # a block of contiguous sample rows, collapsed to sorted genes
+            block = collapse_rows(spool.read_rows(start, start + block_samples), order, starts)
+            for sample, row in zip(samples[start:start + block_samples], block):
+                gex = matrix_pb2.GeneExpression()
+                gex.id = "GeneExpression:%s" % (sample)
+                gex.source = "gtex"
+                gex.biosample_id = "biosample:%s" % (sample)
+                gex.scale = matrix_pb2.RPKM
+                gex.expressions.update(zip(genes, row.tolist()))
+                emit_json(gex)
+                if writer is not None:
+                    writer.add(gex.biosample_id, row)
+
+        if writer is not None:
+            writer.close()
+        spool.close()
+    finally:
+        emit_json.close()
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
 
 
 if __name__ == "__main__":
@@ -104,9 +209,12 @@ if __name__ == "__main__":
     parser.add_argument('--bio', type=str, help='')
     parser.add_argument('--expression', type=str, help='')
     parser.add_argument('--out', default="gtex.")
+    parser.add_argument('--store', type=str, help='directory to also write expression to as a columnar expression store')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='GCT rows read at a time')
+    parser.add_argument('--block-samples', type=int, default=BLOCK_SAMPLES, help='samples emitted per block of the spool')
     args = parser.parse_args()
 
     if args.bio:
         parse_bio(args.bio, args.out)
     if args.expression:
-        parse_expression(args.expression, args.out)
\ No newline at end of file
+        parse_expression(args.expression, args.out, args.store, args.chunk_rows, args.block_samples)
\ No newline at end of file
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+'''
+Fast GTF reader for the agents that only need a few columns and attributes
+of a few feature types.
+
+Each line is split only as far as the source and feature columns before
+the source/feature filters are applied, so the bulk of a GENCODE file
+(exons, CDS, UTRs of other biotypes) is skipped without touching its
+attributes. For the lines that pass, only the requested attribute keys are
+located with str.find rather than parsing every attribute with a regex.
+
+Matching lines come back either as GTFRecord objects, which use __slots__
+and keep the field names of the GTFLine that convert-ccle-seg.py used to
+read with, or collected into a GTFTable of parallel columns.
+
+example usage:
+
+    import gtf
+    with gzip.GzipFile(path) as handle:
+        table = gtf.read_table(handle, source_filter='protein_coding', feature_filter='gene', keys=['gene_name'])
+    names, seqnames, starts, ends = table.spans('gene_name')
+'''
+
+import numpy
+
+try:
+    long
+except NameError:
+    long = int
+
+COLUMNS = ['seqname', 'source', 'feature', 'start', 'end', 'score', 'strand', 'frame']
+
+DEFAULT_KEYS = ('gene_id', 'gene_name')
+
+def attribute(attributes, key):
+    '''
+    The value of `key "value"` in a GTF attribute column, or None. The key
+    has to start the column or follow a space or semicolon, so gene_id does
+    not match havana_gene_id.
+    '''
+    pattern = key + ' "'
+    position = attributes.find(pattern)
+    while position > 0 and attributes[position - 1] not in ' ;':
+        position = attributes.find(pattern, position + 1)
+    if position < 0:
+        return None
+    start = position + len(pattern)
+    end = attributes.find('"', start)
+    if end < 0:
+        return None
+    return attributes[start:end]
+
+def attribute_dict(attributes, keys):
+    out = {}
+    for key in keys:
+        value = attribute(attributes, key)
+        if value is not None:
+            out[key] = value
+    return out
+
+class GTFRecord(object):
+    '''
+    One GTF line with only the requested attributes in attr.
+    '''
+
+    __slots__ = ('seqname', 'source', 'feature', 'start', 'end', 'score', 'strand', 'frame', 'attr')
+
+    def __init__(self, seqname, source, feature, start, end, score, strand, frame, attr):
+        self.seqname = seqname
+        self.source = source
+        self.feature = feature
+        self.start = start
+        self.end = end
+        self.score = score
+        self.strand = strand
+        self.frame = frame
+        self.attr = attr
+
+    def __repr__(self):
+        return "%s:%s:%s-%s" % (self.feature, self.seqname, self.start, self.end)
+
+    def __getitem__(self, name):
+        return self.attr[name]
+
+def split_lines(handle, source_filter=None, feature_filter=None):
+    '''
+    Yield (seqname, source, feature, rest) for the lines passing the
+    filters, where rest holds the unsplit remaining columns.
+    '''
+    for line in handle:
+        if line.startswith('#'):
+            continue
+        parts = line.split('\t', 3)
+        if len(parts) < 4:
+            continue
+        if source_filter is not None and parts[1] != source_filter:
+            continue
+        if feature_filter is not None and parts[2] != feature_filter:
+            continue
+        yield parts
+
+def read_records(handle, source_filter=None, feature_filter=None, keys=DEFAULT_KEYS):
+    '''
+    Yield a GTFRecord for each line passing the filters. Score and frame
+    are None when given as '.'.
+    '''
+    for seqname, source, feature, rest in split_lines(handle, source_filter, feature_filter):
+        start, end, score, strand, frame, attributes = rest.split('\t', 5)
+        yield GTFRecord(
+            seqname, source, feature, long(start), long(end),
+            None if score == '.' else float(score),
+            strand,
+            None if frame == '.' else int(frame),
+            attribute_dict(attributes, keys))
+
+class GTFTable(object):
+    '''
+    Struct of arrays for the lines passing the filters: lists of seqname,
+    source, feature and strand, int64 arrays of start and end, and one list
+    per requested attribute key (None where a line lacks the key). Each
+    read adds its lines after those of earlier reads.
+    '''
+
+    def __init__(self, keys=DEFAULT_KEYS):
+        self.keys = list(keys)
+        self.seqname = []
+        self.source = []
+        self.feature = []
+        self.strand = []
+        self.start = numpy.zeros(0, dtype=numpy.int64)
+        self.end = numpy.zeros(0, dtype=numpy.int64)
+        self.attributes = dict((key, []) for key in self.keys)
+
+    def __len__(self):
+        return len(self.seqname)
+
+    def read(self, handle, source_filter=None, feature_filter=None):
+        seqname = self.seqname.append
+        source = self.source.append
+        feature = self.feature.append
+        strand = self.strand.append
+        line_starts = []
+        line_ends = []
+        start = line_starts.append
+        end = line_ends.append
+        columns = [(key, self.attributes[key].append) for key in self.keys]
+
+        for parts in split_lines(handle, source_filter, feature_filter):
+            line_start, line_end, score, line_strand, frame, attributes = parts[3].split('\t', 5)
+            seqname(parts[0])
+            source(parts[1])
+            feature(parts[2])
+            strand(line_strand)
+            start(line_start)
+            end(line_end)
+            for key, append in columns:
+                append(attribute(attributes, key))
+
+        self.start = numpy.concatenate([self.start, numpy.array(line_starts, dtype=numpy.int64)])
+        self.end = numpy.concatenate([self.end, numpy.array(line_ends, dtype=numpy.int64)])
+        return self
+
+    def spans(self, key='gene_name'):
+        '''
+        Group lines by an attribute, as GTFMap does with gene_name, and
+        return parallel lists of (name, seqname, start, end): the smallest
+        start and largest end of each group and the seqname of its last
+        line, in order of first appearance.
+        '''
+        index = {}
+        names = []
+        seqnames = []
+        starts = []
+        ends = []
+        line_starts = self.start.tolist()
+        line_ends = self.end.tolist()
+        for i, name in enumerate(self.attributes[key]):
+            if name is None:
+                continue
+            start = line_starts[i]
+            end = line_ends[i]
+            position = index.get(name)
+            if position is None:
+                index[name] = len(names)
+                names.append(name)
+                seqnames.append(self.seqname[i])
+                starts.append(start)
+                ends.append(end)
+            else:
+                seqnames[position] = self.seqname[i]
+                if start < starts[position]:
+                    starts[position] = start
+                if end > ends[position]:
+                    ends[position] = end
+        return names, seqnames, starts, ends
+
+def read_table(handle, source_filter=None, feature_filter=None, keys=DEFAULT_KEYS):
+    return GTFTable(keys).read(handle, source_filter, feature_filter)
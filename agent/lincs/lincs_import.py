@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import json
 import argparse
 import urllib
 from bmeg import phenotype_pb2
-from google.protobuf import json_format
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import emitter
 
 BASE_URL = "http://lincs.hms.harvard.edu/db/api/v1/"
 
@@ -58,7 +61,7 @@ def action_parse(args):
             out.append(rc)
     
     for i in out:
-        print json_format.MessageToJson(i)
+        print emitter.message_to_json(i)
     #print cell_line_vs_drug
 
 def action_list(args):
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+'''
+Time the pubmed SAX handler with the compiled rule table and per level text
+chunks against the linear scan of f_map on every closing tag and the single
+text buffer it replaced.
+
+Runs on a Medline baseline file (medlineNNNN.xml.gz) when one is given,
+otherwise on a synthetic file of articles shaped like the baseline, and
+checks that both handlers print the same records. Titles and abstracts with
+inline markup (<i>, <sup>) are the exception: the old buffer kept only the
+text after the last inline element, so the check is skipped on real files
+with --no-check.
+
+example usage:
+
+    python agent/pubmed/benchmark-pubmed.py --medline medline17n0001.xml.gz
+    python agent/pubmed/benchmark-pubmed.py --articles 5000
+'''
+
+import os
+import sys
+import gzip
+import time
+import random
+import logging
+import argparse
+import xml.sax
+from cStringIO import StringIO
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import pubmed
+import sax_rules
+
+WORDS = ['cell', 'tumor', 'expression', 'protein', 'patients', 'cancer', 'gene', 'response', 'analysis', 'treatment', 'mutation', 'pathway']
+
+class LinearLevel:
+    def __init__(self, name, attrs):
+        self.data = {}
+        self.name = name
+        self.attrs = attrs
+
+class LinearHandler(xml.sax.ContentHandler):
+    '''
+    The handler as it was, matching every rule against the element stack
+    and keeping one text buffer.
+    '''
+
+    def __init__(self, record_write):
+        xml.sax.ContentHandler.__init__(self)
+        self.record_write = record_write
+        self.stack = []
+
+    def startElement(self, name, attrs):
+        self.stack.append(LinearLevel(name, dict(attrs.items())))
+        self.buffer = ""
+
+    def characters(self, text):
+        self.buffer += text
+
+    def endElement(self, name):
+        stack_id = list(i.name for i in self.stack)
+        level = self.stack.pop()
+        for s, out_name, f in pubmed.f_map:
+            if sax_rules.stack_match(s, stack_id):
+                if out_name is None:
+                    out_name = stack_id[-1]
+                v = f(self.record_write, self.buffer, level.attrs, **level.data)
+                if v is not None:
+                    if isinstance(v, list):
+                        if out_name in self.stack[-1].data:
+                            self.stack[-1].data[out_name].extend(v)
+                        else:
+                            self.stack[-1].data[out_name] = v
+                    elif isinstance(v, dict):
+                        if out_name in self.stack[-1].data:
+                            self.stack[-1].data[out_name] = dict(self.stack[-1].data, **v)
+                        else:
+                            self.stack[-1].data[out_name] = v
+                    else:
+                        self.stack[-1].data[out_name] = v
+        self.buffer = ""
+
+def sentence(count):
+    return ' '.join(random.choice(WORDS) for i in range(count))
+
+def date(name):
+    return '<%s><Year>%d</Year><Month>%02d</Month><Day>%02d</Day></%s>' % (name, random.randint(1960, 2017), random.randint(1, 12), random.randint(1, 28), name)
+
+def article(pmid):
+    authors = ''.join(
+        '<Author ValidYN="Y"><LastName>%s</LastName><ForeName>%s</ForeName><Initials>A</Initials>'
+        '<AffiliationInfo><Affiliation>%s</Affiliation></AffiliationInfo></Author>' % (random.choice(WORDS).title(), random.choice(WORDS).title(), sentence(8))
+        for i in range(random.randint(1, 8)))
+    mesh = ''.join(
+        '<MeshHeading><DescriptorName UI="D%06d" MajorTopicYN="N">%s</DescriptorName>'
+        '<QualifierName UI="Q%06d" MajorTopicYN="N">%s</QualifierName></MeshHeading>' % (random.randint(0, 999999), random.choice(WORDS), random.randint(0, 999999), random.choice(WORDS))
+        for i in range(random.randint(2, 12)))
+    abstract = ''
+    if random.random() < 0.8:
+        abstract = '<Abstract><AbstractText>%s</AbstractText></Abstract>' % sentence(random.randint(50, 300))
+    return (
+        '<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="1">%d</PMID>%s%s%s'
+        '<Article PubModel="Print"><Journal><ISSN IssnType="Print">0000-0000</ISSN><JournalIssue CitedMedium="Print">'
+        '<Volume>%d</Volume><Issue>%d</Issue><PubDate><Year>%d</Year></PubDate></JournalIssue><Title>%s</Title></Journal>'
+        '<ArticleTitle>%s</ArticleTitle><Pagination><MedlinePgn>1-10</MedlinePgn></Pagination>%s'
+        '<AuthorList CompleteYN="Y">%s</AuthorList><Language>eng</Language>'
+        '<PublicationTypeList><PublicationType UI="D016428">Journal Article</PublicationType></PublicationTypeList></Article>'
+        '<MedlineJournalInfo><Country>United States</Country><MedlineTA>J Test</MedlineTA></MedlineJournalInfo>'
+        '<MeshHeadingList>%s</MeshHeadingList></MedlineCitation>'
+        '<PubmedData><History><PubMedPubDate PubStatus="pubmed"><Year>2000</Year><Month>1</Month><Day>1</Day></PubMedPubDate></History>'
+        '<PublicationStatus>ppublish</PublicationStatus><ArticleIdList><ArticleId IdType="pubmed">%d</ArticleId></ArticleIdList></PubmedData>'
+        '</PubmedArticle>\n' % (
+            pmid, date('DateCreated'), date('DateCompleted'), date('DateRevised'),
+            random.randint(1, 100), random.randint(1, 12), random.randint(1960, 2017), sentence(3),
+            sentence(random.randint(5, 20)), abstract, authors, mesh, pmid))
+
+def synthetic_medline(articles):
+    out = StringIO()
+    out.write('<?xml version="1.0"?>\n<PubmedArticleSet>\n')
+    for pmid in range(1, articles + 1):
+        out.write(article(pmid))
+    out.write('</PubmedArticleSet>\n')
+    return out.getvalue()
+
+def run(handler_class, data):
+    handler = handler_class(pubmed.StdoutWriter())
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(handler)
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    start = time.time()
+    try:
+        parser.parse(StringIO(data))
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    return time.time() - start, output
+
+def parse_args(args):
+    args = args[1:]
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--medline', help='Medline baseline file (.xml.gz) to time on')
+    parser.add_argument('--articles', type=int, default=5000, help='number of synthetic articles')
+    parser.add_argument('--no-check', action='store_true', default=False, help='do not compare the output of the two handlers')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(args)
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv)
+    logging.basicConfig(level=logging.ERROR)
+    random.seed(options.seed)
+    if options.medline:
+        with gzip.open(options.medline) as handle:
+            data = handle.read()
+    else:
+        data = synthetic_medline(options.articles)
+
+    old_time, old = run(LinearHandler, data)
+    new_time, new = run(pubmed.PubMedHandler, data)
+    if not options.no_check and old != new:
+        raise Exception('handlers printed different records')
+    records = new.count('\n')
+    print('%-14s %8.2fs %10.1f records/sec' % ('linear scan', old_time, records / old_time))
+    print('%-14s %8.2fs %10.1f records/sec' % ('rule table', new_time, records / new_time))
+    print('%-14s %.2fx' % ('speedup', old_time / new_time))
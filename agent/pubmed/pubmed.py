@@ -1,5 +1,45 @@
 #!/usr/bin/env python
 
+"""
+Convert Medline baseline and update XML files to Pubmed JSON lines.
+
+With no --out the records of every file are printed to stdout, one file
+after another, with a {"pmid": ..., "deleted": true} tombstone for each
+PMID of a DeleteCitation. With --out the files are converted on --workers
+processes, each file to its own shard in the output directory:
+
+    medline17n0001.json           Pubmed JSON lines of medline17n0001.xml.gz
+    medline17n0001.pmids.npy      the PMIDs of those lines, in order
+    medline17n0001.revised.npy    their DateRevised as YYYYMMDD, 0 if missing
+    manifest.json                 shards in input order with record counts
+    pmid-index/pmids.npy          sorted PMIDs across all shards
+    pmid-index/shards.npy         the manifest shard each PMID is in, -1
+                                  once it has been deleted
+    pmid-index/revised.npy        DateRevised of the indexed record
+    pmid-index/delta-*.npy        the same for changes not yet folded in
+
+A shard is written under a .partial name and renamed once its file has
+been parsed, so running again over the same files only converts the ones
+without a finished shard, then rewrites the manifest and index. When a
+PMID appears in more than one file the later file in the input order wins.
+
+With --update the files are daily update files, applied in the order given
+to the baseline in --out. Each gets a shard with only the records that are
+new or carry a later DateRevised than the index, and a tombstone for each
+deleted PMID. Update files already in the manifest are skipped. The index
+changes go to the delta arrays, so a refresh reads and writes in proportion
+to the updates rather than the corpus, until the delta grows past
+COMPACT_FRACTION of the index and is merged into it.
+
+example usage:
+
+    pubmed.py --workers 8 --out medline-json medline17n0*.xml.gz
+    pubmed.py --update --out medline-json medline17n1*.xml.gz
+
+--engine lxml parses with lxml's iterparse instead of SAX callbacks, for
+the same output.
+"""
+import os
 import argparse
 import sys
 import re
@@ -7,17 +47,20 @@ import xml.sax
 import json
 import logging
 import gzip
+import multiprocessing
+import numpy
 from ftplib import FTP
 from bmeg.nlp_pb2 import Pubmed
-from google.protobuf import json_format
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import emitter
+import sax_rules
 
 reWord = re.compile(r'\w')
 reSpace = re.compile(r'\s')
 
 def message_to_json(message):
-    msg = json_format.MessageToDict(message)
-    #msg['#label'] = message.DESCRIPTOR.name
-    return json.dumps(msg)
+    return emitter.message_to_json(message)
 
 
 def ignore(e, v, attrs, **kwds):
@@ -52,8 +95,11 @@ def emit_pubmed(e,v,attrs, **kwds):
     if 'Abstract' in kwds['MedlineCitation']['Article']:
         out.abstract = kwds['MedlineCitation']['Article']['Abstract']['AbstractText']
     out.date = kwds['MedlineCitation']['DateCreated']
-    print message_to_json(out)
+    e.record(out, kwds['MedlineCitation'].get('DateRevised'))
 
+def emit_delete(e, v, attrs, **kwds):
+    for pmid in kwds.get('PMID', []):
+        e.delete(pmid)
 
 f_map = [
     (['PubmedArticleSet','PubmedArticle'], None, emit_pubmed),
@@ -77,29 +123,21 @@ f_map = [
     (['PubmedArticleSet','PubmedArticle','MedlineCitation','Article','Abstract','AbstractText'], None, string_pass),
     (['PubmedArticleSet','PubmedArticle','MedlineCitation','Article','Abstract'], None, pass_data),
 
+    (['PubmedArticleSet','DeleteCitation','PMID'], None, create_list),
+    (['PubmedArticleSet','DeleteCitation'], None, emit_delete),
+
 ]
 
+RULES = sax_rules.RuleTable(f_map, text_combiners=[string_pass, create_list])
+
 class StackLevel:
-    def __init__(self, name, attrs):
+    def __init__(self, name, attrs, state):
         self.data = {}
         self.name = name
         self.has_children = False
         self.attrs = attrs
-
-def stack_match(query, elem):
-    match = True
-    if len(query) != len(elem):
-        return False
-    for q, e in zip(query, elem):
-        if isinstance(q, list):
-            if e not in q:
-                return False
-        else:
-            if q != "*" and q != e:
-                return False
-    return True
-
-NOT_FOUND = set()
+        self.state = state
+        self.text = [] if state.text else None
 
 class PubMedHandler(xml.sax.ContentHandler):
     def __init__(self, record_write):
@@ -110,57 +148,433 @@ class PubMedHandler(xml.sax.ContentHandler):
     def startElement(self, name, attrs):
         if len(self.stack):
             self.stack[-1].has_children = True
-        self.stack.append(StackLevel(name, dict(attrs.items())))
-        self.buffer = ""
+            state = self.stack[-1].state.child(name)
+        else:
+            state = RULES.root.child(name)
+        self.stack.append(StackLevel(name, dict(attrs.items()), state))
 
     def characters(self, text):
-        self.buffer += text
+        chunks = self.stack[-1].text
+        if chunks is not None:
+            chunks.append(text)
 
     def endElement(self, name):
-        found = False
-        stack_id = list(i.name for i in self.stack)
-        #print stack_id
         level = self.stack.pop()
-        for s, out_name, f in f_map:
-            if stack_match(s, stack_id):
-                found = True
-                if out_name is None:
-                    out_name = stack_id[-1]
-                v = f(self.record_write, self.buffer, level.attrs, **level.data)
-                if v is not None:
-                    if isinstance(v,list):
-                        if out_name in self.stack[-1].data:
-                            self.stack[-1].data[out_name].extend(v)
-                        else:
-                            self.stack[-1].data[out_name] = v
-                    elif isinstance(v,dict):
-                        if out_name in self.stack[-1].data:
-                            self.stack[-1].data[out_name] = dict(self.stack[-1].data, **v)
-                        else:
-                            self.stack[-1].data[out_name] = v
+        state = level.state
+        text = "" if level.text is None else "".join(level.text)
+        for out_name, f in state.combiners:
+            v = f(self.record_write, text, level.attrs, **level.data)
+            if v is not None:
+                if isinstance(v,list):
+                    if out_name in self.stack[-1].data:
+                        self.stack[-1].data[out_name].extend(v)
                     else:
                         self.stack[-1].data[out_name] = v
-        if not found:
-            n = ",".join(stack_id)
-            if n not in NOT_FOUND:
-                NOT_FOUND.add(n)
-                logging.warning("combiner for %s not found" % (",".join(stack_id)))
-        self.buffer = ""
-
-def emit(msg):
-    print msg
-
-def parse_pubmed(handle):
-    handler = PubMedHandler(emit)
+                elif isinstance(v,dict):
+                    if out_name in self.stack[-1].data:
+                        self.stack[-1].data[out_name] = dict(self.stack[-1].data, **v)
+                    else:
+                        self.stack[-1].data[out_name] = v
+                else:
+                    self.stack[-1].data[out_name] = v
+        if not state.combiners:
+            if level.text is not None:
+                # text of inline markup belongs to the enclosing element
+                self.stack[-1].text.append(text)
+            if not state.reported:
+                state.reported = True
+                logging.warning("combiner for %s not found" % (",".join(state.path())))
+
+TOMBSTONE = "tombstone"
+
+def tombstone(pmid):
+    return {"pmid": pmid, "deleted": True}
+
+def tombstone_json(pmid):
+    return emitter.dict_to_json(tombstone(pmid))
+
+def date_number(date):
+    """
+    A date_extract date as a YYYYMMDD integer, 0 when missing.
+    """
+    try:
+        return int(date.replace("-", ""))
+    except (AttributeError, ValueError):
+        return 0
+
+class StdoutWriter(object):
+    def record(self, message, revised=None):
+        sys.stdout.write(message_to_json(message) + "\n")
+
+    def delete(self, pmid):
+        sys.stdout.write(tombstone_json(pmid) + "\n")
+
+ENGINES = ["sax", "lxml"]
+
+def parse_pubmed(handle, writer=None, engine="sax"):
+    """
+    Parse a Medline file with the SAX handler, or with lxml's iterparse,
+    which reduces one PubmedArticle at a time and gives the same records.
+    """
+    if writer is None:
+        writer = StdoutWriter()
+    if engine == "lxml":
+        sax_rules.iterparse(handle, RULES, writer)
+        return
+    handler = PubMedHandler(writer)
     parser = xml.sax.make_parser()
     parser.setContentHandler(handler)
     parser.parse(handle)
 
+########################################
+
+MANIFEST = "manifest.json"
+INDEX = "pmid-index"
+PARTIAL = ".partial"
+
+# rewrite the full index once the changes from update files reach this
+# fraction of it, and keep them in the smaller delta arrays until then
+COMPACT_FRACTION = 0.05
+
+def shard_name(path):
+    name = os.path.basename(path)
+    for suffix in [".gz", ".xml"]:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+def shard_paths(out_dir, path):
+    base = os.path.join(out_dir, shard_name(path))
+    return base + ".json", base + ".pmids.npy", base + ".revised.npy"
+
+def shard_complete(out_dir, path):
+    return all(os.path.exists(p) for p in shard_paths(out_dir, path))
+
+def save_array(path, values):
+    with open(path + PARTIAL, "wb") as handle:
+        numpy.save(handle, values)
+    os.rename(path + PARTIAL, path)
+
+def save_json(path, data):
+    with open(path + PARTIAL, "w") as handle:
+        json.dump(data, handle, indent=2, sort_keys=True)
+    os.rename(path + PARTIAL, path)
+
+def read_manifest(out_dir):
+    with open(os.path.join(out_dir, MANIFEST)) as handle:
+        return json.load(handle)
+
+class ShardWriter(object):
+    """
+    Writes Pubmed lines and deletion tombstones to a shard and keeps the
+    PMID and DateRevised of each record.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.emit = emitter.JSONEmitter(out=path)
+        self.pmids = []
+        self.revised = []
+        self.deleted = []
+
+    def record(self, message, revised=None):
+        self.pmids.append(int(message.pmid))
+        self.revised.append(date_number(revised))
+        self.emit(message)
+
+    def delete(self, pmid):
+        self.deleted.append(int(pmid))
+        self.emit.emit_dict(TOMBSTONE, tombstone(pmid))
+
+    def close(self):
+        self.emit.close()
+
+class PMIDIndex(object):
+    """
+    PMID -> (shard, DateRevised) for the shards of an output directory.
+    The full index is three sorted, memory mapped arrays. Changes made by
+    update files are kept in delta arrays, loaded into a dict, until
+    save() folds them into the full index. Deleted PMIDs have shard -1.
+    """
+
+    NAMES = ["pmids", "shards", "revised"]
+
+    def __init__(self, out_dir):
+        self.path = os.path.join(out_dir, INDEX)
+        self.pmids, self.shards, self.revised = self.load("")
+        pmids, shards, revised = self.load("delta-")
+        self.delta = dict(zip(pmids.tolist(), zip(shards.tolist(), revised.tolist())))
+
+    def load(self, prefix):
+        paths = [os.path.join(self.path, prefix + name + ".npy") for name in self.NAMES]
+        if not all(os.path.exists(p) for p in paths):
+            return (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0, dtype=numpy.int32))
+        return tuple(numpy.load(p, mmap_mode="r") for p in paths)
+
+    def __len__(self):
+        return len(self.pmids)
+
+    def get(self, pmid):
+        entry = self.delta.get(pmid)
+        if entry is not None:
+            return entry
+        i = numpy.searchsorted(self.pmids, pmid)
+        if i < len(self.pmids) and self.pmids[i] == pmid:
+            return int(self.shards[i]), int(self.revised[i])
+        return None
+
+    def set(self, pmid, shard, revised):
+        self.delta[pmid] = (shard, revised)
+
+    def live(self):
+        """
+        The number of PMIDs that are not deleted.
+        """
+        count = int((numpy.asarray(self.shards) >= 0).sum())
+        for pmid, (shard, revised) in self.delta.items():
+            i = numpy.searchsorted(self.pmids, pmid)
+            if i < len(self.pmids) and self.pmids[i] == pmid and self.shards[i] >= 0:
+                count -= 1
+            if shard >= 0:
+                count += 1
+        return count
+
+    def save(self, compact_fraction=COMPACT_FRACTION):
+        pmids = numpy.array(sorted(self.delta), dtype=numpy.int64)
+        entries = [self.delta[p] for p in pmids.tolist()]
+        shards = numpy.array([e[0] for e in entries], dtype=numpy.int32)
+        revised = numpy.array([e[1] for e in entries], dtype=numpy.int32)
+        if len(pmids) > compact_fraction * len(self.pmids):
+            self.reset(*merge_index(self.pmids, self.shards, self.revised, pmids, shards, revised))
+        else:
+            self.write("delta-", pmids, shards, revised)
+
+    def reset(self, pmids, shards, revised):
+        """
+        Replace the full index and drop the delta.
+        """
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        self.write("", pmids, shards, revised)
+        self.write("delta-", empty, empty.astype(numpy.int32), empty.astype(numpy.int32))
+
+    def write(self, prefix, pmids, shards, revised):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        for name, values in zip(self.NAMES, [pmids, shards, revised]):
+            save_array(os.path.join(self.path, prefix + name + ".npy"), values)
+
+def merge_index(*arrays):
+    """
+    Merge (pmids, shards, revised) triples given one after another into one
+    sorted triple, the last triple winning for a repeated PMID.
+    """
+    pmids = numpy.concatenate([numpy.asarray(a) for a in arrays[0::3]])
+    shards = numpy.concatenate([numpy.asarray(a) for a in arrays[1::3]])
+    revised = numpy.concatenate([numpy.asarray(a) for a in arrays[2::3]])
+    order = numpy.argsort(pmids, kind="mergesort")
+    pmids = pmids[order]
+    last = numpy.ones(len(pmids), dtype=bool)
+    last[:-1] = pmids[1:] != pmids[:-1]
+    return pmids[last], shards[order][last], revised[order][last]
+
+def convert_file(task):
+    """
+    Parse one Medline file into its shard. Returns (path, records).
+    """
+    path, out_dir, engine = task
+    shard, pmid_path, revised_path = shard_paths(out_dir, path)
+    writer = ShardWriter(shard + PARTIAL)
+    with gzip.open(path) as handle:
+        parse_pubmed(handle, writer, engine)
+    writer.close()
+
+    save_array(pmid_path, numpy.array(writer.pmids, dtype=numpy.int64))
+    save_array(revised_path, numpy.array(writer.revised, dtype=numpy.int32))
+    # the shard is renamed last, it marks the file as done
+    os.rename(shard + PARTIAL, shard)
+    return path, len(writer.pmids)
+
+def write_manifest(out_dir, paths):
+    """
+    Write the manifest and a new PMID index for the baseline shards of
+    paths. A PMID in several shards is indexed to the last of them.
+    """
+    shards = []
+    arrays = []
+    for position, path in enumerate(paths):
+        shard, pmid_path, revised_path = shard_paths(out_dir, path)
+        pmids = numpy.load(pmid_path)
+        shards.append({"source": os.path.basename(path), "shard": os.path.basename(shard), "records": len(pmids)})
+        arrays.extend([pmids, numpy.full(len(pmids), position, dtype=numpy.int32), numpy.load(revised_path)])
+
+    if arrays:
+        pmids, positions, revised = merge_index(*arrays)
+    else:
+        pmids = numpy.zeros(0, dtype=numpy.int64)
+        positions = revised = numpy.zeros(0, dtype=numpy.int32)
+    PMIDIndex(out_dir).reset(pmids, positions, revised)
+
+    manifest = {"shards": shards, "records": int(sum(s["records"] for s in shards)), "pmids": len(pmids)}
+    save_json(os.path.join(out_dir, MANIFEST), manifest)
+    return manifest
+
+def applied_manifest(out_dir, paths):
+    """
+    The manifest of out_dir when update files have been applied to it, or
+    None. Rewriting the manifest and index from the baseline shards would
+    drop the updates, so the baseline can then only be run again as it was.
+    """
+    if not os.path.exists(os.path.join(out_dir, MANIFEST)):
+        return None
+    manifest = read_manifest(out_dir)
+    baseline = [s["source"] for s in manifest["shards"] if not s.get("update")]
+    if len(baseline) == len(manifest["shards"]):
+        return None
+    if baseline != [os.path.basename(p) for p in paths] or not all(shard_complete(out_dir, p) for p in paths):
+        raise ValueError("%s has update files applied, the baseline can not be changed" % (out_dir))
+    return manifest
+
+def convert_files(paths, out_dir, workers=1, engine="sax"):
+    """
+    Convert each Medline file without a finished shard in out_dir, on
+    `workers` processes, then write the manifest and PMID index. Once
+    updates are applied, running the same baseline again leaves the
+    manifest and index as they are.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    names = [shard_name(p) for p in paths]
+    if len(set(names)) != len(names):
+        raise ValueError("input files have to have distinct names")
+    manifest = applied_manifest(out_dir, paths)
+    if manifest is not None:
+        logging.info("%d files already converted, %d update files applied" % (len(paths), len(manifest["shards"]) - len(paths)))
+        return manifest
+
+    todo = [(p, out_dir, engine) for p in paths if not shard_complete(out_dir, p)]
+    logging.info("%d of %d files already converted" % (len(paths) - len(todo), len(paths)))
+    if workers > 1 and len(todo) > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(convert_file, todo)
+    else:
+        pool = None
+        results = (convert_file(t) for t in todo)
+
+    try:
+        for path, records in results:
+            logging.info("%s: %d records" % (path, records))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return write_manifest(out_dir, paths)
+
+########################################
+
+class EventWriter(object):
+    """
+    Keeps the records and deletions of an update file in file order, as
+    ('record', pmid, revised, line) and ('delete', pmid).
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def record(self, message, revised=None):
+        self.events.append(("record", int(message.pmid), date_number(revised), message_to_json(message)))
+
+    def delete(self, pmid):
+        self.events.append(("delete", int(pmid)))
+
+def parse_update(task):
+    path, engine = task
+    writer = EventWriter()
+    with gzip.open(path) as handle:
+        parse_pubmed(handle, writer, engine)
+    return path, writer.events
+
+def apply_update(out_dir, index, path, events, position):
+    """
+    Write the shard of one update file with the records that are new or
+    have a later DateRevised than the index, and a tombstone for each
+    deleted PMID the index holds. A DateRevised of 0 is unknown, so a
+    record where either date is missing is applied. Returns its manifest
+    entry.
+    """
+    shard = shard_paths(out_dir, path)[0]
+    records = 0
+    deleted = 0
+    with emitter.JSONEmitter(out=shard + PARTIAL) as emit:
+        for event in events:
+            current = index.get(event[1])
+            if event[0] == "record":
+                kind, pmid, revised, line = event
+                if current is not None and current[0] >= 0 and revised and current[1] and revised <= current[1]:
+                    continue
+                index.set(pmid, position, revised)
+                emit.emit_line(Pubmed.DESCRIPTOR.full_name, line)
+                records += 1
+            else:
+                kind, pmid = event
+                if current is None or current[0] < 0:
+                    continue
+                index.set(pmid, -1, current[1])
+                emit.emit_dict(TOMBSTONE, tombstone(str(pmid)))
+                deleted += 1
+    os.rename(shard + PARTIAL, shard)
+    return {"source": os.path.basename(path), "shard": os.path.basename(shard), "records": records, "deleted": deleted, "update": True}
+
+def apply_updates(paths, out_dir, workers=1, engine="sax"):
+    """
+    Apply update files, in the order given, to the baseline converted into
+    out_dir. Files already in the manifest are skipped. Each applied file
+    gets a shard holding only its new or revised records and tombstones
+    for its deletions; the index and manifest are written at the end, so
+    an interrupted run applies the same files again from the same index.
+    """
+    manifest = read_manifest(out_dir)
+    applied = set(s["source"] for s in manifest["shards"])
+    todo = [p for p in paths if os.path.basename(p) not in applied]
+    names = [shard_name(s["source"]) for s in manifest["shards"]] + [shard_name(p) for p in todo]
+    if len(set(names)) != len(names):
+        raise ValueError("update files have to have distinct names from the files already applied")
+    logging.info("%d of %d update files already applied" % (len(paths) - len(todo), len(paths)))
+
+    index = PMIDIndex(out_dir)
+    if workers > 1 and len(todo) > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(parse_update, [(p, engine) for p in todo])
+    else:
+        pool = None
+        results = (parse_update((p, engine)) for p in todo)
+
+    try:
+        for path, events in results:
+            entry = apply_update(out_dir, index, path, events, len(manifest["shards"]))
+            manifest["shards"].append(entry)
+            manifest["records"] += entry["records"]
+            logging.info("%s: %d new or revised, %d deleted" % (path, entry["records"], entry["deleted"]))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    manifest["pmids"] = index.live()
+    index.save()
+    save_json(os.path.join(out_dir, MANIFEST), manifest)
+    return manifest
+
 if __name__ =="__main__":
     logging.basicConfig(level=logging.INFO)
 
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument("-l", action="store_true", default=False)
+    parser.add_argument("--out", type=str, help="Directory to write a JSON lines shard per input file to, instead of stdout")
+    parser.add_argument("--workers", type=int, default=1, help="Number of files to convert at once with --out")
+    parser.add_argument("--engine", choices=ENGINES, default="sax", help="Parse with the SAX handler or with lxml iterparse")
+    parser.add_argument("--update", action="store_true", default=False, help="The files are update files to apply, in order, to the baseline already converted into --out")
     parser.add_argument("files", nargs="*")
     args = parser.parse_args()
 
@@ -169,7 +583,13 @@ if __name__ =="__main__":
         ftp.login()
         for i in ftp.nlst("/pubmed/baseline/medline*.xml.gz"):
             print "ftp://ftp.ncbi.nlm.nih.gov%s" % i
+    elif args.out and args.update:
+        apply_updates(args.files, args.out, args.workers, args.engine)
+    elif args.out:
+        convert_files(args.files, args.out, args.workers, args.engine)
     else:
+        if args.workers > 1 or args.update:
+            parser.error("--workers and --update need --out")
         for path in args.files:
             with gzip.open(path) as handle:
-                parse_pubmed(handle)
+                parse_pubmed(handle, engine=args.engine)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+'''
+Reader for Broad .res expression files, shared by the CCLE converters.
+
+After the gene and accession columns a .res file alternates a sample value
+column and an unnamed call column. The file is read once with the pandas C
+parser into a genes x samples float array with the call columns dropped,
+and rows that share a gene are averaged in one grouped pass: the rows are
+ordered by a gene index computed once, summed with add.reduceat and
+divided by the group counts.
+
+example usage:
+
+    import res_matrix
+    samples, genes, values = res_matrix.read_res('CCLE_Expression_2012-09-29.res', 2)
+    genes, means = res_matrix.collapse_genes(genes, values)
+'''
+
+import numpy
+import pandas
+
+def read_res(path, skip):
+    '''
+    Read a .res file into its sample names, the gene of each row and a
+    genes x samples float array. skip is the number of lines between the
+    header and the first gene row.
+    '''
+    with open(path) as handle:
+        header = handle.readline().rstrip('\r\n').split('\t')
+    columns = [i for i, name in enumerate(header) if i >= 2 and len(name)]
+    samples = [header[i] for i in columns]
+
+    frame = pandas.read_csv(path, sep='\t', header=None, skiprows=1 + skip,
+        usecols=[0] + columns, dtype=dict([(0, object)] + [(i, numpy.float64) for i in columns]),
+        keep_default_na=False, float_precision='round_trip')
+    frame = frame[frame[0].str.len() > 0]
+    return samples, frame[0].values, frame[columns].values
+
+def collapse_genes(genes, values):
+    '''
+    Average the rows of values that share a gene. Returns the sorted unique
+    genes and a matching array of means, one row per gene.
+    '''
+    unique, index = numpy.unique(genes, return_inverse=True)
+    order = numpy.argsort(index, kind='mergesort')
+    starts = numpy.flatnonzero(numpy.diff(numpy.concatenate([[-1], index[order]])))
+    sums = numpy.add.reduceat(values[order], starts, axis=0)
+    counts = numpy.diff(numpy.append(starts, len(order)))
+    return unique.tolist(), sums / counts[:, numpy.newaxis]
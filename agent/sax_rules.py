@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+'''
+Compiled combiner rules for the SAX handlers of the pubmed and drugbank
+agents.
+
+A rule is (path, out_name, combiner) where each step of the path is an
+element name, '*' for any name, or a list of alternative names. Matching
+every rule against the element stack on every closing tag costs a scan of
+the whole rule list per element, so the rules are compiled once into a
+trie of element names, and the handlers walk a table of document paths
+alongside it:
+
+    rules = sax_rules.RuleTable(f_map)
+    state = rules.root
+    state = state.child('PubmedArticleSet')     # on startElement
+    state = state.child('PubmedArticle')
+    state.combiners                             # on endElement
+
+Each distinct document path gets one PathState, created the first time the
+path is seen and reused after that, so advancing on startElement is a dict
+lookup and endElement reads the combiners already resolved for the path.
+When several rules match a path their combiners are listed in rule order,
+the order the linear scan applied them in.
+
+Only some combiners (string_pass, create_list) use the text of their
+element. A PathState has text set when one of its combiners does, or when
+it has no combiners and sits inside an element that collects text, so
+inline markup such as <i> in an AbstractText still contributes its words.
+The handlers keep a chunk list only for those levels and skip the text of
+everything else.
+
+example usage:
+
+    import sax_rules
+    rules = sax_rules.RuleTable(f_map, text_combiners=[string_pass, create_list])
+    state = rules.root.child('drugbank').child('drug').child('name')
+    for out_name, combiner in state.combiners:
+        ...
+'''
+
+import logging
+import itertools
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+WILDCARD = '*'
+
+def stack_match(query, elem):
+    '''
+    Match one rule path against a full element path, the reference
+    semantics the compiled table follows.
+    '''
+    if len(query) != len(elem):
+        return False
+    for q, e in zip(query, elem):
+        if isinstance(q, list):
+            if e not in q:
+                return False
+        else:
+            if q != WILDCARD and q != e:
+                return False
+    return True
+
+def expand_path(path):
+    '''
+    Every plain path a rule path with alternative lists stands for.
+    '''
+    steps = [step if isinstance(step, list) else [step] for step in path]
+    return itertools.product(*steps)
+
+class RuleNode(object):
+    '''
+    One step of the rule trie. rules holds (order, out_name, combiner) for
+    the rules ending here.
+    '''
+
+    __slots__ = ('children', 'wildcard', 'rules')
+
+    def __init__(self):
+        self.children = {}
+        self.wildcard = None
+        self.rules = []
+
+    def step(self, name):
+        if name == WILDCARD:
+            if self.wildcard is None:
+                self.wildcard = RuleNode()
+            return self.wildcard
+        node = self.children.get(name)
+        if node is None:
+            node = RuleNode()
+            self.children[name] = node
+        return node
+
+    def advance(self, name):
+        out = []
+        node = self.children.get(name)
+        if node is not None:
+            out.append(node)
+        if self.wildcard is not None:
+            out.append(self.wildcard)
+        return out
+
+class PathState(object):
+    '''
+    The rule nodes reached by one document path and the combiners of the
+    rules ending on it, as (out_name, combiner) with out_name resolved to
+    the element name where the rule leaves it as None.
+    '''
+
+    __slots__ = ('name', 'parent', 'nodes', 'combiners', 'children', 'reported', 'text', 'text_combiners')
+
+    def __init__(self, name, parent, nodes, text_combiners):
+        self.name = name
+        self.parent = parent
+        self.nodes = nodes
+        self.children = {}
+        self.reported = False
+        self.text_combiners = text_combiners
+        rules = sorted(dict((rule[0], rule) for node in nodes for rule in node.rules).values())
+        self.combiners = [(name if out_name is None else out_name, combiner) for order, out_name, combiner in rules]
+        if self.combiners:
+            self.text = any(combiner in text_combiners for out_name, combiner in self.combiners)
+        else:
+            self.text = parent is not None and parent.text
+
+    def child(self, name):
+        state = self.children.get(name)
+        if state is None:
+            nodes = []
+            for node in self.nodes:
+                nodes.extend(node.advance(name))
+            state = PathState(name, self, nodes, self.text_combiners)
+            self.children[name] = state
+        return state
+
+    def child_tag(self, tag):
+        '''
+        child() for an lxml tag, which may carry a namespace. The state is
+        also kept under the tag itself so the next lookup is direct.
+        '''
+        state = self.children.get(tag)
+        if state is None:
+            state = self.child(local_name(tag))
+            self.children[tag] = state
+        return state
+
+    def path(self):
+        out = []
+        state = self
+        while state.parent is not None:
+            out.append(state.name)
+            state = state.parent
+        out.reverse()
+        return out
+
+class RuleTable(object):
+    '''
+    A rule list compiled into a trie, with root as the PathState of the
+    empty path. text_combiners are the combiners that read element text.
+    '''
+
+    def __init__(self, rules, text_combiners=()):
+        self.trie = RuleNode()
+        for order, (path, out_name, combiner) in enumerate(rules):
+            for steps in expand_path(path):
+                node = self.trie
+                for step in steps:
+                    node = node.step(step)
+                node.rules.append((order, out_name, combiner))
+        self.root = PathState(None, None, [self.trie], frozenset(text_combiners))
+
+########################################
+
+def merge_value(data, out_name, v):
+    '''
+    Store a combiner's return value in the parent level's data the way the
+    SAX handlers do: lists are extended, anything else is set.
+    '''
+    if isinstance(v, list):
+        if out_name in data:
+            data[out_name].extend(v)
+        else:
+            data[out_name] = v
+    elif isinstance(v, dict):
+        if out_name in data:
+            data[out_name] = dict(data, **v)
+        else:
+            data[out_name] = v
+    else:
+        data[out_name] = v
+
+def local_name(tag):
+    # the SAX handlers see names without namespaces, as in drugbank's
+    # default xmlns
+    if tag[0] == '{':
+        return tag.rpartition('}')[2]
+    return tag
+
+class TreeReducer(object):
+    '''
+    Applies a rule table to an lxml element tree the way the SAX handlers
+    apply it to events. Text comes from element.text and child tails
+    instead of characters() calls, and subtrees no rule can reach are
+    skipped without being walked; only their top element is reported as
+    having no combiner. With attrs the element attributes are passed to
+    the combiners as the pubmed handler does.
+    '''
+
+    def __init__(self, record_write, attrs=True):
+        self.record_write = record_write
+        self.attrs = attrs
+
+    def reduce(self, element, state, parent_data, parent_text):
+        data = {}
+        text = [] if state.text else None
+        if text is not None and element.text:
+            text.append(element.text)
+        for child in element:
+            tag = child.tag
+            if isinstance(tag, basestring):
+                child_state = state.child_tag(tag)
+                if not (child_state.nodes or child_state.text):
+                    self.report(child_state)
+                elif len(child):
+                    self.reduce(child, child_state, data, text)
+                else:
+                    self.leaf(child, child_state, data, text)
+            if text is not None and child.tail:
+                text.append(child.tail)
+        self.combine(element, state, data, text, parent_data, parent_text)
+
+    def leaf(self, element, state, parent_data, parent_text):
+        text = None
+        if state.text:
+            text = [element.text] if element.text else []
+        self.combine(element, state, {}, text, parent_data, parent_text)
+
+    def combine(self, element, state, data, text, parent_data, parent_text):
+        value = '' if text is None else ''.join(text)
+        for out_name, f in state.combiners:
+            if self.attrs:
+                v = f(self.record_write, value, dict(element.attrib), **data)
+            else:
+                v = f(self.record_write, value, **data)
+            if v is not None:
+                merge_value(parent_data, out_name, v)
+        if not state.combiners:
+            if text is not None:
+                parent_text.append(value)
+            self.report(state)
+
+    def report(self, state):
+        if not state.reported:
+            state.reported = True
+            logging.warning("combiner for %s not found" % (",".join(state.path())))
+
+def record_tags(rules):
+    '''
+    The element names rules can match directly under a root element, as
+    lxml tag filters in any namespace, or None when a wildcard allows any.
+    '''
+    roots = list(rules.trie.children.values())
+    if rules.trie.wildcard is not None:
+        return None
+    names = set()
+    for node in roots:
+        if node.wildcard is not None:
+            return None
+        names.update(node.children)
+    return ['{*}' + name for name in sorted(names)]
+
+def iterparse(handle, rules, record_write, attrs=True):
+    '''
+    Parse a document whose records are the children of its root element,
+    PubmedArticle or DeleteCitation under PubmedArticleSet, drug under
+    drugbank, with lxml's iterparse. Only the end events of the record
+    elements the rules name come back from lxml; each record is reduced
+    and then cleared, along with everything before it, so memory holds one
+    record at a time. Unlike the handlers, children of the root that no
+    rule names are dropped without a warning.
+    '''
+    from lxml import etree
+
+    reducer = TreeReducer(record_write, attrs)
+    root = None
+    root_state = None
+    root_data = {}
+    for event, element in etree.iterparse(handle, events=('end',), tag=record_tags(rules), huge_tree=True):
+        parent = element.getparent()
+        if parent is None or parent.getparent() is not None:
+            continue
+        if root is None:
+            root = parent
+            root_state = rules.root.child_tag(root.tag)
+        state = root_state.child_tag(element.tag)
+        if not (state.nodes or state.text):
+            reducer.report(state)
+        elif len(element):
+            reducer.reduce(element, state, root_data, None)
+        else:
+            reducer.leaf(element, state, root_data, None)
+        element.clear()
+        while element.getprevious() is not None:
+            del root[0]